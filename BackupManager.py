@@ -0,0 +1,131 @@
+import os
+import re
+import gzip
+import shutil
+import hashlib
+import logging
+import argparse
+import datetime
+from uuid import uuid4
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Snapshots are kept in this folder next to the file being backed up.
+BACKUP_DIR_NAME = 'Backups'
+# Retention policy: always keep the newest few snapshots, and drop anything older than the max age.
+SNAPSHOT_KEEP = 10
+SNAPSHOT_MAX_AGE_DAYS = 90
+
+Snapshot = namedtuple('Snapshot', ['path', 'timestamp', 'digest'])
+
+
+def get_backup_dir(file_path):
+    """Return the folder that holds the snapshots for a file."""
+    return os.path.join(os.path.dirname(os.path.abspath(file_path)), BACKUP_DIR_NAME)
+
+
+def list_snapshots(file_path):
+    """Return the snapshots of a file, newest first."""
+    backup_dir = get_backup_dir(file_path)
+    if not os.path.isdir(backup_dir):
+        return []
+    stem, ext = os.path.splitext(os.path.basename(file_path))
+    pattern = re.compile(rf'^{re.escape(stem)}_(\d{{8}}-\d{{6}})_([0-9a-f]{{16}}){re.escape(ext)}\.gz$')
+    snapshots = []
+    for name in os.listdir(backup_dir):
+        match = pattern.match(name)
+        if match:
+            timestamp = datetime.datetime.strptime(match.group(1), '%Y%m%d-%H%M%S')
+            snapshots.append(Snapshot(os.path.join(backup_dir, name), timestamp, match.group(2)))
+    return sorted(snapshots, key=lambda x: x.timestamp, reverse=True)
+
+
+def snapshot_file(file_path):
+    """
+    Save a compressed snapshot of a file, ahead of overwriting it.
+
+    The file is hashed while it's compressed, and the new snapshot is thrown away if one with the same
+    contents already exists. Returns the path to the matching snapshot, or None if there's no file yet.
+    """
+    if not os.path.exists(file_path):
+        return None
+    backup_dir = get_backup_dir(file_path)
+    os.makedirs(backup_dir, exist_ok=True)
+    stem, ext = os.path.splitext(os.path.basename(file_path))
+    temp_path = os.path.join(backup_dir, f'{stem}.{uuid4().hex}.tmp')
+    # Hash and compress in the same pass so the file only gets read once.
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as source, gzip.open(temp_path, 'wb', compresslevel=1) as target:
+        for block in iter(lambda: source.read(1 << 20), b''):
+            hasher.update(block)
+            target.write(block)
+    digest = hasher.hexdigest()[:16]
+
+    existing = [i for i in list_snapshots(file_path) if i.digest == digest]
+    if existing:
+        os.remove(temp_path)
+        logger.info(f'{os.path.basename(file_path)} is unchanged since its last snapshot; no new backup needed.')
+        return existing[0].path
+    timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    snapshot_path = os.path.join(backup_dir, f'{stem}_{timestamp}_{digest}{ext}.gz')
+    os.replace(temp_path, snapshot_path)
+    logger.info(f'Saved backup of {os.path.basename(file_path)} as: {snapshot_path}')
+    prune_snapshots(file_path)
+    return snapshot_path
+
+
+def prune_snapshots(file_path, keep=SNAPSHOT_KEEP, max_age_days=SNAPSHOT_MAX_AGE_DAYS):
+    """Delete snapshots beyond the newest `keep`, and any older than max_age_days (the newest always stays)."""
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=max_age_days)
+    removed = []
+    for num, snapshot in enumerate(list_snapshots(file_path)):
+        if num > 0 and (num >= keep or snapshot.timestamp < cutoff):
+            os.remove(snapshot.path)
+            removed.append(snapshot)
+    if removed:
+        logger.info(f'Pruned {len(removed)} old backups of {os.path.basename(file_path)}.')
+    return removed
+
+
+def restore_snapshot(file_path, snapshot_path=None):
+    """
+    Restore a file from one of its snapshots (the newest one by default).
+
+    The current file gets snapshotted first, so a restore can always be undone.
+    """
+    snapshots = list_snapshots(file_path)
+    if snapshot_path is None:
+        if not snapshots:
+            logger.error(f'No backups found for {file_path}.')
+            return False
+        snapshot_path = snapshots[0].path
+    elif not os.path.exists(snapshot_path):
+        # Allow just the snapshot filename to be given.
+        snapshot_path = os.path.join(get_backup_dir(file_path), os.path.basename(snapshot_path))
+    if not os.path.exists(snapshot_path):
+        logger.error(f'Backup not found: {snapshot_path}')
+        return False
+    snapshot_file(file_path)
+    temp_path = f'{file_path}.{uuid4().hex}.tmp'
+    with gzip.open(snapshot_path, 'rb') as source, open(temp_path, 'wb') as target:
+        shutil.copyfileobj(source, target, 1 << 20)
+    os.replace(temp_path, file_path)
+    logger.info(f'Restored {file_path} from backup: {snapshot_path}')
+    return True
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(description='Manage backups of the commissions working files.')
+    parser.add_argument('command', choices=['list', 'restore', 'prune'])
+    parser.add_argument('file', help='Path to the backed-up file, e.g. the Commissions Master.')
+    parser.add_argument('--snapshot', help='Backup to restore (defaults to the newest).')
+    args = parser.parse_args()
+    if args.command == 'list':
+        for item in list_snapshots(args.file):
+            print(f'{item.timestamp:%m/%d/%Y %H:%M:%S}  {os.path.basename(item.path)}')
+    elif args.command == 'restore':
+        restore_snapshot(args.file, args.snapshot)
+    else:
+        prune_snapshots(args.file)
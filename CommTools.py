@@ -1,8 +1,14 @@
 import pandas as pd
-from RCExcelTools import table_format, form_date, save_error
+from RCExcelTools import table_format, save_error, tab_save_prep
 from xlrd import XLRDError
 import datetime
 import os
+import logging
+import GenerateMasterUtils as Utils
+from FileIO import load_run_com, load_entries_need_fixing, load_com_master, save_excel_file
+from BackupManager import snapshot_file
+
+logger = logging.getLogger(__name__)
 
 
 def extractLookups(runningCom):
@@ -113,164 +119,136 @@ def extractLookups(runningCom):
           '+++')
 
 
-def reIndex(runningCom):
-    """
-    """
-    # Set the directory for saving output files.
-    outDir = 'Z:/MK Working Commissions/'
-    lookDir = 'Z:/Commissions Lookup/'
+def match_keys(data):
+    """Build the composite key used to match Entries Need Fixing lines to Running Commissions lines."""
+    keys = pd.DataFrame(index=data.index)
+    for col in ['Reported Customer', 'Part Number', 'From File', 'Invoice Number']:
+        keys[col] = data[col].astype(str).str.strip()
+    keys['Actual Comm Paid'] = pd.to_numeric(data['Actual Comm Paid'], errors='coerce').round(2)
+    # Exact duplicates get matched up in the order that they occur in each file.
+    keys['Occurrence'] = keys.groupby(list(keys.columns), dropna=False).cumcount()
+    return keys
 
-    # ----------------------------------------------
-    # Load up the current Running Commissions file.
-    # ----------------------------------------------
-    runningCom = pd.read_excel(runCom, 'Master', dtype=str)
-    # Convert applicable columns to numeric.
-    numCols = ['Quantity', 'Ext. Cost', 'Invoiced Dollars',
-               'Paid-On Revenue', 'Actual Comm Paid', 'Unit Cost',
-               'Unit Price', 'CM Split', 'Year', 'Sales Commission',
-               'Split Percentage', 'Commission Rate',
-               'Gross Rev Reduction', 'Shared Rev Tier Rate']
-    for col in numCols:
-        try:
-            runningCom[col] = pd.to_numeric(runningCom[col],
-                                            errors='coerce').fillna('')
-        except KeyError:
-            pass
-    # Convert individual numbers to numeric in rest of columns.
-    mixedCols = [col for col in list(runningCom) if col not in numCols]
-    # Invoice/part numbers sometimes has leading zeros we'd like to keep.
-    mixedCols.remove('Invoice Number')
-    mixedCols.remove('Part Number')
-    # The INF gets read in as infinity, so skip the principal column.
-    mixedCols.remove('Principal')
-    for col in mixedCols:
-        runningCom[col] = runningCom[col].map(
-                lambda x: pd.to_numeric(x, errors='ignore'))
-    runningCom.replace('nan', '', inplace=True)
-    # Round the Actual Comm Paid field.
-    runningCom['Actual Comm Paid'] = runningCom['Actual Comm Paid'].map(
-            lambda x: round(float(x), 2))
-    filesProcessed = pd.read_excel(runCom, 'Files Processed').fillna('')
-    comDate = runCom[-20:]
-
-    # --------------------------------------
-    # Load up the Entries Need Fixing file.
-    # --------------------------------------
-    if os.path.exists(outDir + 'Entries Need Fixing ' + comDate):
-        try:
-            fixList = pd.read_excel(outDir + 'Entries Need Fixing ' + comDate,
-                                    'Data', dtype=str)
-            # Convert entries to proper types, like above.
-            for col in numCols:
-                try:
-                    fixList[col] = pd.to_numeric(fixList[col],
-                                                 errors='coerce').fillna('')
-                except KeyError:
-                    pass
-            for col in mixedCols:
-                fixList[col] = fixList[col].map(
-                        lambda x: pd.to_numeric(x, errors='ignore'))
-            fixList.replace('nan', '', inplace=True)
-            # Round the Actual Comm Paid field.
-            fixList['Actual Comm Paid'] = fixList['Actual Comm Paid'].map(
-                    lambda x: round(float(x), 2))
-        except XLRDError:
-            print('Error reading sheet name for Entries Need Fixing.xlsx!\n'
-                  'Please make sure the main tab is named Data.\n'
-                  '*Program Teminated*')
-            return
-    else:
-        print('No Entries Need Fixing file found!\n'
-              'Please make sure Entries Need Fixing ' + comDate
-              + ' is in the directory ' + outDir + '.\n'
-              '*Program Teminated*')
-        return
 
-    # ------------------------------------------------------
-    # Go through and start matching the lines in ENF to RC.
-    # ------------------------------------------------------
-    for row in fixList.index:
-        # Match the Reported Customer, Part Number, File, Commissions, and
-        # Invoice Number.
-        repCust = fixList.loc[row, 'Reported Customer']
-        repCustMatch = runningCom[runningCom['Reported Customer'] == repCust]
-        partNo = fixList.loc[row, 'Part Number']
-        partNoMatch = repCustMatch[repCustMatch['Part Number'] == partNo]
-        file = fixList.loc[row, 'From File']
-        fileMatch = partNoMatch[partNoMatch['From File'] == file]
-        comm = fixList.loc[row, 'Actual Comm Paid']
-        commMatch = fileMatch[fileMatch['Actual Comm Paid'] == comm]
-        invNo = fixList.loc[row, 'Invoice Number']
-        invMatch = commMatch[commMatch['Invoice Number'] == invNo]
-        # One match, we're good.
-        if len(commMatch) == 1:
-            fixList.loc[row, 'Running Com Index'] = str(commMatch.index[0])
-        # Multiple matches, find and deal with exact duplicates.
-        elif len(commMatch) > 1:
-            fixList.loc[row, 'Running Com Index'] = ', '.join(
-                    str(i) for i in invMatch.index)
-        else:
-            fixList.loc[row, 'Running Com Index'] = ''
+def match_entries_to_running_com(entries_need_fixing, running_com):
+    """
+    Match each Entries Need Fixing line to its line in Running Commissions.
 
-    # -------------------------------------------
-    # Deal with all of the multiple match lines.
-    # -------------------------------------------
-    multiMatches = fixList[fixList['Running Com Index'].str.contains(',')]
-    for match in multiMatches['Running Com Index'].unique():
-        matchIDs = match.split(', ')
-        matchIDs = [int(i) for i in matchIDs]
-        RCMatches = runningCom.loc[matchIDs]
-        allMatch = all([all(RCMatches.iloc[0] == i) for i in RCMatches])
+    Returns a series (aligned with entries_need_fixing) holding the matching Running Commissions
+    index, or NaN where no match is found, along with a series flagging the unmatched lines that
+    collided with an existing key (i.e. there are more copies of the line in ENF than in RC).
+    """
+    enf_keys = match_keys(entries_need_fixing)
+    rc_keys = match_keys(running_com)
+    key_cols = list(enf_keys.columns)
+    matches = enf_keys.reset_index(names='ENF Index').merge(rc_keys.reset_index(names='Running Com Index'),
+                                                            how='left', on=key_cols, validate='one_to_one')
+    rc_index = matches.set_index('ENF Index')['Running Com Index'].reindex(entries_need_fixing.index)
+    # Unmatched lines whose key exists in RC are duplicates that ran out of RC lines to match.
+    rc_key_set = pd.MultiIndex.from_frame(rc_keys[key_cols[:-1]])
+    collisions = pd.Series(pd.MultiIndex.from_frame(enf_keys[key_cols[:-1]]).isin(rc_key_set),
+                           index=entries_need_fixing.index)
+    return rc_index, collisions & rc_index.isna()
+
+
+def reIndex(run_com_path):
+    """Rebuild the Running Com Index in Entries Need Fixing by matching each line back to Running Commissions.
+
+    Lines are matched on Reported Customer, Part Number, From File, Actual Comm Paid (rounded to the
+    cent) and Invoice Number. Exact duplicates are paired up in the order they appear in each file.
+    This is used to recover the index after rows have been edited, sorted or deleted by hand in Excel.
+    """
+    running_com, _ = load_run_com(file_path=run_com_path)
+    com_date = run_com_path[-20:]
+    filepath_ENF = os.path.join(Utils.DIRECTORIES.get('COMM_WORKING_DIR'), f'Entries Need Fixing {com_date}')
+    entries_need_fixing = load_entries_need_fixing(file_dir=filepath_ENF)
+    if running_com.empty or entries_need_fixing is None:
+        logger.error('Error loading Running Commissions and/or Entries Need Fixing.\n*Program Terminated*')
+        return
 
-    # --------------------------------
-    # Check for and clear collisions.
-    # --------------------------------
-    duplicates = fixList['Running Com Index'].duplicated()
-    
+    match_cols = ['Reported Customer', 'Part Number', 'From File', 'Actual Comm Paid', 'Invoice Number']
+    missing_cols = [i for i in match_cols if i not in list(running_com) or i not in list(entries_need_fixing)]
+    if missing_cols:
+        logger.error(f'The following columns are needed for matching but were not found: {', '.join(missing_cols)}'
+                     '\n*Program Terminated*')
+        return
 
+    logger.info('Matching Entries Need Fixing to Running Commissions...')
+    rc_index, collisions = match_entries_to_running_com(entries_need_fixing, running_com)
+    entries_need_fixing['Running Com Index'] = rc_index.astype('Int64').astype(object).fillna('')
+
+    # Report everything that couldn't be matched in one go.
+    unmatched = rc_index.isna() & ~collisions
+    if collisions.any():
+        logger.warning(f'{collisions.sum()} lines in Entries Need Fixing are duplicated more times than in '
+                       f'Running Commissions and were left unmatched. Excel rows: '
+                       f'{', '.join(map(str, collisions[collisions].index + 2))}')
+    if unmatched.any():
+        logger.warning(f'{unmatched.sum()} lines in Entries Need Fixing have no match in Running Commissions. '
+                       f'Excel rows: {', '.join(map(str, unmatched[unmatched].index + 2))}')
+    logger.info(f'Matched {rc_index.notna().sum()} of {len(rc_index)} lines.')
+
+    if save_error(filepath_ENF):
+        logger.error('Entries Need Fixing is currently open in Excel! '
+                     'Please close the file and try again.\n*Program Terminated*')
+        return
+    save_excel_file(filename=filepath_ENF, tab_data=entries_need_fixing, tab_names='Data')
+    logger.info('Running Com Index rebuilt successfully!')
 
 
+def removeData(comm_month):
+    """Roll back a commission month by removing its lines from the Commissions Master.
 
-def removeData(commMonth):
+    Files Processed entries are removed along with the lines for any file that has no lines left in
+    the Commissions Master. A backup of the Commissions Master is saved before it is overwritten, and
+    the removed lines are written to a Removed Data file along with a summary of the changes.
     """
-    """
-    # ---------------------------------------------
-    # Load and prepare the Commissions Master file.
-    # ---------------------------------------------
-    dataDir = 'Z:/MK Working Commissions/'
-    try:
-        comMast = pd.read_excel(dataDir + 'Commissions Master.xlsx',
-                                'Master Data', dtype=str)
-        masterFiles = pd.read_excel(dataDir + 'Commissions Master.xlsx',
-                                    'Files Processed').fillna('')
-    except FileNotFoundError:
-        print('No Commissions Master file found!\n'
-              '***')
+    month = Utils.normalize_comm_month(comm_month)
+    com_mast, master_files = load_com_master()
+    if com_mast.empty:
+        logger.error('Error loading the Commissions Master.\n*Program Terminated*')
         return
-    except XLRDError:
-        print('Commissions Master tab names incorrect!\n'
-              'Make sure the tabs are named Master and Files Processed.\n'
-              '***')
+
+    # Find the lines for this month through the Comm Month index.
+    month_index = Utils.build_comm_month_index(com_mast)
+    if month not in month_index:
+        logger.error(f'No lines found in the Commissions Master for Comm Month {month}.\n*Program Terminated*')
+        return
+    removed_pos = month_index[month]
+    removed = com_mast.iloc[removed_pos].reset_index(drop=True)
+    com_mast = com_mast.drop(index=com_mast.index[removed_pos]).reset_index(drop=True)
+
+    # Only drop the Files Processed entries for files that have no lines left.
+    removed_files = pd.Index(removed['From File'].unique()).difference(com_mast['From File'].unique())
+    files_mask = master_files['Filename'].isin(removed_files)
+    files_removed = master_files[files_mask].reset_index(drop=True)
+    master_files = master_files[~files_mask].reset_index(drop=True)
+
+    # Summarize what we removed, by file.
+    summary = removed.assign(**{'Actual Comm Paid': pd.to_numeric(removed['Actual Comm Paid'], errors='coerce')})
+    summary = summary.groupby('From File', sort=True).agg(**{'Lines Removed': ('Actual Comm Paid', 'size'),
+                                                             'Actual Comm Paid': ('Actual Comm Paid', 'sum')})
+    summary['Files Processed Removed'] = summary.index.isin(removed_files)
+    summary = summary.reset_index()
+    logger.info(f'Removing {len(removed):,} lines (${summary['Actual Comm Paid'].sum():,.2f}) from '
+                f'{len(summary)} files for Comm Month {month}. '
+                f'{len(files_removed)} Files Processed entries will be removed.')
+
+    data_dir = Utils.DIRECTORIES.get('COMM_WORKING_DIR')
+    filepath_CM = os.path.join(data_dir, 'Commissions Master.xlsx')
+    filepath_removed = os.path.join(data_dir, f'Removed Data {month}.xlsx')
+    if save_error(filepath_CM, filepath_removed):
+        logger.error('The Commissions Master and/or Removed Data file is currently open in Excel! '
+                     'Please close the files and try again.\n*Program Terminated*')
         return
-    # Convert applicable columns to numeric.
-    for col in numCols:
-        try:
-            comMast[col] = pd.to_numeric(comMast[col],
-                                         errors='coerce').fillna(0)
-        except KeyError:
-            pass
-    for col in mixedCols:
-        comMast[col] = comMast[col].map(
-                lambda x: pd.to_numeric(x, errors='ignore'))
-    # Now remove the nans.
-    comMast.replace('nan', '', inplace=True)
-    # Make sure all the dates are formatted correctly.
-    for col in ['Invoice Date', 'Paid Date', 'Sales Report Date']:
-        comMast[col] = comMast[col].map(lambda x: form_date(x))
-    # Make sure that the CM Splits aren't blank or zero.
-    comMast['CM Split'] = comMast['CM Split'].replace(['', '0', 0], 20)
 
-    # -----------------------------------------------------
-    # Now remove the data that matches the provided month.
-    # -----------------------------------------------------
+    # Back up the Commissions Master before overwriting it.
+    snapshot_file(filepath_CM)
 
+    save_excel_file(filename=filepath_removed, tab_data=[summary, removed, files_removed],
+                    tab_names=['Summary', 'Removed Lines', 'Files Processed'])
+    with pd.ExcelWriter(filepath_CM, engine='xlsxwriter', datetime_format='mm/dd/yyyy') as writer:
+        tab_save_prep(writer=writer, data=com_mast, sheet_name='Master')
+        tab_save_prep(writer=writer, data=master_files, sheet_name='Files Processed')
+    logger.info(f'Comm Month {month} removed from the Commissions Master. '
+                f'Removed lines saved in: {filepath_removed}')
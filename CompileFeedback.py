@@ -1,9 +1,11 @@
 import pandas as pd
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from RCExcelTools import save_error
-from FileIO import load_salespeople_info, load_root_customer_mappings, load_acct_list, load_digikey_master
-from xlrd import XLRDError
+from FileIO import (load_salespeople_info, load_root_customer_mappings, load_acct_list, load_digikey_master,
+                    save_excel_files)
+from DigikeyMasterStore import DigikeyMasterStore, EXPORT_NAME
 
 # Set the directory for the data input/output.
 if os.path.exists('Z:\\'):
@@ -13,6 +15,9 @@ else:
     data_dir = os.getcwd()
     look_dir = os.getcwd()
 
+# Most of the time is spent waiting on the network drive, so read a few feedback files at once.
+FEEDBACK_READ_WORKERS = 8
+
 
 def table_format(sheet_data, sheet_name, workbook):
     """Formats the Excel output as a table with correct column formatting."""
@@ -55,6 +60,112 @@ def table_format(sheet_data, sheet_name, workbook):
     sheet.autofilter(0, 0, sheet_data.shape[0], sheet_data.shape[1]-1)
 
 
+def write_tab(writer, data, sheet_name):
+    """Write a tab and format it as a table."""
+    data.to_excel(writer, sheet_name=sheet_name, index=False)
+    table_format(data, sheet_name, writer)
+
+
+def read_feedback_file(filepath, initials):
+    """Read in one salesperson's feedback file, keeping only their own lines."""
+    sheet = pd.read_excel(filepath)
+    return sheet[sheet['Sales'] == initials]
+
+
+def read_feedback_files(filepaths, initials_list):
+    """Read in the feedback files in parallel, each filtered to the lines of the salesperson it belongs to.
+
+    Returns the data from each file that was read (in order), along with a dictionary of
+    filename --> error for any files that couldn't be read for any reason.
+    """
+    input_data = []
+    read_errors = {}
+    with ThreadPoolExecutor(max_workers=min(FEEDBACK_READ_WORKERS, len(filepaths) or 1)) as executor:
+        futures = [executor.submit(read_feedback_file, i, j) for i, j in zip(filepaths, initials_list)]
+        for filepath, future in zip(filepaths, futures):
+            try:
+                sheet_data = future.result()
+            # A bad file (corrupt, not really a workbook, missing columns...) only skips that file.
+            except Exception as error:
+                read_errors[os.path.basename(filepath)] = error
+                continue
+            print('---\nCopying comments from file: ' + os.path.basename(filepath))
+            input_data.append(sheet_data)
+    return input_data, read_errors
+
+
+def upsert_customer_mappings(customer_mappings, final_data):
+    """Update the rootCustomerMappings with the salespeople assigned in the feedback.
+
+    Existing customers get their salesperson updated and new customers are added. If the same customer
+    is given different salespeople in the feedback, the last one wins and the conflicts are reported.
+    Returns the updated mappings, or None if any of the customers are in the mappings more than once.
+    """
+    cust = final_data['Root Customer..'].fillna('').astype(str).str.lower().str.rstrip()
+    sales = final_data['Sales']
+    indiv = final_data['Root Customer Class'].astype(str).str.lower().str.rstrip() == 'individual'
+    valid = (cust != '') & sales.notna() & (sales != '') & ~indiv
+    updates = pd.DataFrame({'Root Customer': cust[valid], 'Salesperson': sales[valid]})
+    # Report customers that were given conflicting salespeople in this batch.
+    num_sales = updates.groupby('Root Customer')['Salesperson'].nunique()
+    conflicts = num_sales[num_sales > 1].index
+    if len(conflicts) > 0:
+        print('---\nThe following customers were assigned more than one salesperson in the feedback '
+              '(using the last one):\n' + ', '.join(conflicts))
+    updates = updates.drop_duplicates(subset='Root Customer', keep='last')
+    # Look for matches in the existing mappings.
+    mapping_keys = customer_mappings['Root Customer'].astype(str).str.lower()
+    matched_keys = mapping_keys[mapping_keys.isin(updates['Root Customer'])]
+    duplicates = matched_keys[matched_keys.duplicated()].unique()
+    if len(duplicates) > 0:
+        print('There appear to be duplicate customers in rootCustomerMappings:\n'
+              + '\n'.join(duplicates) + '\nPlease trim to one entry each and try again.'
+              '\n*Program Terminated*')
+        return None
+    # Input (possibly new) salespeople for existing customers.
+    new_sales = mapping_keys.map(updates.set_index('Root Customer')['Salesperson'])
+    matched = new_sales.notna()
+    customer_mappings.loc[matched, 'Salesperson'] = new_sales[matched]
+    # New customers (no match) get added to the mappings.
+    new_custs = updates[~updates['Root Customer'].isin(mapping_keys)]
+    return pd.concat([customer_mappings, new_custs], ignore_index=True, sort=False)
+
+
+def refresh_current_sales(digikey_master, acct_list, customer_mappings):
+    """Update the Current Sales of each customer in the Digikey Insight Master.
+
+    The Account List takes priority, then the rootCustomerMappings. Customer names are matched without
+    regard to case or trailing spaces, and only the lines whose salesperson changed are written.
+    This function modifies the Master inplace, and returns a mask of the lines updated.
+    """
+    # Build the customer --> current salesperson lookup, with the Account List entries overriding the mappings.
+    acct_sales = acct_list[['ProperName', 'SLS']].set_axis(['Root Customer', 'Salesperson'], axis=1)
+    current_sales = pd.concat([acct_sales, customer_mappings[['Root Customer', 'Salesperson']]], ignore_index=True)
+    current_sales['Root Customer'] = current_sales['Root Customer'].astype(str).str.lower().str.rstrip()
+    current_sales = current_sales[current_sales['Salesperson'].notna() & (current_sales['Salesperson'] != '')]
+    current_sales = current_sales.drop_duplicates(subset='Root Customer').set_index('Root Customer')['Salesperson']
+    # Apply it to the Master, touching only the lines that changed.
+    cust = digikey_master['Root Customer..'].astype(str).str.lower().str.rstrip()
+    new_sales = cust.map(current_sales)
+    changed = new_sales.notna() & (new_sales != digikey_master['Current Sales'])
+    digikey_master.loc[changed, 'Current Sales'] = new_sales[changed]
+    return changed
+
+
+def export_insight_master():
+    """Write the full Digikey Insight Master out to a single Excel file."""
+    print('Exporting the Digikey Insight Master...')
+    fname = os.path.join(data_dir, EXPORT_NAME)
+    if save_error(fname):
+        print('---\nDigikey Insight Master export is currently open in Excel!\n'
+              'Please close the file and try again.\n*Program Terminated*')
+        return
+    if DigikeyMasterStore().export_excel(fname, format_sheet=table_format):
+        print('---\nDigikey Insight Master exported to:\n' + fname + '\n+Program Complete+')
+    else:
+        print('---\nError loading the Digikey Insight Master!\n*Program Terminated*')
+
+
 # The main function.
 def main(filepaths):
     """Combine files into one finalized monthly Digikey file, and append it
@@ -69,26 +180,26 @@ def main(filepaths):
     sales_info = load_salespeople_info()
     customer_mappings = load_root_customer_mappings()
     acct_list = load_acct_list()
-    digikey_master, files_processed = load_digikey_master()
+    # Make sure the files we're going to save aren't open before doing any work.
+    fname1 = data_dir + '\\Digikey Insight Final ' + time.strftime('%Y-%m-%d') + '.xlsx'
+    fname3 = look_dir + '\\rootCustomerMappings.xlsx'
+    if save_error(fname1, fname3):
+        print('---\nInsight Final or rootCustomerMapings is currently open in Excel!\n'
+              'Please close the file(s) and try again.\n*Program Terminated*')
+        return
+
+    store = DigikeyMasterStore()
+    digikey_master, files_processed = load_digikey_master(store)
 
     if any([sales_info.empty, customer_mappings.empty, acct_list.empty, digikey_master.empty]):
         print('*Program Terminated*')
         return
 
-    # ------------------------
-    # Load the Insight files.
-    # ------------------------
+    # ---------------------------------------------
+    # Check the salesperson initials on each file.
+    # ---------------------------------------------
     # Strip the root off of the filepaths and leave just the filenames.
     filenames = [os.path.basename(i) for i in filepaths]
-    try:
-        input_data = [pd.read_excel(i) for i in filepaths]
-    except XLRDError:
-        print('---\nError reading in files!\n*Program Terminated*')
-        return
-
-    # -----------------------------------------------
-    # Combine the report data from each salesperson.
-    # -----------------------------------------------
     # Make sure each filename has a salesperson initials.
     salespeople = sales_info['Sales Initials'].values
     initials_list = []
@@ -105,19 +216,19 @@ def main(filepaths):
                   '*Program Terminated*')
             return
         initials_list.append(initials)
-    # Create the master dataframe to append to.
-    final_data = pd.DataFrame(columns=digikey_master.columns)
-    # Copy over the comments.
-    file_num = 0
-    for sheet in input_data:
-        print('---\nCopying comments from file: ' + filenames[file_num])
-        # Grab only the salesperson's data.
-        sales = filenames[file_num][0:2]
-        sheet_data = sheet[sheet['Sales'] == sales]
-        # Append data to the output dataframe.
-        final_data = final_data.append(sheet_data, ignore_index=True, sort=False)
-        # Next file.
-        file_num += 1
+
+    # -----------------------------------------------------------------------
+    # Load the Insight files and combine the report data from each salesperson.
+    # -----------------------------------------------------------------------
+    input_data, read_errors = read_feedback_files(filepaths, initials_list)
+    for filename, error in read_errors.items():
+        print('---\nError reading in file: ' + filename + '\n' + str(error) + '\nSkipping this file.')
+    if not input_data:
+        print('---\nNo feedback files could be read!\n*Program Terminated*')
+        return
+    # Create the master dataframe with the comments from each file.
+    final_data = pd.concat([pd.DataFrame(columns=digikey_master.columns)] + input_data,
+                           ignore_index=True, sort=False)
     # Drop any unnamed columns that got processed.
     try:
         final_data = final_data.loc[:, ~final_data.columns.str.contains('^Unnamed')]
@@ -128,89 +239,43 @@ def main(filepaths):
     # --------------------------------------
     # Update the rootCustomerMappings file.
     # --------------------------------------
-    for row in final_data.index:
-        # Get root customer and salesperson.
-        cust = str(final_data.loc[row, 'Root Customer..']).lower().rstrip()
-        salesperson = final_data.loc[row, 'Sales']
-        try:
-            indiv = final_data.loc[row, 'Root Customer Class'].lower().rstrip() == 'individual'
-        except AttributeError:
-            indiv = False
-        if cust and salesperson and not indiv:
-            # Find match in rootCustomerMappings.
-            cust_match = customer_mappings['Root Customer'].astype(str).str.lower() == cust
-            if sum(cust_match) == 1:
-                match_id = customer_mappings[cust_match].index
-                # Input (possibly new) salesperson.
-                customer_mappings.loc[match_id, 'Salesperson'] = salesperson
-            elif not cust_match.any():
-                # New customer (no match), so append to mappings.
-                new_cust = pd.DataFrame({'Root Customer': [cust], 'Salesperson': [salesperson]})
-                customer_mappings = customer_mappings.append(new_cust, ignore_index=True, sort=False)
-            else:
-                print('There appears to be a duplicate customer in rootCustomerMappings:\n'
-                      + str(cust) + '\nPlease trim to one entry and try again.'
-                      + '\n*Program Terminated*')
-                return
+    customer_mappings = upsert_customer_mappings(customer_mappings, final_data)
+    if customer_mappings is None:
+        return
 
     # ----------------------------------------------------------------------------------------
     # Append the new data to the Digikey Insight Master, then update the Current Salesperson.
     # ----------------------------------------------------------------------------------------
     master_cols = list(digikey_master)
     master_cols.remove('Current Sales')
-    digikey_master = digikey_master.append(final_data[master_cols], ignore_index=True, sort=False)
+    # The new data goes in the partition for the month it's from.
+    digikey_master = store.append(digikey_master, final_data[master_cols])
     digikey_master.fillna('', inplace=True)
     final_data.fillna('', inplace=True)
-    # Go through each root customer and update current salesperson.
-    for cust in digikey_master['Root Customer..'].unique():
-        current_sales = ''
-        # First check the Account List.
-        acct_match = acct_list[acct_list['ProperName'] == cust]
-        if not acct_match.empty:
-            current_sales = acct_match['SLS'].iloc[0]
-        # Next try rootCustomerMappings.
-        map_match = customer_mappings[customer_mappings['Root Customer'] == cust]
-        if acct_match.empty and not map_match.empty:
-            try:
-                current_sales = map_match['Current Sales'].iloc[0]
-            except KeyError:
-                pass
-        # Update current salesperson, if a new one is found.
-        if current_sales:
-            match_id = digikey_master[digikey_master['Root Customer..'] == cust].index
-            digikey_master.loc[match_id, 'Current Sales'] = current_sales
+    changed_rows = refresh_current_sales(digikey_master, acct_list, customer_mappings)
 
     # ---------------------------------------------------------------------
     # Try saving the files, exit with error if any file is currently open.
     # ---------------------------------------------------------------------
-    fname1 = data_dir + '\\Digikey Insight Final ' + time.strftime('%Y-%m-%d') + '.xlsx'
     # Append the new file to files processed.
-    new_file = pd.DataFrame(columns=files_processed.columns)
-    new_file.loc[0, 'Filename'] = fname1
-    files_processed = files_processed.append(new_file, ignore_index=True, sort=False)
-    fname2 = data_dir + '\\Digikey Insight Master.xlsx'
-    fname3 = look_dir + '\\rootCustomerMappings.xlsx'
-    if save_error(fname1, fname2, fname3):
-        print('---\nInsight Master, Insight Final, or rootCustomerMapings is currently open in Excel!\n'
+    files_processed = pd.concat([files_processed, pd.DataFrame({'Filename': [fname1]})], ignore_index=True, sort=False)
+    if save_error(fname1, fname3):
+        print('---\nInsight Final or rootCustomerMapings is currently open in Excel!\n'
               'Please close the file(s) and try again.\n*Program Terminated*')
         return
-    # Write the finished Insight file.
-    writer1 = pd.ExcelWriter(fname1, engine='xlsxwriter', datetime_format='mm/dd/yyyy')
-    final_data.to_excel(writer1, sheet_name='Master', index=False)
-    table_format(final_data, 'Master', writer1)
-    # Write the Insight Master file.
-    writer2 = pd.ExcelWriter(fname2, engine='xlsxwriter', datetime_format='mm/dd/yyyy')
-    digikey_master.to_excel(writer2, sheet_name='Master', index=False)
-    files_processed.to_excel(writer2, sheet_name='Files Processed', index=False)
-    table_format(digikey_master, 'Master', writer2)
-    table_format(files_processed, 'Files Processed', writer2)
-    # Write the new rootCustomerMappings file.
-    writer3 = pd.ExcelWriter(fname3, engine='xlsxwriter', datetime_format='mm/dd/yyyy')
-    customer_mappings.to_excel(writer3, sheet_name='Sales Lookup', index=False)
-    table_format(customer_mappings, 'Sales Lookup', writer3)
-    # Save the files.
-    writer1.save()
-    writer2.save()
-    writer3.save()
+    # Write the new and updated partitions of the Insight Master first, keeping the old ones until the
+    # Insight Final and rootCustomerMappings are saved too, so that either everything is updated or nothing is.
+    try:
+        store.save(digikey_master, files_processed, changed_rows, keep_backups=True)
+    except OSError as error:
+        print('---\nError saving the Digikey Insight Master: ' + str(error) + '\n'
+              'No files were changed.\n*Program Terminated*')
+        return
+    files = {fname1: (final_data, 'Master'), fname3: (customer_mappings, 'Sales Lookup')}
+    if not save_excel_files(files, write_tab=write_tab):
+        store.restore()
+        print('---\nError saving files! No files were changed.\n*Program Terminated*')
+        return
+    store.finish_save()
     print('---\nUpdates completed successfully!\n---\nDigikey Master updated.\n'
           'rootCustomerMappings updated.\n+Program Complete+')
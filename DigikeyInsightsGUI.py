@@ -80,6 +80,13 @@ class GenMast(QMainWindow):
         self.btn_compile_feedback.setToolTip('Combine individual reports with feedback into one file, '
                                              'and append that file to Digikey Insight Master.')
 
+        # Button for exporting the full Insight Master to Excel.
+        self.btn_export_master = QPushButton('Export \n Insight Master', self)
+        self.btn_export_master.move(650, 30)
+        self.btn_export_master.resize(150, 100)
+        self.btn_export_master.clicked.connect(self.export_master_clicked)
+        self.btn_export_master.setToolTip('Write the full Digikey Insight Master out to a single Excel file.')
+
         # Button for clearing selections.
         self.btn_clear_all = QPushButton('Clear \n File Selections', self)
         self.btn_clear_all.move(450, 30)
@@ -87,11 +94,11 @@ class GenMast(QMainWindow):
         self.btn_clear_all.clicked.connect(self.clear_all_clicked)
 
         # Button for selecting new file to lookup salespeople.
-        self.btn_open_insight = QPushButton('Select New \n Digikey Insight \n File', self)
+        self.btn_open_insight = QPushButton('Select New \n Digikey Insight \n Files', self)
         self.btn_open_insight.move(50, 30)
         self.btn_open_insight.resize(150, 100)
         self.btn_open_insight.clicked.connect(self.open_insight_clicked)
-        self.btn_open_insight.setToolTip('Select a brand new Digikey LI file.')
+        self.btn_open_insight.setToolTip('Select one or more brand new Digikey LI files.')
 
         # Button for selecting files to append to master.
         self.btn_open_finished = QPushButton('Select Files \n with Feedback', self)
@@ -129,6 +136,13 @@ class GenMast(QMainWindow):
         if self.threadpool.activeThreadCount() == 0:
             self.threadpool.start(worker)
 
+    def export_master_clicked(self):
+        """Send the Insight Master export to a worker thread."""
+        self.lock_buttons()
+        worker = Worker(self.export_master_execute)
+        if self.threadpool.activeThreadCount() == 0:
+            self.threadpool.start(worker)
+
     def clear_all_clicked(self):
         """Clear the filename variables."""
         self.filenames = []
@@ -153,6 +167,14 @@ class GenMast(QMainWindow):
                   'Use the Select Commission Files button to select files.\n---')
         self.restore_buttons()
 
+    def export_master_execute(self):
+        """Runs function for exporting the Insight Master."""
+        try:
+            CompileFeedback.export_insight_master()
+        except Exception as error:
+            print('Unexpected Python error:\n' + str(error) + '\nPlease contact your local coder.')
+        self.restore_buttons()
+
     def look_sales_execute(self):
         """Runs function for looking up salespeople."""
         # Check to see if we're ready to process.
@@ -160,7 +182,10 @@ class GenMast(QMainWindow):
         if self.filename and map_exists:
             # Run the GenerateMaster.py file.
             try:
-                LookupSales.main(self.filename)
+                if len(self.filename) == 1:
+                    LookupSales.main(self.filename[0])
+                else:
+                    LookupSales.main_batch(self.filename)
             except Exception as error:
                 print('Unexpected Python error:\n' + str(error) + '\nPlease contact your local coder.')
             # Clear file.
@@ -180,16 +205,20 @@ class GenMast(QMainWindow):
             print('Selecting new file, old selection cleared...')
 
         # Grab the filenames to be passed into LookupSales.
-        self.filename, _ = QFileDialog.getOpenFileName(self, filter="Excel files (*.xls *.xlsx *.xlsm)")
+        self.filename, _ = QFileDialog.getOpenFileNames(self, filter="Excel files (*.xls *.xlsx *.xlsm)")
 
         # Check if the current master got uploaded as a new file.
-        if 'Digikey Insight Master' in self.filename:
+        if any('Digikey Insight Master' in name for name in self.filename):
             print('Master uploaded as new file.\nTry uploading files again.\n---')
+            self.filename = []
             return
 
         # Print out the selected filenames.
         if self.filename:
-            print('File selected: ' + self.filename + '\n---')
+            print('Files selected:')
+            for file in self.filename:
+                print(file)
+            print('---')
             # Turn off/on the correct buttons.
             self.btn_compile_feedback.setEnabled(False)
             self.btn_lookup_sales.setEnabled(True)
@@ -224,6 +253,7 @@ class GenMast(QMainWindow):
         self.btn_lookup_sales.setEnabled(False)
         self.btn_open_finished.setEnabled(False)
         self.btn_clear_all.setEnabled(False)
+        self.btn_export_master.setEnabled(False)
         self.btn_compile_feedback.setEnabled(False)
 
     def restore_buttons(self):
@@ -231,6 +261,7 @@ class GenMast(QMainWindow):
         self.btn_lookup_sales.setEnabled(True)
         self.btn_open_finished.setEnabled(True)
         self.btn_clear_all.setEnabled(True)
+        self.btn_export_master.setEnabled(True)
         self.btn_compile_feedback.setEnabled(True)
 
 
@@ -0,0 +1,278 @@
+import os
+import json
+import pickle
+import logging
+import numpy as np
+import pandas as pd
+from uuid import uuid4
+from xlrd import XLRDError
+from GenerateMasterUtils import DIRECTORIES
+
+logger = logging.getLogger(__name__)
+
+# The partitioned master lives in this folder in the Digikey directory.
+MASTER_STORE_DIR_NAME = 'Digikey Insight Master'
+MANIFEST_NAME = 'manifest.json'
+# The old single-file master, which gets migrated into the legacy partition.
+LEGACY_MASTER_NAME = 'Digikey Insight Master.xlsx'
+LEGACY_PARTITION = 'legacy'
+# Once migrated, the old master is renamed so that nothing keeps reading it as if it were current.
+MIGRATED_LEGACY_NAME = 'Digikey Insight Master (migrated).xlsx'
+# Full exports go to their own file, so the old master is never overwritten.
+EXPORT_NAME = 'Digikey Insight Master Export.xlsx'
+# Columns used (in order) to work out which month a batch of Insight data belongs to.
+PARTITION_DATE_COLUMNS = ['DKLI Report Date', 'Invoice Date']
+
+
+class DigikeyMasterStore:
+    """
+    The Digikey Insight Master, stored as one pickle per monthly partition plus a manifest.
+
+    The manifest keeps the partitions in order along with the files processed, which stands in for
+    the Files Processed sheet of the old Excel master. If there's no store yet, the Excel master is
+    loaded instead and gets migrated into the legacy partition the first time the store is saved,
+    after which the Excel master is renamed to MIGRATED_LEGACY_NAME.
+    """
+
+    def __init__(self, location=None):
+        self.location = location or DIRECTORIES.get('DIGIKEY_DIR')
+        self.store_dir = os.path.join(self.location, MASTER_STORE_DIR_NAME)
+        self.manifest = {'partitions': {}, 'files_processed': {'columns': ['Filename'], 'data': []}}
+        # The partition of each row in the loaded master, and the partitions that need to be written.
+        self.row_partitions = pd.Series([], dtype=object)
+        self.unsaved = set()
+        # Set when the loaded master came from the old Excel master.
+        self.migrating = False
+        # Files replaced by a save that can still be undone, as {path: backup path (None if new)}.
+        self.backups = {}
+        self.previous_state = None
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.store_dir, MANIFEST_NAME)
+
+    def exists(self):
+        """Return True if the partitioned master has been created."""
+        return os.path.exists(self.manifest_path)
+
+    def partition_path(self, partition):
+        return os.path.join(self.store_dir, f'{partition}.pkl')
+
+    def load(self):
+        """Load the full master and the files processed. Return empty Series if there's an error."""
+        digikey_master = pd.Series([])
+        files_processed = pd.Series([])
+        if self.exists():
+            with open(self.manifest_path, 'r') as file:
+                self.manifest = json.load(file)
+            partitions = list(self.manifest['partitions'])
+            try:
+                frames = [pd.read_pickle(self.partition_path(i)) for i in partitions]
+            except FileNotFoundError as error:
+                logger.error(f'Digikey Insight Master partition missing: {error.filename}')
+                return digikey_master, files_processed
+            except (pickle.UnpicklingError, EOFError) as error:
+                logger.error(f'Digikey Insight Master partition is unreadable (possibly truncated): {error}')
+                return digikey_master, files_processed
+            self.unsaved = set()
+            self.migrating = False
+        else:
+            try:
+                sheets = pd.read_excel(os.path.join(self.location, LEGACY_MASTER_NAME),
+                                       sheet_name=['Master', 'Files Processed'])
+            except FileNotFoundError:
+                logger.error('No Digikey Insight Master file found! '
+                             'Please make sure Digikey Insight Master is in the directory.')
+                return digikey_master, files_processed
+            except (ValueError, XLRDError):
+                logger.error('Error reading sheet names.')
+                return digikey_master, files_processed
+            partitions = [LEGACY_PARTITION]
+            frames = [sheets['Master'].fillna('')]
+            legacy_files = sheets['Files Processed'].fillna('').astype(str)
+            self.manifest = {'partitions': {LEGACY_PARTITION: len(frames[0])},
+                             'files_processed': {'columns': list(legacy_files),
+                                                 'data': legacy_files.values.tolist()}}
+            self.unsaved = {LEGACY_PARTITION}
+            self.migrating = True
+        digikey_master = pd.concat(frames, ignore_index=True, sort=False)
+        self.row_partitions = pd.Series(np.repeat(partitions, [len(i) for i in frames]), dtype=object)
+        files_processed = pd.DataFrame(self.manifest['files_processed']['data'],
+                                       columns=self.manifest['files_processed']['columns'])
+        return digikey_master, files_processed
+
+    @staticmethod
+    def data_partition(new_data):
+        """
+        Name the partition for a batch of data after the month (YYYY-MM) most of its dates fall in.
+
+        Returns None if the data has no usable dates.
+        """
+        for col in PARTITION_DATE_COLUMNS:
+            if col in new_data:
+                dates = pd.to_datetime(new_data[col], errors='coerce', format='mixed').dropna()
+                if not dates.empty:
+                    return dates.dt.strftime('%Y-%m').mode().iloc[0]
+        return None
+
+    def append(self, digikey_master, new_data, partition=None):
+        """
+        Add new data to the end of the loaded master under the given partition.
+
+        By default the partition is the month of the data (see data_partition), falling back to the
+        current month if the data has no dates. Nothing is written until save is called. Returns the
+        combined master.
+        """
+        if partition is None:
+            partition = self.data_partition(new_data)
+            if partition is None:
+                partition = pd.Timestamp.today().strftime('%Y-%m')
+                logger.warning(f'No dates found in the new data; adding it to the {partition} partition.')
+        self.row_partitions = pd.concat([self.row_partitions, pd.Series([partition] * len(new_data), dtype=object)],
+                                        ignore_index=True)
+        self.unsaved.add(partition)
+        return pd.concat([digikey_master, new_data], ignore_index=True, sort=False)
+
+    def save(self, digikey_master, files_processed, changed_rows=None, keep_backups=False):
+        """
+        Write the new partitions, plus any partitions with changed rows, then the manifest.
+
+        Everything is written to temporary files first and then moved into place, manifest last. If
+        any file can't be written or moved, the files already replaced are put back, so the store is
+        left as it was, and the error is raised.
+
+        Arguments:
+        digikey_master -- The full master, in the same row order it was loaded/appended in.
+        files_processed -- The files processed, which gets written to the manifest.
+        changed_rows -- Boolean mask of the rows that were updated since loading.
+        keep_backups -- Keep the replaced files, so that the save can be undone with restore (for
+                        saving alongside other files). Call finish_save once the save is final.
+
+        Returns the list of partitions that were written.
+        """
+        affected = set(self.unsaved)
+        if changed_rows is not None:
+            affected.update(self.row_partitions[np.asarray(changed_rows, dtype=bool)].unique())
+        os.makedirs(self.store_dir, exist_ok=True)
+        # Keep the existing partition order, with new partitions going on the end.
+        order = list(self.manifest['partitions']) + [i for i in self.row_partitions.unique()
+                                                     if i not in self.manifest['partitions']]
+        partitions = {}
+        temp_paths = {}
+        try:
+            for partition in order:
+                rows = (self.row_partitions == partition).to_numpy()
+                if partition in affected:
+                    temp_path = f'{self.partition_path(partition)}.{uuid4().hex}.tmp'
+                    temp_paths[self.partition_path(partition)] = temp_path
+                    digikey_master[rows].reset_index(drop=True).to_pickle(temp_path)
+                partitions[partition] = int(rows.sum())
+            files_processed = files_processed.fillna('').astype(str)
+            manifest = {'partitions': partitions,
+                        'files_processed': {'columns': list(files_processed),
+                                            'data': files_processed.values.tolist()}}
+            # The manifest goes in last, so an interrupted save leaves the old master intact.
+            temp_path = f'{self.manifest_path}.{uuid4().hex}.tmp'
+            temp_paths[self.manifest_path] = temp_path
+            with open(temp_path, 'w') as file:
+                json.dump(manifest, file, indent=1)
+            self.backups = self.replace_files(temp_paths)
+        finally:
+            for temp_path in temp_paths.values():
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        self.previous_state = (self.manifest, self.unsaved)
+        self.manifest = manifest
+        self.unsaved = set()
+        written = [i for i in order if i in affected]
+        logger.info(f'Digikey Insight Master partitions written: {', '.join(written)}')
+        if not keep_backups:
+            self.finish_save()
+        return written
+
+    @staticmethod
+    def replace_files(temp_paths):
+        """
+        Move each temporary file over its destination, keeping the old files as backups.
+
+        If a move fails, the old files are put back and the error is raised. Returns the backups as
+        {path: backup path}, where the backup path is None for files that didn't exist before.
+        """
+        backups = {}
+        try:
+            for path, temp_path in temp_paths.items():
+                if os.path.exists(path):
+                    backups[path] = f'{temp_path}.old'
+                    os.replace(path, backups[path])
+                else:
+                    backups[path] = None
+                os.replace(temp_path, path)
+        except OSError:
+            DigikeyMasterStore.restore_files(backups)
+            raise
+        return backups
+
+    @staticmethod
+    def restore_files(backups):
+        """Put back the files replaced by replace_files, and remove any that were new."""
+        for path, backup_path in backups.items():
+            if backup_path and os.path.exists(backup_path):
+                os.replace(backup_path, path)
+            elif not backup_path and os.path.exists(path):
+                os.remove(path)
+
+    def restore(self):
+        """Undo a save made with keep_backups, putting the old partitions and manifest back."""
+        if self.previous_state is None:
+            return
+        self.restore_files(self.backups)
+        self.manifest, self.unsaved = self.previous_state
+        self.backups = {}
+        self.previous_state = None
+        logger.info('Digikey Insight Master save undone; the previous partitions were restored.')
+
+    def finish_save(self):
+        """
+        Make the last save final by removing its backups.
+
+        If that save migrated the old Excel master, the Excel master is renamed so that it can't be
+        mistaken for the current one (it's no longer updated; use export_excel for a current copy).
+        """
+        for backup_path in self.backups.values():
+            if backup_path and os.path.exists(backup_path):
+                os.remove(backup_path)
+        self.backups = {}
+        self.previous_state = None
+        if not self.migrating:
+            return
+        self.migrating = False
+        legacy_path = os.path.join(self.location, LEGACY_MASTER_NAME)
+        try:
+            os.replace(legacy_path, os.path.join(self.location, MIGRATED_LEGACY_NAME))
+        except OSError as error:
+            logger.warning(f'{LEGACY_MASTER_NAME} was migrated into {MASTER_STORE_DIR_NAME} but could not be renamed '
+                           f'({error}). It is no longer updated, so please do not use it; export the master instead.')
+            return
+        logger.warning(f'{LEGACY_MASTER_NAME} was migrated into {MASTER_STORE_DIR_NAME} and renamed to '
+                       f'{MIGRATED_LEGACY_NAME}, since it is no longer updated. Export the master for a current copy.')
+
+    def export_excel(self, file_path=None, format_sheet=None):
+        """
+        Write the full master to a single Excel file, with Master and Files Processed tabs.
+
+        Arguments:
+        file_path -- Where to save the file (defaults to EXPORT_NAME in the Digikey directory).
+        format_sheet -- Optional function(sheet_data, sheet_name, workbook) for formatting each tab.
+
+        Returns the file path, or None if the master couldn't be loaded.
+        """
+        digikey_master, files_processed = self.load()
+        if digikey_master.empty:
+            return None
+        file_path = file_path or os.path.join(self.location, EXPORT_NAME)
+        with pd.ExcelWriter(file_path, engine='xlsxwriter', datetime_format='mm/dd/yyyy') as writer:
+            for sheet_data, sheet_name in zip([digikey_master, files_processed], ['Master', 'Files Processed']):
+                sheet_data.to_excel(writer, sheet_name=sheet_name, index=False)
+                if format_sheet:
+                    format_sheet(sheet_data, sheet_name, writer)
+        return file_path
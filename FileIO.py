@@ -1,15 +1,20 @@
 import os
 import pandas as pd
 import numpy as np
-import datetime
-import shutil
 import logging
+import openpyxl
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
 import GenerateMasterUtils as Utils
 from xlrd import XLRDError
-from RCExcelTools import form_date, save_error, table_format
+from RCExcelTools import form_date, save_error, write_sheet, CONSTANT_MEMORY_MIN_ROWS
+from DigikeyMasterStore import DigikeyMasterStore
 
 logger = logging.getLogger(__name__)
 
+# Number of rows per chunk when streaming in the Commissions Master.
+COM_MASTER_CHUNK_SIZE = 50000
+
 
 def load_salespeople_info():
     """Read in Salespeople Info. Return empty series if not found or if there's an error."""
@@ -37,6 +42,14 @@ def load_salespeople_info():
     return sales_info
 
 
+def load_territory_index():
+    """Load the Salespeople Info and index its territory cities. Return None if there's an error."""
+    sales_info = load_salespeople_info()
+    if sales_info.empty:
+        return None
+    return Utils.TerritoryIndex(sales_info)
+
+
 def load_principal_info():
     """Load the Principal Info file."""
     principal_info = pd.Series([])
@@ -52,47 +65,232 @@ def load_principal_info():
     return principal_info
 
 
-def load_com_master():
-    """Load and prepare the Commissions Master file. Return empty series if not found."""
+# Columns that stay as text no matter what: invoice/part numbers sometimes have leading zeros we'd
+# like to keep, and the INF gets read in as infinity.
+TEXT_COLUMNS = ['Invoice Number', 'Part Number', 'Principal']
+
+
+class ComMasterProfile:
+    """
+    Column-wide facts about the Commissions Master, gathered from every row as the sheet is streamed.
+
+    Whether a column is numeric, whether its numbers are floats (decimals or blanks anywhere make the
+    whole column float), and whether a percentage column is in percent (any value over 1) all depend on
+    the whole column. These get decided here over the full sheet, so the prepared data doesn't depend
+    on how it was chunked or which rows were kept.
+    """
+
+    def __init__(self, columns):
+        self.pct_cols = [i for i in Utils.PERCENTAGE_COLUMNS if i in columns]
+        self.mixed_cols = [i for i in columns if i not in Utils.NUMERICAL_COLUMNS + TEXT_COLUMNS
+                           and i not in Utils.DOLLAR_COLUMNS + Utils.PERCENTAGE_COLUMNS]
+        self.number_cols = [i for i in columns if i in Utils.DOLLAR_COLUMNS + Utils.PERCENTAGE_COLUMNS
+                            + Utils.NUMERICAL_COLUMNS] + self.mixed_cols
+        self.scaled_pct_cols = set()
+        self.text_cols = set()
+        self.float_cols = set()
+
+    def update(self, chunk):
+        """Take a chunk of raw (string) rows into account."""
+        for col in self.pct_cols:
+            if col not in self.scaled_pct_cols:
+                values = pd.to_numeric(chunk[col].str.strip().str.replace('%', ''), errors='coerce')
+                if (values > 1).any():
+                    self.scaled_pct_cols.add(col)
+        for col in self.mixed_cols:
+            if col not in self.text_cols:
+                try:
+                    pd.to_numeric(chunk[col])
+                except (ValueError, TypeError):
+                    self.text_cols.add(col)
+        for col in self.number_cols:
+            if col in self.float_cols or col in self.text_cols:
+                continue
+            values = chunk[col].str.strip()
+            # Dollar and percentage columns leave their blanks alone, the rest turn them into NaN.
+            if col in Utils.DOLLAR_COLUMNS + Utils.PERCENTAGE_COLUMNS:
+                values = values[values != ''].str.replace('$' if col in Utils.DOLLAR_COLUMNS else '%', '',
+                                                          regex=False)
+            if not values.empty and pd.to_numeric(values, errors='coerce').dtype.kind == 'f':
+                self.float_cols.add(col)
+
+
+def prepare_com_master(commission_master, profile=None):
+    """
+    Convert a (string-typed) Commissions Master into its working types.
+
+    If a ComMasterProfile is given, column types and percentage scaling follow it (use this when the
+    data is only some of the rows); otherwise they're decided from the data itself.
+    """
+    if profile is None:
+        profile = ComMasterProfile(list(commission_master))
+        profile.update(commission_master)
+    commission_master = Utils.format_pct_numeric_cols(commission_master, scaled_pct_cols=profile.scaled_pct_cols,
+                                                      float_cols=profile.float_cols)
+
+    # Convert individual numbers to numeric in rest of columns.
+    mixed_cols = [col for col in list(commission_master) if col not in Utils.NUMERICAL_COLUMNS
+                  and col not in TEXT_COLUMNS and col not in profile.text_cols]
+    for col in mixed_cols:
+        commission_master[col] = pd.to_numeric(commission_master[col])
+        if col in profile.float_cols:
+            commission_master[col] = commission_master[col].astype(float)
+
+    # Now remove the nans.
+    commission_master.replace(to_replace=['nan', np.nan], value='', inplace=True)
+
+    # Make sure all the dates are formatted correctly.
+    for col in ['Invoice Date', 'Paid Date', 'Sales Report Date']:
+        commission_master[col] = commission_master[col].map(lambda x: form_date(x))
+
+    # Make sure that the CM Splits aren't blank or zero.
+    commission_master['CM Split'] = commission_master['CM Split'].replace(['', '0', 0], 20)
+    for col in ['CM Sales', 'Design Sales', 'Principal']:
+        commission_master[col] = commission_master[col].map(lambda x: x.strip().upper())
+    return commission_master
+
+
+def excel_value_to_str(value):
+    """Turn a raw cell value into the string pd.read_excel(dtype=str) would give, with blanks left empty."""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def get_header(row):
+    """Clean up a header row read by openpyxl, naming any blank columns the way pandas does."""
+    return [str(i).strip() if i is not None else f'Unnamed: {num}' for num, i in enumerate(row or ())]
+
+
+def iter_com_master_chunks(workbook, chunk_size=COM_MASTER_CHUNK_SIZE):
+    """
+    Stream the Master tab of an open (read-only) Commissions Master in raw string chunks of up to chunk_size rows.
+
+    The sheet is read row by row, so only one chunk of raw rows is held in memory at a time.
+    At least one (possibly empty) chunk is always yielded.
+    """
+    if 'Master' not in workbook.sheetnames:
+        raise KeyError('Master')
+    rows = workbook['Master'].iter_rows(values_only=True)
+    header = get_header(next(rows, ()))
+    chunk = []
+    chunks_yielded = False
+    for row in rows:
+        # Skip fully blank rows at the end of the sheet.
+        if not any(i is not None for i in row):
+            continue
+        chunk.append([excel_value_to_str(i) for i in row[:len(header)]])
+        if len(chunk) >= chunk_size:
+            yield pd.DataFrame(chunk, columns=header, dtype=object)
+            chunks_yielded = True
+            chunk = []
+    if chunk or not chunks_yielded:
+        yield pd.DataFrame(chunk, columns=header, dtype=object)
+
+
+def read_files_processed(workbook):
+    """Read the Files Processed tab of an open (read-only) Commissions Master."""
+    rows = workbook['Files Processed'].iter_rows(values_only=True)
+    header = get_header(next(rows, ()))
+    data = [row[:len(header)] for row in rows if any(i is not None for i in row)]
+    return pd.DataFrame(data, columns=header).fillna('')
+
+
+def comm_month_key(comm_month):
+    """Turn a normalized Comm Month (YYYY-M) into a sortable (year, month), or None if it isn't one."""
+    try:
+        year, month = comm_month.split('-')
+        return int(year), int(month)
+    except ValueError:
+        return None
+
+
+class RecentLinesFilter:
+    """
+    Keeps the lines in the latest Comm Month's quarter, plus the lines in the most recent few Quarter Shipped.
+
+    Which lines those are isn't known until the whole sheet has been seen, so the chunks are all passed
+    to update before any of them are filtered with apply.
+    """
+
+    def __init__(self, num_quarters):
+        self.num_quarters = num_quarters
+        self.quarters = set()
+        self.last_month = None
+
+    def update(self, chunk):
+        """Take the Comm Months and Quarter Shipped of a chunk into account."""
+        self.quarters.update(chunk['Quarter Shipped'].str.strip().unique())
+        months = [comm_month_key(i) for i in Utils.normalize_comm_months(chunk['Comm Month']).unique()]
+        months = [i for i in months if i is not None]
+        if months:
+            self.last_month = max(months + [self.last_month] if self.last_month else months)
+
+    def cutoffs(self):
+        """The current quarters to keep, and the Comm Months (YYYY-M) in the latest Comm Month's quarter."""
+        quarters = set(sorted(self.quarters)[-self.num_quarters:])
+        comm_months = set()
+        if self.last_month:
+            year, month = self.last_month
+            comm_months = {f'{year}-{i}' for i in range(month - (month - 1) % 3, month + 1)}
+        return quarters, comm_months
+
+    def apply(self, chunk):
+        quarters, comm_months = self.cutoffs()
+        keep = (chunk['Quarter Shipped'].str.strip().isin(quarters)
+                | Utils.normalize_comm_months(chunk['Comm Month']).isin(comm_months))
+        return chunk[keep.to_numpy()]
+
+
+def load_com_master(recent_quarters=None, chunk_size=COM_MASTER_CHUNK_SIZE):
+    """Load and prepare the Commissions Master file. Return empty series if not found.
+
+    If recent_quarters is given, only the lines in the latest Comm Month's quarter and the lines in
+    the most recent recent_quarters Quarter Shipped are kept.
+
+    The Master is streamed through twice: first to decide the column types over the whole sheet (see
+    ComMasterProfile) and which lines to keep, then to prepare each chunk as it's read. Only one chunk
+    of raw rows is held at a time, and the kept lines come out exactly as they would in a full load.
+    """
     commission_master, master_files = pd.Series([]), pd.Series([])
     location = Utils.DIRECTORIES.get('COMM_WORKING_DIR')
     file_path = os.path.join(location, 'Commissions Master.xlsx')
 
-    # Create backup file.
-    today = datetime.datetime.today().strftime('%m-%d-%Y')
-    run_com_backup = file_path.replace('.xlsx', f'_BACKUP_{str(today)}.xlsx')
-    logger.info(f'Saving Commissions Master backup as: {run_com_backup}')
-    shutil.copy(file_path, run_com_backup)
-
     try:
-        commission_master = pd.read_excel(file_path, sheet_name='Master', dtype=str)
-        master_files = pd.read_excel(file_path, sheet_name='Files Processed').fillna('')
-        commission_master = Utils.format_pct_numeric_cols(commission_master)
-
-        # Convert individual numbers to numeric in rest of columns.
-        # Invoice/part numbers sometimes have leading zeros we'd like to keep, and
-        # the INF gets read in as infinity, so remove these.
-        mixed_cols = [col for col in list(commission_master) if col not in Utils.NUMERICAL_COLUMNS
-                      and col not in ['Invoice Number', 'Part Number', 'Principal']]
-        for col in mixed_cols:
-            commission_master[col] = pd.to_numeric(commission_master[col], errors='ignore')
-
-        # Now remove the nans.
-        commission_master.replace(to_replace=['nan', np.nan], value='', inplace=True)
-
-        # Make sure all the dates are formatted correctly.
-        for col in ['Invoice Date', 'Paid Date', 'Sales Report Date']:
-            commission_master[col] = commission_master[col].map(lambda x: form_date(x))
-
-        # Make sure that the CM Splits aren't blank or zero.
-        commission_master['CM Split'] = commission_master['CM Split'].replace(['', '0', 0], 20)
-        for col in ['CM Sales', 'Design Sales', 'Principal']:
-            commission_master[col] = commission_master[col].map(lambda x: x.strip().upper())
+        workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
     except FileNotFoundError:
         logger.error('No Commissions Master file found!')
-    except XLRDError:
-        logger.error('Commissions Master tab names incorrect! '
-                     'Make sure the tabs are named Master and Files Processed.')
+        return commission_master, master_files
+    try:
+        # First pass: the column types, and the cutoffs for the recent lines.
+        profile = None
+        recent = RecentLinesFilter(recent_quarters) if recent_quarters else None
+        for chunk in iter_com_master_chunks(workbook, chunk_size=chunk_size):
+            if profile is None:
+                profile = ComMasterProfile(list(chunk))
+            profile.update(chunk)
+            if recent:
+                recent.update(chunk)
+        # Second pass: prepare the (kept lines of) each chunk as it comes in.
+        prepared = []
+        for chunk in iter_com_master_chunks(workbook, chunk_size=chunk_size):
+            if recent:
+                chunk = recent.apply(chunk).reset_index(drop=True)
+            if not chunk.empty:
+                prepared.append(prepare_com_master(chunk, profile))
+        if not prepared:
+            # No lines, but still give back the Master's columns.
+            prepared.append(prepare_com_master(chunk, profile))
+        commission_master = pd.concat(prepared, ignore_index=True)
+        master_files = read_files_processed(workbook)
+    except (KeyError, ValueError) as error:
+        commission_master, master_files = pd.Series([]), pd.Series([])
+        logger.error(f'Error reading the Commissions Master ({error})! Make sure the tabs are named Master '
+                     'and Files Processed, and the Master has Comm Month and Quarter Shipped columns.')
+    finally:
+        workbook.close()
     return commission_master, master_files
 
 
@@ -222,22 +420,10 @@ def load_root_customer_mappings():
     return customer_mappings
 
 
-def load_digikey_master():
-    """Load and prepare the digikey insights master file."""
-    digikey_master = pd.Series([])
-    files_processed = pd.Series([])
-    location = Utils.DIRECTORIES.get('DIGIKEY_DIR')
-    try:
-        digikey_master = pd.read_excel(os.path.join(location, 'Digikey Insight Master.xlsx'),
-                                       sheet_name='Master').fillna('')
-        files_processed = pd.read_excel(os.path.join(location, 'Digikey Insight Master.xlsx'),
-                                        sheet_name='Files Processed').fillna('')
-    except FileNotFoundError:
-        logger.error('No Digikey Insight Master file found! '
-                     'Please make sure Digikey Insight Master is in the directory.')
-    except XLRDError:
-        logger.error('Error reading sheet names.')
-    return digikey_master, files_processed
+def load_digikey_master(store=None):
+    """Load the Digikey Insight Master and its files processed from the (partitioned) master store."""
+    store = store or DigikeyMasterStore()
+    return store.load()
 
 
 def load_distributor_map():
@@ -270,13 +456,86 @@ def save_excel_file(filename, tab_data, tab_names):
         logger.error(f'The following file is currently open in Excel: {filename}'
                      f'\nPlease close the file and try again.')
         return None
+    return save_excel_files({filename: (tab_data, tab_names)})
+
+
+def write_excel_file(filename, tab_data, tab_names, write_tab=None):
+    """Write the tabs of one Excel file. By default each tab is written and then table formatted."""
     if not isinstance(tab_data, list):
         tab_data = [tab_data]
     if not isinstance(tab_names, list):
         tab_names = [tab_names]
     assert len(tab_data) == len(tab_names), logger.error(f'Mismatch in size of tab data and tab names in {filename}.')
+    # Stream big files out row by row to keep the memory use down.
+    options = {'constant_memory': max(len(i) for i in tab_data) >= CONSTANT_MEMORY_MIN_ROWS}
     # Add each tab to the document.
-    with pd.ExcelWriter(filename, datetime_format='mm/dd/yyyy') as writer:
+    with pd.ExcelWriter(filename, engine='xlsxwriter', datetime_format='mm/dd/yyyy',
+                        engine_kwargs={'options': options}) as writer:
         for data, sheet_name in zip(tab_data, tab_names):
-            data.to_excel(writer, sheet_name=sheet_name, index=False)
-            table_format(sheet_data=data, sheet_name=sheet_name, workbook=writer)
+            if write_tab:
+                write_tab(writer=writer, data=data, sheet_name=sheet_name)
+            else:
+                write_sheet(writer=writer, data=data, sheet_name=sheet_name)
+
+
+def save_excel_files(files, write_tab=None):
+    """
+    Save a set of Excel files together, so that either all of them are updated or none are.
+
+    Every file is written out in parallel to a temporary file next to its destination, then the
+    temporary files are moved into place. If any file fails, the temporary files are removed and any
+    files that were already replaced get put back.
+
+    Arguments:
+    files -- Dictionary of filename --> (tab data, tab names).
+    write_tab -- Optional function(writer, data, sheet_name) for writing each tab (e.g. tab_save_prep).
+
+    Returns True if all the files were saved.
+    """
+    temp_paths = {}
+    for filename in files:
+        root, ext = os.path.splitext(filename)
+        temp_paths[filename] = f'{root}.{uuid4().hex[:8]}.tmp{ext}'
+    # Write all the files out to temporary files first.
+    failed = []
+    with ThreadPoolExecutor(max_workers=len(files) or 1) as executor:
+        futures = {filename: executor.submit(write_excel_file, temp_paths[filename], *tabs, write_tab=write_tab)
+                   for filename, tabs in files.items()}
+        for filename, future in futures.items():
+            try:
+                future.result()
+            except Exception as error:
+                failed.append(filename)
+                logger.error(f'Error writing {os.path.basename(filename)}: {error}')
+    if failed:
+        for temp_path in temp_paths.values():
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        logger.error('No files were saved, since not all of them could be written.')
+        return False
+    # Move the new files into place, keeping the old ones until everything has gone through.
+    replaced = {}
+    try:
+        for filename, temp_path in temp_paths.items():
+            if os.path.exists(filename):
+                backup_path = f'{temp_path}.old'
+                os.replace(filename, backup_path)
+                replaced[filename] = backup_path
+            else:
+                replaced[filename] = None
+            os.replace(temp_path, filename)
+    except OSError as error:
+        logger.error(f'Error saving {os.path.basename(filename)}: {error}\nRestoring the previous files.')
+        for filename, backup_path in replaced.items():
+            if backup_path:
+                os.replace(backup_path, filename)
+            elif os.path.exists(filename):
+                os.remove(filename)
+        for temp_path in temp_paths.values():
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return False
+    for backup_path in replaced.values():
+        if backup_path:
+            os.remove(backup_path)
+    return True
@@ -11,7 +11,7 @@ import logging
 from uuid import uuid4
 import GenerateMasterUtils as Utils
 from FileIO import (load_lookup_master, load_run_com, load_entries_need_fixing, load_principal_info,
-                    load_distributor_map, save_excel_file)
+                    load_distributor_map, load_territory_index, save_excel_files)
 from RCExcelTools import save_error, form_date
 from PrincipalSpecialProcessing import process_by_principal, preprocess_by_principal
 
@@ -37,6 +37,10 @@ def main(filepaths, path_to_running_com, field_mappings):
                      file data columns.
     """
     logger.info('Starting program: Generate Master')
+    # Make sure the Lookup Master isn't open before doing any work, since it gets saved at the end.
+    if save_error(os.path.join(Utils.DIRECTORIES.get('COMM_LOOKUPS_DIR'), 'Lookup Master - Current.xlsx')):
+        logger.error('Please close the Lookup Master and try again.\n*Program Terminated*')
+        return
     # Get the correct column names for the commission file.
     column_names = Utils.get_column_names(field_mappings)
 
@@ -98,6 +102,9 @@ def main(filepaths, path_to_running_com, field_mappings):
         logger.error('Error loading supporting files.\n*Program terminated*')
         return
     principal_list = principal_info['Abbreviation'].to_list()
+    # The territory index is only used to sanity check OOT cities, so carry on without it if it fails to load.
+    territory = load_territory_index()
+    oot_in_territory = []
 
     # -------------------------------------------------------------------------
     # Done loading in the data and supporting files, now go to work.
@@ -281,6 +288,11 @@ def main(filepaths, path_to_running_com, field_mappings):
                 # Update OOT city if not already filled in.
                 if full_match['T-Name'][0:3] == 'OOT' and not full_match['City']:
                     master_lookup.loc[full_match['index'], 'City'] = running_com.loc[row, 'City']
+                    # Flag out-of-territory customers that are actually in one of our territory cities.
+                    territory_sales = territory.lookup(running_com.loc[row, 'City']) if territory else None
+                    if territory_sales:
+                        oot_in_territory.append(f'{full_match['T-Name']} ({running_com.loc[row, 'City']}, '
+                                                f'{territory_sales})')
             # If we found multiple matches, then fill in all the options and let the user fix later.
             elif lookup_matches > 1:
                 lookup_cols = ['CM Sales', 'Design Sales', 'T-Name', 'CM', 'T-End Cust', 'CM Split']
@@ -355,6 +367,10 @@ def main(filepaths, path_to_running_com, field_mappings):
         if (row - running_com_input_len) % 100 == 0 and row > running_com_input_len:
             logger.info(f'Done with row {'{:,.0f}'.format(row - running_com_input_len)}')
 
+    if oot_in_territory:
+        logger.warning('The following OOT customers are in cities that belong to a salesperson\'s territory: '
+                       f'{', '.join(sorted(set(oot_in_territory)))}')
+
     # -----------------------------
     # Clean up the finalized data.
     # -----------------------------
@@ -386,8 +402,8 @@ def main(filepaths, path_to_running_com, field_mappings):
                      'Please close the files and try again.\n*Program Teminated*')
         return
 
-    save_excel_file(filename=filepath_RC, tab_data=[running_com, files_processed],
-                    tab_names=['Master', 'Files Processed'])
-    save_excel_file(filename=filepath_ENF, tab_data=entries_need_fixing, tab_names='Data')
-    save_excel_file(filename=filepath_LM, tab_data=master_lookup, tab_names='Lookup')
+    if not save_excel_files({filepath_RC: ([running_com, files_processed], ['Master', 'Files Processed']),
+                             filepath_ENF: (entries_need_fixing, 'Data'),
+                             filepath_LM: (master_lookup, 'Lookup')}):
+        return
     return True
@@ -1,7 +1,10 @@
 import os
 import pandas as pd
+import numpy as np
 import datetime
 import logging
+from functools import lru_cache
+from collections import Counter
 from dateutil.parser import parse
 
 logger = logging.getLogger(__name__)
@@ -74,15 +77,23 @@ def check_for_date_errors(date):
     return False
 
 
-def format_pct_numeric_cols(dataframe):
-    """Convert know numeric and percentage columns to their correct form."""
+def format_pct_numeric_cols(dataframe, scaled_pct_cols=None, float_cols=()):
+    """
+    Convert know numeric and percentage columns to their correct form.
+
+    Percentage columns with any value over 1 are taken to be in percent and divided by 100. If
+    scaled_pct_cols is given, exactly those columns are divided instead (for when the data is only
+    part of a file, and the decision was made over the whole column). Likewise, the numbers in any
+    float_cols are always made floats, even if this part of the column only has whole numbers.
+    """
     for col in DOLLAR_COLUMNS:
         try:
             # Remove extra whitespace and any dollar signs, then convert non-empty entries to numeric.
             dataframe[col] = dataframe[col].map(lambda x: str(x).strip().replace('$', ''))
             non_empty_idx = dataframe[dataframe[col] != ''].index
             # Columns with partially numeric data will end up mixed type (i.e. Object col type).
-            dataframe.loc[non_empty_idx, col] = pd.to_numeric(dataframe.loc[non_empty_idx, col])
+            numbers = pd.to_numeric(dataframe.loc[non_empty_idx, col])
+            dataframe.loc[non_empty_idx, col] = numbers.astype(float) if col in float_cols else numbers
         except KeyError:
             pass
         except ValueError:
@@ -94,7 +105,8 @@ def format_pct_numeric_cols(dataframe):
             # Remove extra whitespace.
             dataframe[col] = dataframe[col].map(lambda x: str(x).strip())
             non_empty_idx = dataframe[dataframe[col] != ''].index
-            dataframe.loc[non_empty_idx, col] = pd.to_numeric(dataframe.loc[non_empty_idx, col])
+            numbers = pd.to_numeric(dataframe.loc[non_empty_idx, col])
+            dataframe.loc[non_empty_idx, col] = numbers.astype(float) if col in float_cols else numbers
             # Columns with partially numeric data will end up mixed type (i.e. Object col type).
             dataframe[col] = pd.to_numeric(dataframe[col], errors='coerce').fillna('')
         except KeyError:
@@ -109,9 +121,14 @@ def format_pct_numeric_cols(dataframe):
             dataframe[col] = dataframe[col].map(lambda x: str(x).strip().replace('%', ''))
             non_empty_idx = dataframe[dataframe[col] != ''].index
             # Columns with partially numeric data will end up mixed type (i.e. Object col type).
-            dataframe.loc[non_empty_idx, col] = pd.to_numeric(dataframe.loc[non_empty_idx, col])
+            numbers = pd.to_numeric(dataframe.loc[non_empty_idx, col])
+            dataframe.loc[non_empty_idx, col] = numbers.astype(float) if col in float_cols else numbers
             # Detect percentages and convert them to decimal.
-            if (dataframe.loc[non_empty_idx, col] > 1).any():
+            if scaled_pct_cols is not None:
+                scale = col in scaled_pct_cols
+            else:
+                scale = (dataframe.loc[non_empty_idx, col] > 1).any()
+            if scale:
                 dataframe.loc[non_empty_idx, col] /= 100
         except (KeyError, TypeError):
             pass
@@ -120,3 +137,62 @@ def format_pct_numeric_cols(dataframe):
             raise
 
     return dataframe
+
+
+@lru_cache(maxsize=None)
+def normalize_comm_month(comm_month):
+    """Put a Comm Month into the standard YYYY-M form. Blanks come back empty, unreadable months unchanged."""
+    comm_month = str(comm_month).strip()
+    if comm_month in ['', 'nan', 'NaT', 'None']:
+        return ''
+    try:
+        date = parse(comm_month)
+    except (ValueError, OverflowError):
+        return comm_month
+    return f'{date.year}-{date.month}'
+
+
+def normalize_comm_months(comm_months):
+    """Normalize a column of Comm Months, parsing each distinct value only once."""
+    codes, uniques = pd.factorize(comm_months)
+    # Missing values get code -1, which picks up the trailing blank.
+    normalized = np.array([normalize_comm_month(i) for i in uniques] + [''], dtype=object)
+    return pd.Series(normalized[codes], index=comm_months.index)
+
+
+def build_comm_month_index(dataframe):
+    """Index the rows of a commissions file by Comm Month. Returns a dict of {YYYY-M: row positions}."""
+    comm_months = normalize_comm_months(dataframe['Comm Month']).reset_index(drop=True)
+    return comm_months.groupby(comm_months).indices
+
+
+class TerritoryIndex:
+    """An index of territory cities to the salesperson who covers them, built from Salespeople Info."""
+
+    def __init__(self, sales_info):
+        """Index the Territory Cities of each salesperson, noting any city that's listed more than once."""
+        self.city_sales = {}
+        city_counts = Counter()
+        for cities, initials in zip(sales_info['Territory Cities'], sales_info['Sales Initials']):
+            for city in self.split_cities(cities):
+                city_counts[city] += 1
+                self.city_sales[city] = initials
+        self.duplicates = sorted(city for city, count in city_counts.items() if count > 1)
+
+    @staticmethod
+    def normalize(city):
+        """Put a city name into the form used for lookups."""
+        return str(city).upper().strip()
+
+    @classmethod
+    def split_cities(cls, cities):
+        """Split a comma-separated list of territory cities into normalized city names."""
+        return [cls.normalize(i) for i in str(cities).split(',') if cls.normalize(i)]
+
+    def lookup(self, city):
+        """Return the Sales Initials covering a city, or None if it isn't in anyone's territory."""
+        return self.city_sales.get(self.normalize(city))
+
+    def map(self, cities):
+        """Look up the Sales Initials for a whole column of cities (NaN where not found)."""
+        return cities.astype(str).str.upper().str.strip().map(self.city_sales)
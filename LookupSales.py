@@ -1,7 +1,16 @@
 import pandas as pd
 import numpy as np
 import os
-from FileIO import load_acct_list, load_root_customer_mappings, load_salespeople_info
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from xlsxwriter.utility import xl_range
+from FileIO import load_acct_list, load_root_customer_mappings, load_territory_index
+from RCExcelTools import check_file_locks, describe_file_locks
+
+# Columns in the Digikey Insight layout that hold numbers. Every other column is treated as text.
+INSIGHT_NUMERIC_COLUMNS = ['Qty Shipped', 'Quantity', 'Unit Price', 'Invoiced Dollars', 'Vendor ID',
+                           'Invoice Detail Nbr']
 
 
 def tableFormat(sheetData, sheetName, wbook):
@@ -45,75 +54,194 @@ def tableFormat(sheetData, sheetName, wbook):
         i += 1
     # Highlight new root customer and moved city rows.
     try:
-        for row in sheetData.index:
-            ind = str(sheetData.loc[row, 'TAARCOM Comments']).lower().rstrip() == 'individual'
-            no_root_cust = sheetData.loc[row, 'Root Customer..'] == ''
-            if ind or no_root_cust:
-                continue
-            root_cust_loc = int(np.where(sheetData.columns == 'Root Customer..')[0])
-            city_loc = int(np.where(sheetData.columns == 'City on Acct List')[0])
-            if sheetData.loc[row, 'New T-Cust'] == 'Y':
-                sheet.write(row + 1, root_cust_loc, sheetData.loc[row, 'Root Customer..'], newFormat)
-            elif not sheetData.loc[row, 'City on Acct List']:
-                pass
-            elif sheetData.loc[row, 'Customer City'] not in sheetData.loc[row, 'City on Acct List'].split(', '):
-                sheet.write(row + 1, root_cust_loc, sheetData.loc[row, 'Root Customer..'],  movedFormat)
-                sheet.write(row + 1, city_loc, sheetData.loc[row, 'City on Acct List'], movedFormat)
+        rootCustLoc = sheetData.columns.get_loc('Root Customer..')
+        cityLoc = sheetData.columns.get_loc('City on Acct List')
+        rootCust = sheetData['Root Customer..']
+        acctCity = sheetData['City on Acct List']
+        ind = sheetData['TAARCOM Comments'].astype(str).str.lower().str.rstrip() == 'individual'
+        candidates = (~ind & (rootCust != '')).to_numpy()
+        newCust = candidates & (sheetData['New T-Cust'] == 'Y').to_numpy()
+        # Rows whose Customer City isn't one of the cities on the Acct List.
+        checkCity = candidates & ~newCust & (acctCity.astype(bool)).to_numpy()
+        acctCities = pd.Series(acctCity.to_numpy()[checkCity]).astype(str).str.split(', ').explode()
+        custCity = pd.Series(sheetData['Customer City'].to_numpy()[checkCity]).astype(str)
+        found = (acctCities == custCity.reindex(acctCities.index)).groupby(level=0).any()
+        movedCity = checkCity.copy()
+        movedCity[checkCity] = ~found.reindex(custCity.index, fill_value=False).to_numpy()
     except KeyError:
         print('Error locating Sales and/or City on Acct List columns.\n'
               'Unable to highlight without these columns.\n---')
+        return
+    highlight_cells(sheet, np.flatnonzero(newCust), [rootCustLoc], newFormat)
+    highlight_cells(sheet, np.flatnonzero(movedCity), [rootCustLoc, cityLoc], movedFormat)
+
+
+# Most cell ranges to put in a single conditional format.
+HIGHLIGHT_RANGES_PER_FORMAT = 500
+
+
+def highlight_cells(sheet, rows, cols, cell_format):
+    """
+    Highlight cells with conditional formats instead of rewriting each cell.
+
+    Arguments:
+    sheet -- The xlsxwriter worksheet.
+    rows -- Sorted data row positions to highlight (the header is row 0 in the sheet).
+    cols -- Column positions to highlight in each row.
+    cell_format -- The format to apply.
+    """
+    if not len(rows):
+        return
+    # Merge consecutive rows into runs, so each run is a single range.
+    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+    runs = [(i[0] + 1, i[-1] + 1) for i in np.split(rows, breaks)]
+    ranges = [xl_range(first, col, last, col) for col in cols for first, last in runs]
+    for start in range(0, len(ranges), HIGHLIGHT_RANGES_PER_FORMAT):
+        batch = ranges[start:start + HIGHLIGHT_RANGES_PER_FORMAT]
+        sheet.conditional_format(batch[0], {'type': 'no_errors', 'format': cell_format,
+                                            'multi_range': ' '.join(batch)})
 
 
 def saveError(*excelFiles):
     """Check Excel files and return True if any file is open."""
-    for file in excelFiles:
-        try:
-            open(file, 'r+')
-        except FileNotFoundError:
-            pass
-        except PermissionError:
-            return True
-    return False
+    locks = check_file_locks(*excelFiles)
+    if locks:
+        print('The following files are currently open:\n' + describe_file_locks(locks))
+    return bool(locks)
 
 
-def main(filepath):
-    """Looks up the salespeople for a Digikey Local Insight file.
+# Number of Insight files to look up at once in batch mode.
+LOOKUP_WORKERS = 4
 
-    Arguments:
-    filepath -- The filepath to the new Digikey Insight file.
+# Lookup tables used to assign salespeople to Insight lines.
+SalesLookups = namedtuple('SalesLookups', ['acct_info', 'mapping_counts', 'root_cust_sales', 'territory'])
+
+
+def build_sales_lookups(acct_list, root_cust_map, territory):
+    """Builds the customer and city lookup tables once, so that lines can be assigned in bulk.
+
+    acct_info -- SLS and CITY from the Account List, indexed by lowercase ProperName (unique names only).
+    mapping_counts -- Number of rootCustomerMappings entries for each lowercase Root Customer.
+    root_cust_sales -- Salesperson from rootCustomerMappings, indexed by lowercase Root Customer (unique only).
+    territory -- The TerritoryIndex of cities to Sales Initials.
     """
-    # Set the directory paths to the server.
-    lookup_dir = 'Z:/Commissions Lookup/'
-    if not os.path.exists(lookup_dir):
-        lookup_dir = os.getcwd()
+    acct_names = acct_list['ProperName'].astype(str).str.lower()
+    unique_acct = ~acct_names.duplicated(keep=False)
+    acct_info = acct_list.loc[unique_acct, ['SLS', 'CITY']].set_index(acct_names[unique_acct])
+    mapping_names = root_cust_map['Root Customer'].astype(str).str.lower()
+    mapping_counts = mapping_names.value_counts()
+    unique_mapping = ~mapping_names.duplicated(keep=False)
+    root_cust_sales = root_cust_map.loc[unique_mapping, 'Salesperson'].set_axis(mapping_names[unique_mapping])
+    return SalesLookups(acct_info, mapping_counts, root_cust_sales, territory)
+
 
+def assign_salespeople(insight_file, lookups):
+    """Fills in Sales, City on Acct List, New T-Cust, and TAARCOM Comments for every line of an Insight file.
+
+    Individuals are assigned by territory city. Everyone else is matched to the Account List first,
+    then to rootCustomerMappings, and any customer not found in either is flagged as new and
+    assigned by territory city.
+    """
+    for col in ['Sales', 'City on Acct List', 'TAARCOM Comments', 'New T-Cust']:
+        if col not in list(insight_file):
+            insight_file[col] = ''
+    # Note individuals and CMs in the comments.
+    root_class = insight_file['Root Customer Class'].astype(str).str.lower().str.rstrip()
+    individual = root_class.str.contains('individual', regex=False)
+    insight_file.loc[root_class.str.contains('contract', regex=False), 'TAARCOM Comments'] = 'Contract Manufacturer'
+    insight_file.loc[individual, 'TAARCOM Comments'] = 'Individual'
+    city = insight_file['Customer City'].astype(str).str.upper().str.rstrip()
+    city_sales = lookups.territory.map(insight_file['Customer City'])
+    insight_file.loc[individual & city_sales.notna(), 'Sales'] = city_sales
+
+    # Match customers to the Account List and copy over the salesperson.
+    cust = insight_file['Root Customer..'].astype(str).str.lower().str.rstrip()
+    in_acct_list = ~individual & (cust != '') & cust.isin(lookups.acct_info.index)
+    acct_match = lookups.acct_info.reindex(cust[in_acct_list])
+    insight_file.loc[in_acct_list, 'Sales'] = acct_match['SLS'].to_numpy()
+    # Note the Account List city if it's different from the reported one.
+    acct_city = acct_match['CITY'].astype(str).str.upper().to_numpy()
+    moved = [i not in j.split(', ') for i, j in zip(city[in_acct_list], acct_city)]
+    moved_idx = insight_file.index[in_acct_list][moved]
+    insight_file.loc[moved_idx, 'City on Acct List'] = acct_city[moved]
+
+    # Next look for a match in the rootCustomerMappings.
+    not_in_acct_list = ~individual & ~in_acct_list
+    mapping_count = cust.map(lookups.mapping_counts).fillna(0)
+    mapped = not_in_acct_list & (cust != '') & (mapping_count == 1)
+    insight_file.loc[mapped, 'Sales'] = cust[mapped].map(lookups.root_cust_sales)
+    multiple = not_in_acct_list & ~mapped & (mapping_count > 1)
+    for name in cust[multiple].unique():
+        print('Multiple entries found in rootCustomerMappings for %s!' % name)
+    # Anything left is a new customer, so assign by city.
+    new_cust = not_in_acct_list & ~mapped & ~multiple
+    insight_file.loc[new_cust, 'New T-Cust'] = 'Y'
+    insight_file.loc[new_cust & city_sales.notna(), 'Sales'] = city_sales
+    return insight_file
+
+
+def convert_insight_types(insight_file):
+    """Converts the numeric columns of an Insight file to numbers, one column at a time.
+
+    Blanks and any stray text in a numeric column are left as they are.
+    """
+    for col in [i for i in INSIGHT_NUMERIC_COLUMNS if i in list(insight_file)]:
+        numeric = pd.to_numeric(insight_file[col], errors='coerce')
+        # Keep whole numbers (quantities, IDs) as integers.
+        if (numeric.dropna() % 1 == 0).all():
+            numeric = numeric.astype('Int64')
+        insight_file[col] = numeric.astype(object).where(numeric.notna(), insight_file[col])
+    return insight_file
+
+
+def load_sales_lookups():
+    """Loads the supporting files and builds the salesperson lookups. Returns None if there's a problem."""
     # Load the Root Customer Mappings file.
     root_cust_map = load_root_customer_mappings()
 
     # Load the Master Account List file.
     acct_list = load_acct_list()
 
-    # Load the Salesperson Info file.
-    salespeople_info = load_salespeople_info()
+    # Load the Salesperson Info file and index the territory cities.
+    territory = load_territory_index()
 
-    if any(i.empty for i in (root_cust_map, acct_list, salespeople_info)):
-        return
+    if territory is None or any(i.empty for i in (root_cust_map, acct_list)):
+        return None
 
     # Check for duplicate cities in the Salespeople Info.
-    city_list = [str(i).split(', ') for i in salespeople_info['Territory Cities'] if i != '']
-    city_list = [j for i in city_list for j in i]
-    duplicates = set(x for x in city_list if city_list.count(x) > 1)
-    if duplicates:
+    if territory.duplicates:
         print('The following cities are in the Salespeople Info file multiple times:\n%s'
-              % ', '.join(map(str, duplicates)) + '\nPlease remove the extras and try again.'
+              % ', '.join(territory.duplicates) + '\nPlease remove the extras and try again.'
               '\n*Program Terminated*')
-        return
+        return None
+
+    return build_sales_lookups(acct_list, root_cust_map, territory)
+
+
+def get_output_dir():
+    """Returns the directory for saving the looked-up Insight files."""
+    output_dir = 'C:/Users/kerry/Documents/disty data/Digikey/'
+    if not os.path.exists(output_dir):
+        print('Output directory %s not found!\nUsing current directory for saving files.' % output_dir)
+        output_dir = os.getcwd()
+    return output_dir
 
-    print('Looking up salespeople...')
 
-    # Strip the root off of the filepath and leave just the filename.
-    filename = os.path.basename(filepath)
+def get_output_file(filepath, output_dir):
+    """Returns the filepath for saving the looked-up version of an Insight file."""
+    return os.path.join(output_dir, os.path.basename(filepath)[:-5] + ' With Salespeople.xlsx')
 
+
+def lookup_insight_file(filepath, lookups, output_dir):
+    """Looks up the salespeople for one Digikey Local Insight file and saves the result.
+
+    Arguments:
+    filepath -- The filepath to the new Digikey Insight file.
+    lookups -- The SalesLookups built by load_sales_lookups.
+    output_dir -- Where to save the finished file.
+
+    Returns the filepath of the saved file, or None if the file couldn't be processed.
+    """
     # Load the Digikey Insight file.
     insight_file = pd.read_excel(filepath, None)
     insight_file = insight_file[list(insight_file)[0]].fillna('')
@@ -154,7 +282,7 @@ def main(filepath):
               'Please make sure Qty Shipped and Unit Price columns are in the report.\n'
               '(Also check that the top line of the file contains the column names).\n'
               '*Program Terminated*')
-        return
+        return None
 
     # Remove the 'Send' column, if present.
     try:
@@ -167,82 +295,115 @@ def main(filepath):
               'Please make sure this column exists and try again.\n'
               'Note: also check that row 1 of the file is the column headers.'
               '\n*Program Terminated*')
-        return
+        return None
 
-    # ----------------------------------------------------------------------
-    # Go through each entry in the Insight file and look for a sales match.
-    # ----------------------------------------------------------------------
-    for row in insight_file.index:
-        # Check for individuals and CMs and note them in comments.
-        if 'contract' in str(insight_file.loc[row, 'Root Customer Class']).lower().rstrip():
-            insight_file.loc[row, 'TAARCOM Comments'] = 'Contract Manufacturer'
-        if 'individual' in str(insight_file.loc[row, 'Root Customer Class']).lower().rstrip():
-            insight_file.loc[row, 'TAARCOM Comments'] = 'Individual'
-            city = str(insight_file.loc[row, 'Customer City']).upper().rstrip()
-            # Check for matches to city and assign salesperson.
-            for person in salespeople_info.index:
-                cities = str(salespeople_info['Territory Cities'][person]).upper().rstrip().split(', ')
-                if city in cities:
-                    insight_file.loc[row, 'Sales'] = salespeople_info.loc[person, 'Sales Initials']
-            # Done, so move to next line in file.
-            continue
-        cust = str(insight_file.loc[row, 'Root Customer..']).lower().rstrip()
-        # Check for customer match in account list.
-        acct_list_match = acct_list[acct_list['ProperName'].astype(str).str.lower() == cust]
-        if cust and len(acct_list_match) == 1:
-            # Check if the city is different from our account list.
-            acct_list_city = str(acct_list_match['CITY'].iloc[0]).upper().split(', ')
-            if str(insight_file.loc[row, 'Customer City']).upper().rstrip() not in acct_list_city:
-                if len(acct_list_city) > 1:
-                    acct_list_city = ', '.join(acct_list_city)
-                insight_file.loc[row, 'City on Acct List'] = acct_list_city
-            # Copy over salesperson.
-            insight_file.loc[row, 'Sales'] = acct_list_match['SLS'].iloc[0]
-        else:
-            # Look for match in root_cust_map file.
-            sales_match = root_cust_map['Root Customer'].astype(str).str.lower() == cust
-            match = root_cust_map[sales_match]
-            if cust and len(match) == 1:
-                # Match to salesperson if exactly one match is found.
-                insight_file.loc[row, 'Sales'] = match['Salesperson'].iloc[0]
-            elif len(match) > 1:
-                print('Multiple entries found in rootCustomerMappings for %s!' % cust)
-            else:
-                # Record that the customer is new.
-                insight_file.loc[row, 'New T-Cust'] = 'Y'
-                # Look up based on city and fill in.
-                city = insight_file.loc[row, 'Customer City'].upper().rstrip()
-                for person in salespeople_info.index:
-                    cities = salespeople_info['Territory Cities'][person].upper().split(', ')
-                    if city in cities:
-                        insight_file.loc[row, 'Sales'] = salespeople_info.loc[person, 'Sales Initials']
-
-        # Convert applicable entries to numeric.
-        for col in list(insight_file):
-            insight_file.loc[row, col] = pd.to_numeric(insight_file.loc[row, col], errors='ignore')
+    # ------------------------------------------------------------
+    # Look up the salespeople for every line in the Insight file.
+    # ------------------------------------------------------------
+    insight_file = assign_salespeople(insight_file, lookups)
+
+    # Convert the numeric columns to numbers.
+    insight_file = convert_insight_types(insight_file)
 
     # Reorder columns and fill NaNs.
     insight_file = insight_file.loc[:, col_names].fillna('')
 
     # Try saving the files, exit with error if any file is currently open.
-    output_dir = 'C:/Users/kerry/Documents/disty data/Digikey/'
-    if not os.path.exists(output_dir):
-        print('Output directory %s not found!\nUsing current directory for saving files.' % output_dir)
-        output_dir = os.getcwd()
-    fname1 = os.path.join(output_dir, filename[:-5] + ' With Salespeople.xlsx')
+    fname1 = get_output_file(filepath, output_dir)
     if saveError(fname1):
-        print('---\nOne or more files are currently open in Excel!\n'
-              'Please close the files and try again.\n*Program Terminated*')
-        return
+        print('---\n%s is currently open in Excel!\n'
+              'Please close the file and try again.\n*Program Terminated*' % os.path.basename(fname1))
+        return None
 
     # Write the Digikey Insight file, which now contains salespeople.
-    writer1 = pd.ExcelWriter(fname1, engine='xlsxwriter', datetime_format='mm/dd/yyyy')
-    insight_file.to_excel(writer1, sheet_name='Data', index=False)
-    # Format in Excel.
-    tableFormat(insight_file, 'Data', writer1)
+    with pd.ExcelWriter(fname1, engine='xlsxwriter', datetime_format='mm/dd/yyyy') as writer1:
+        insight_file.to_excel(writer1, sheet_name='Data', index=False)
+        # Format in Excel.
+        tableFormat(insight_file, 'Data', writer1)
+
+    return fname1
+
+
+def main(filepath):
+    """Looks up the salespeople for a Digikey Local Insight file.
+
+    Arguments:
+    filepath -- The filepath to the new Digikey Insight file.
+    """
+    # Make sure the output file isn't open before doing any work.
+    output_dir = get_output_dir()
+    if saveError(get_output_file(filepath, output_dir)):
+        print('Please close the file and try again.\n*Program Terminated*')
+        return
+
+    lookups = load_sales_lookups()
+    if lookups is None:
+        return
+
+    print('Looking up salespeople...')
+    fname1 = lookup_insight_file(filepath, lookups, output_dir)
+    if fname1:
+        print('---\nSalespeople successfully looked up!\n'
+              'New file saved as:\n ' + fname1 + '\n+Program Complete+')
+
+
+def timed_lookup(filepath, lookups, output_dir):
+    """Runs lookup_insight_file and times it. Returns (saved filepath or error, seconds taken)."""
+    start = time.perf_counter()
+    try:
+        result = lookup_insight_file(filepath, lookups, output_dir)
+    except Exception as error:
+        result = error
+    return result, time.perf_counter() - start
+
+
+def main_batch(filepaths):
+    """Looks up the salespeople for a batch of Digikey Local Insight files.
+
+    The supporting files are loaded once and shared by all of the Insight files, which are processed
+    by a pool of workers. Each file is saved as soon as it's finished.
+
+    Arguments:
+    filepaths -- The filepaths to the new Digikey Insight files.
+    """
+    # Skip any files whose output is open, before doing any work.
+    output_dir = get_output_dir()
+    locks = check_file_locks(*[get_output_file(i, output_dir) for i in filepaths])
+    if locks:
+        print('The following output files are currently open, so their Insight files will be skipped:\n'
+              + describe_file_locks(locks) + '\n---')
+        filepaths = [i for i in filepaths if get_output_file(i, output_dir) not in locks]
+        if not filepaths:
+            print('*Program Terminated*')
+            return
+
+    lookups = load_sales_lookups()
+    if lookups is None:
+        return
 
-    # Save the files.
-    writer1.save()
+    print('Looking up salespeople for %d files...' % len(filepaths))
+    start = time.perf_counter()
+    timings = {}
+    with ThreadPoolExecutor(max_workers=min(LOOKUP_WORKERS, len(filepaths) or 1)) as executor:
+        futures = {executor.submit(timed_lookup, i, lookups, output_dir): i for i in filepaths}
+        # Timings are kept by full path, since files in different folders can share a name.
+        for future in as_completed(futures):
+            filepath = futures[future]
+            filename = os.path.basename(filepath)
+            result, seconds = future.result()
+            timings[filepath] = (result, seconds)
+            if isinstance(result, Exception):
+                print('---\nError processing %s:\n%s' % (filename, result))
+            elif result:
+                print('---\n%s saved as:\n %s' % (filename, result))
 
-    print('---\nSalespeople successfully looked up!\n'
-          'New file saved as:\n ' + fname1 + '\n+Program Complete+')
+    # Print a summary of how each file went.
+    print('---\nSummary:')
+    for filepath in filepaths:
+        filename = os.path.basename(filepath)
+        result, seconds = timings[filepath]
+        status = 'done' if isinstance(result, str) else 'FAILED'
+        print('%s: %s (%.1f s)' % (filename, status, seconds))
+    num_done = sum(isinstance(i[0], str) for i in timings.values())
+    print('%d of %d files completed in %.1f s.\n+Program Complete+'
+          % (num_done, len(filepaths), time.perf_counter() - start))
@@ -1,32 +1,210 @@
+import os
 import smtplib
+import logging
+import threading
+from glob import glob
+from queue import Queue, Empty
 from os.path import basename
+from contextlib import contextmanager
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import formatdate
 
+logger = logging.getLogger(__name__)
+
+DEFAULT_BODY = ('Hello,\n\nAttached are your latest reports from TAARCOM. Please look them over and let us know '
+                'if anything needs to be fixed.\n\nThank you!')
+DEFAULT_SUBJECT = 'TAARCOM Sales Reports'
+# Column in Salespeople Info with each salesperson's email address.
+EMAIL_COLUMN = 'Email'
+# Most mail servers throttle clients that open lots of connections, so keep the pool small.
+MAIL_WORKERS = 4
+
+# One message to send in a bulk mailing.
+MailJob = namedtuple('MailJob', ['send_to', 'subject', 'body', 'files'], defaults=[DEFAULT_BODY, None])
+# What happened to each message.
+DeliveryResult = namedtuple('DeliveryResult', ['send_to', 'subject', 'delivered', 'error'])
+
+
+class SMTPPool:
+    """A small pool of persistent SMTP sessions that are reused across messages."""
+
+    def __init__(self, server='127.0.0.1', port=0, size=1, timeout=60):
+        self.server = server
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.idle = Queue()
+        self.sessions = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        return smtplib.SMTP(self.server, self.port, timeout=self.timeout)
+
+    @contextmanager
+    def session(self):
+        """Borrow a session from the pool, opening a new one if there's room, otherwise wait for one."""
+        with self.lock:
+            try:
+                smtp = self.idle.get_nowait()
+            except Empty:
+                smtp = None
+                if len(self.sessions) < self.size:
+                    smtp = self.connect()
+                    self.sessions.append(smtp)
+        if smtp is None:
+            smtp = self.idle.get()
+        try:
+            yield smtp
+        finally:
+            self.idle.put(smtp)
+
+    def sendmail(self, send_from, send_to, message):
+        """Send a message on a pooled session, reconnecting once if the server dropped the session."""
+        with self.session() as smtp:
+            try:
+                smtp.sendmail(send_from, send_to, message)
+            except smtplib.SMTPServerDisconnected:
+                self.reconnect(smtp)
+                smtp.sendmail(send_from, send_to, message)
+
+    def reconnect(self, smtp):
+        """Reopen a dropped session. The EHLO has to be redone too, or the server rejects the next MAIL."""
+        smtp.close()
+        smtp.connect(self.server, self.port)
+        smtp.ehlo()
+
+    def close(self):
+        for smtp in self.sessions:
+            try:
+                smtp.quit()
+            except smtplib.SMTPException:
+                smtp.close()
+        self.sessions = []
+        self.idle = Queue()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AttachmentCache:
+    """Reads each attachment once, no matter how many messages it goes out on."""
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def read(self, file):
+        with self.lock:
+            if file not in self.data:
+                with open(file, 'rb') as fil:
+                    self.data[file] = fil.read()
+            return self.data[file]
+
+    def part(self, file):
+        """Build the MIME part for an attachment."""
+        part = MIMEApplication(self.read(file), Name=basename(file))
+        part['Content-Disposition'] = 'attachment; filename="%s"' % basename(file)
+        return part
 
-def send_mail(send_from, send_to, subject, files=None,
-              server="127.0.0.1"):
 
+def build_message(send_from, send_to, subject, body=DEFAULT_BODY, files=None, attachments=None):
+    """Put together the email message, with attachments read through the cache (if given)."""
+    attachments = attachments or AttachmentCache()
     msg = MIMEMultipart()
     msg['From'] = send_from
     msg['To'] = send_to
     msg['Date'] = formatdate(localtime=True)
     msg['Subject'] = subject
 
-    msg.attach(MIMEText('This is a test'))
+    msg.attach(MIMEText(body))
 
     for f in files or []:
-        with open(f, "rb") as fil:
-            part = MIMEApplication(
-                fil.read(),
-                Name=basename(f)
-            )
-        # After the file is closed
-        part['Content-Disposition'] = 'attachment; filename="%s"' % basename(f)
-        msg.attach(part)
-
-    smtp = smtplib.SMTP(server)
-    smtp.sendmail(send_from, send_to, msg.as_string())
-    smtp.close()
+        msg.attach(attachments.part(f))
+    return msg
+
+
+def send_mail(send_from, send_to, subject, files=None,
+              server="127.0.0.1", body=DEFAULT_BODY):
+    msg = build_message(send_from, send_to, subject, body, files)
+    with SMTPPool(server) as pool:
+        pool.sendmail(send_from, send_to, msg.as_string())
+
+
+def send_bulk(send_from, jobs, server='127.0.0.1', port=0, workers=MAIL_WORKERS):
+    """
+    Send a batch of messages (e.g. each salesperson's Insight and commission reports).
+
+    Up to `workers` messages are sent at once, each over one of the same number of persistent SMTP
+    sessions. Attachments shared between messages are only read once.
+
+    Arguments:
+    send_from -- The sender address.
+    jobs -- List of MailJob.
+    server, port -- The SMTP server to send through.
+    workers -- Most messages (and SMTP sessions) in flight at once.
+
+    Returns a list of DeliveryResult, in the same order as the jobs.
+    """
+    attachments = AttachmentCache()
+
+    def deliver(job):
+        try:
+            msg = build_message(send_from, job.send_to, job.subject, job.body, job.files, attachments)
+            pool.sendmail(send_from, job.send_to, msg.as_string())
+        except (smtplib.SMTPException, OSError) as error:
+            logger.error(f'Failed to send "{job.subject}" to {job.send_to}: {error}')
+            return DeliveryResult(job.send_to, job.subject, False, str(error))
+        return DeliveryResult(job.send_to, job.subject, True, '')
+
+    workers = max(1, min(workers, len(jobs)))
+    with SMTPPool(server, port, size=workers) as pool, ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(deliver, jobs))
+    logger.info(f'Sent {sum(i.delivered for i in results)} of {len(results)} messages.')
+    return results
+
+
+def find_sales_reports(reports_dir, salespeople, comm_month):
+    """
+    Find each salesperson's reports for a Comm Month, as saved by SalesReportGenerator
+    (e.g. "AB Commission Report - 2024-3.xlsx" and "AB Revenue Report - 2024-3.xlsx").
+
+    Returns a dictionary of sales initials --> list of report file paths.
+    """
+    return {person: sorted(glob(os.path.join(reports_dir, f'{person} * Report - {comm_month}.xlsx')))
+            for person in salespeople}
+
+
+def build_report_jobs(sales_info, report_files, shared_files=None, subject=DEFAULT_SUBJECT, body=DEFAULT_BODY):
+    """
+    Put together a MailJob for each salesperson, ready for send_bulk.
+
+    Arguments:
+    sales_info -- Salespeople Info, with the email addresses in the EMAIL_COLUMN column.
+    report_files -- Dictionary of sales initials --> list of that salesperson's own reports.
+    shared_files -- Files that go to everyone (like the looked-up Insight file).
+    subject, body -- The subject and body of each message.
+
+    Salespeople with no email address or nothing to send are skipped (and logged).
+    """
+    if EMAIL_COLUMN not in sales_info:
+        logger.error(f'No {EMAIL_COLUMN} column found in Salespeople Info, so no reports can be mailed.')
+        return []
+    emails = sales_info.drop_duplicates('Sales Initials').set_index('Sales Initials')[EMAIL_COLUMN]
+    jobs = []
+    for person, files in report_files.items():
+        files = list(shared_files or []) + list(files)
+        email = emails.get(person)
+        if not isinstance(email, str) or not email.strip():
+            logger.warning(f'No email address found for {person} in Salespeople Info, so their reports were not sent.')
+        elif not files:
+            logger.info(f'No reports found for {person}.')
+        else:
+            jobs.append(MailJob(email.strip(), subject, body, files))
+    return jobs
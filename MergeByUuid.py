@@ -2,6 +2,7 @@ import os
 import pandas as pd
 from FileIO import load_run_com, load_com_master
 from RCExcelTools import tab_save_prep, save_error
+from BackupManager import snapshot_file
 
 # Set the directory for the data input/output.
 if os.path.exists('Z:\\'):
@@ -39,6 +40,7 @@ def main(run_com_path):
             return
 
     filename = os.path.join(data_dir, 'Commissions Master.xlsx')
+    snapshot_file(filename)
     writer = pd.ExcelWriter(filename, engine='xlsxwriter', datetime_format='mm/dd/yyyy')
     tab_save_prep(writer=writer, data=com_mast, sheet_name='Master')
     tab_save_prep(writer=writer, data=master_files, sheet_name='Files Processed')
@@ -7,7 +7,7 @@ import calendar
 import math
 import os.path
 import GenerateMasterUtils as Utils
-from FileIO import load_entries_need_fixing, load_run_com, load_lookup_master, save_excel_file
+from FileIO import load_entries_need_fixing, load_run_com, load_lookup_master, save_excel_files
 from RCExcelTools import save_error, form_date
 
 logger = logging.getLogger(__name__)
@@ -26,9 +26,19 @@ def main(run_com_path):
     entries when needed, and quarantining old entries that have not been
     used in 2+ years.
     """
+    # Make sure none of the files we're going to save are open before doing any work.
+    com_date = run_com_path[-20:]
+    filepath_RC = os.path.join(Utils.DIRECTORIES.get('COMM_WORKING_DIR'), f'Running Commissions {com_date}')
+    filepath_ENF = os.path.join(Utils.DIRECTORIES.get('COMM_WORKING_DIR'), f'Entries Need Fixing {com_date}')
+    filepath_LM = os.path.join(Utils.DIRECTORIES.get('COMM_LOOKUPS_DIR'), 'Lookup Master - Current.xlsx')
+    filepath_QL = os.path.join(Utils.DIRECTORIES.get('COMM_LOOKUPS_DIR'), 'Quarantined Lookups.xlsx')
+    if save_error(filepath_RC, filepath_ENF, filepath_LM, filepath_QL):
+        logger.error('One or more of the RC/ENF/Lookup/Quarantine files are currently open in Excel! '
+                     'Please close the files and try again.\n*Program Teminated*')
+        return
+
     # Load up the necessary files.
     running_com, files_processed = load_run_com(run_com_path)
-    com_date = run_com_path[-20:]
     entries_need_fixing = load_entries_need_fixing(os.path.join(Utils.DIRECTORIES.get('COMM_WORKING_DIR'),
                                                                 f'Entries Need Fixing {com_date}'))
     lookup_master = load_lookup_master()
@@ -188,20 +198,16 @@ def main(run_com_path):
         # Notify us of changes.
         logger.info(f'{len(old_entries)} entries quarantined for being more than 2 years old.')
 
-    # Check if the files we're going to save are open already.
-    filepath_RC = os.path.join(Utils.DIRECTORIES.get('COMM_WORKING_DIR'), f'Running Commissions {com_date}')
-    filepath_ENF = os.path.join(Utils.DIRECTORIES.get('COMM_WORKING_DIR'), f'Entries Need Fixing {com_date}')
-    filepath_LM = os.path.join(Utils.DIRECTORIES.get('COMM_LOOKUPS_DIR'), 'Lookup Master - Current.xlsx')
-    filepath_QL = os.path.join(Utils.DIRECTORIES.get('COMM_LOOKUPS_DIR'), 'Quarantined Lookups.xlsx')
+    # Check again in case any of the files got opened in the meantime.
     if save_error(filepath_RC, filepath_ENF, filepath_LM, filepath_QL):
         logger.error('One or more of the RC/ENF/Lookup/Quarantine files are currently open in Excel! '
                      'Please close the files and try again.\n*Program Teminated*')
         return
 
-    save_excel_file(filename=filepath_RC, tab_data=[running_com, files_processed],
-                    tab_names=['Master', 'Files Processed'])
-    save_excel_file(filename=filepath_ENF, tab_data=entries_need_fixing, tab_names='Data')
-    save_excel_file(filename=filepath_LM, tab_data=lookup_master, tab_names='Lookup')
-    save_excel_file(filename=filepath_QL, tab_data=quarantined, tab_names='Lookup')
+    if not save_excel_files({filepath_RC: ([running_com, files_processed], ['Master', 'Files Processed']),
+                             filepath_ENF: (entries_need_fixing, 'Data'),
+                             filepath_LM: (lookup_master, 'Lookup'),
+                             filepath_QL: (quarantined, 'Lookup')}):
+        return
 
     logger.info('Fixed entries migrated successfully!')
@@ -1,84 +1,206 @@
+import os
+import re
+import logging
+import pandas as pd
+from datetime import date
+from functools import lru_cache
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from reportlab.lib.pagesizes import letter
+from reportlab.lib.utils import ImageReader
 from reportlab.pdfgen import canvas
 from reportlab.pdfbase.pdfmetrics import stringWidth
-import locale
-from datetime import date
 
+logger = logging.getLogger(__name__)
 
-def pdf_report(salesperson, data, prior_comm, priorDue, salesDraw):
-    locale.setlocale(locale.LC_ALL, '')
+LOGO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'TAARCOM.png')
+# Statements are independent, so they're rendered in separate processes.
+PDF_WORKERS = 4
+# Column in principalList.xlsx with the full principal names (falls back to the abbreviation).
+PRINCIPAL_NAME_COLUMN = 'Principal'
+# Layout of the principal rows: rows go down the page from TABLE_TOP, and a new page is started
+# once they'd go past ROWS_BOTTOM. The totals and footer need FOOTER_HEIGHT below the last row.
+TABLE_TOP = 600
+ROW_HEIGHT = 40
+ROWS_BOTTOM = 80
+FOOTER_HEIGHT = 120
 
-    # Initialize report pdf.
-    report = canvas.Canvas('Quarterly Sales Report - ' + salesperson + '.pdf', pagesize=letter)
-    report.setFont('Helvetica', 12)
-    report_date = date.today().strftime('%m/%d/%Y')
+# Optional Salespeople Info columns with the amounts shown above and below the principals.
+AMOUNT_COLUMNS = ['Prior Qtr Commission', 'Prior Qtr Due', 'Sales Draw']
+
+# Everything needed to draw one salesperson's statement. Principals is a list of (name, commission).
+Statement = namedtuple('Statement', ['salesperson', 'principals', 'prior_comm', 'prior_due', 'sales_draw'])
+
+
+@lru_cache(maxsize=None)
+def get_logo():
+    """Load the logo once per process and reuse it for every statement."""
+    return ImageReader(LOGO_PATH)
+
+
+@lru_cache(maxsize=None)
+def text_width(text, font, size):
+    return stringWidth(text, font, size)
+
+
+def format_currency(value):
+    """Format a dollar amount like $1,234.56 (without going through the locale)."""
+    return f'-${-value:,.2f}' if value < 0 else f'${value:,.2f}'
+
+
+def get_principal_names(principal_info):
+    """Map principal abbreviations to their full names from principalList.xlsx."""
+    if PRINCIPAL_NAME_COLUMN not in principal_info:
+        return {}
+    names = principal_info[['Abbreviation', PRINCIPAL_NAME_COLUMN]].dropna()
+    return dict(zip(names['Abbreviation'].astype(str).str.strip(), names[PRINCIPAL_NAME_COLUMN].astype(str)))
+
+
+def build_statements(totals, sales_info, principal_names, salespeople=None):
+    """
+    Put together a Statement for each salesperson from the salesperson/principal totals.
+
+    Arguments:
+    totals -- Table with Salesperson, Principal and Sales Commission columns (one line per pair).
+    sales_info -- Salespeople Info, for the full names and any prior quarter/draw amounts.
+    principal_names -- Dictionary of principal abbreviation --> full name.
+    salespeople -- Sales initials to make statements for (defaults to everyone in Salespeople Info).
+    """
+    if salespeople is None:
+        salespeople = sales_info['Sales Initials'].values
+    info = sales_info.drop_duplicates('Sales Initials').set_index('Sales Initials')
+    amounts = pd.DataFrame({i: pd.to_numeric(info[i], errors='coerce') if i in info else 0.0 for i in AMOUNT_COLUMNS},
+                           index=info.index).fillna(0)
+    person_totals = dict(list(totals.groupby('Salesperson')))
+    statements = []
+    for person in salespeople:
+        rows = person_totals.get(person, totals.iloc[:0])
+        principals = [(principal_names.get(i, i), float(j)) for i, j in zip(rows['Principal'], rows['Sales Commission'])]
+        if person in info.index:
+            full_name = info.loc[person].get('Salesperson')
+            statements.append(Statement(full_name if isinstance(full_name, str) and full_name else person,
+                                        principals, *map(float, amounts.loc[person])))
+        else:
+            statements.append(Statement(person, principals, 0.0, 0.0, 0.0))
+    return statements
 
-    # Header.
-    report.drawImage('TAARCOM.png', 505, 715, 100, 100)
-    prior_comm_str = locale.currency(prior_comm, grouping=True)
-    priorDueStr = locale.currency(priorDue, grouping=True)
-    prior_commWidth = stringWidth(prior_comm_str, 'Helvetica', 10)
-    dateWidth = stringWidth(report_date, 'Helvetica', 12)
-    report.drawString(20, 750, 'QUARTERLY SALES REPORT')
+
+def draw_header(report, statement, report_date, continued=False):
+    """Draw the top of a page, down through the column headings."""
+    report.setFont('Helvetica', 12)
+    report.drawImage(get_logo(), 505, 715, 100, 100, mask='auto')
+    report.drawString(20, 750, 'QUARTERLY SALES REPORT' + (' (CONTINUED)' if continued else ''))
     report.drawString(20, 735, 'TAARCOM, INC.')
-    report.drawString(600-dateWidth, 705, report_date)
-    report.drawString(20, 705, 'SALESPERSON: ' + salesperson)
+    report.drawString(600 - text_width(report_date, 'Helvetica', 12), 705, report_date)
+    report.drawString(20, 705, 'SALESPERSON: ' + statement.salesperson)
     report.setLineWidth(2)
     report.line(20, 700, 600, 700)
     report.setFont('Helvetica-Bold', 10)
-    report.drawString(20, 680, 'Balance due prior month:')
-    report.drawString(455-prior_commWidth, 680, 'Commissions paid last cycle:')
+    if not continued:
+        prior_comm_str = format_currency(statement.prior_comm)
+        prior_comm_width = text_width(prior_comm_str, 'Helvetica', 10)
+        report.drawString(20, 680, 'Balance due prior month:')
+        report.drawString(455 - prior_comm_width, 680, 'Commissions paid last cycle:')
     report.drawString(20, 645, 'Manufacturer')
     report.drawString(250, 645, 'Months')
     report.drawString(540, 655, 'Salesperson')
     report.drawString(540, 645, 'Commission')
     report.setFont('Helvetica', 10)
-    report.drawString(145, 680, priorDueStr)
-    report.drawString(600-prior_commWidth, 680, prior_comm_str)
+    if not continued:
+        report.drawString(145, 680, format_currency(statement.prior_due))
+        report.drawString(600 - prior_comm_width, 680, prior_comm_str)
+    report.line(20, 640, 600, 640)
+    report.line(20, 639, 600, 639)
+    report.setLineWidth(0.5)
 
-    # Keep track of the full principal names.
-    princDict = {'ABR': 'Abracon', 'ATS': 'Advanced Thermal Solutions',
-                 'COS': 'Cosel', 'GLO': 'Globtek', 'INF': 'Infineon',
-                 'ISS': 'ISSI', 'LAT': 'Lattice Semiconductor', 'OSR': 'Osram',
-                 'QRF': 'RF360 Qualcomm', 'TRU': 'Truly',
-                 'TRI': 'Triad Semiconductor', 'XMO': 'XMOS'}
 
-    # Iterate over each principal and fill in data.
-    report.setLineWidth(0.5)
-    numPrincs = len(princDict.keys())
-    shiftLen = 480/numPrincs
+def render_statement(statement, file_path, report_date=None):
+    """Draw one salesperson's statement to a PDF, starting new pages as the principals run down the page."""
+    report_date = report_date or date.today().strftime('%m/%d/%Y')
+    report = canvas.Canvas(file_path, pagesize=letter)
+    draw_header(report, statement, report_date)
     shift = 0
-    totComm = 0
-    for princ in princDict.keys():
-        princData = data[data['Principal'] == princ]
-        princComm = sum(princData['Sales Commission'])
-        totComm += princComm
-        report.line(20, 600-shift, 600, 600-shift)
-        commStr = locale.currency(princComm, grouping=True)
-        commWidth = stringWidth(commStr, 'Helvetica', 10)
-        report.drawString(600-commWidth, 605-shift, commStr)
-        report.drawString(20, 605-shift, princDict[princ])
-        shift += shiftLen
+    tot_comm = 0
+    for name, comm in statement.principals:
+        if TABLE_TOP - shift < ROWS_BOTTOM:
+            report.showPage()
+            draw_header(report, statement, report_date, continued=True)
+            shift = 0
+        tot_comm += comm
+        report.line(20, TABLE_TOP - shift, 600, TABLE_TOP - shift)
+        comm_str = format_currency(comm)
+        report.drawString(600 - text_width(comm_str, 'Helvetica', 10), TABLE_TOP + 5 - shift, comm_str)
+        report.drawString(20, TABLE_TOP + 5 - shift, name)
+        shift += ROW_HEIGHT
+    # Make sure the totals and footer fit under the last row.
+    if TABLE_TOP - shift - FOOTER_HEIGHT < 0:
+        report.showPage()
+        draw_header(report, statement, report_date, continued=True)
+        shift = 0
 
     # Commission total.
-    report.line(20, 640, 600, 640)
-    report.line(20, 639, 600, 639)
-    report.line(20, 600-shift+39, 600, 600-shift+39)
-    report.line(20, 600-shift-1, 600, 600-shift-1)
-    report.line(20, 600-shift, 600, 600-shift)
+    report.line(20, TABLE_TOP - shift + 39, 600, TABLE_TOP - shift + 39)
+    report.line(20, TABLE_TOP - shift - 1, 600, TABLE_TOP - shift - 1)
+    report.line(20, TABLE_TOP - shift, 600, TABLE_TOP - shift)
     report.setFont('Helvetica-Bold', 10)
-    report.drawString(20, 605-shift, 'TOTAL COMMISSIONS DUE:')
-    totCommStr = locale.currency(totComm, grouping=True)
-    totCommWidth = stringWidth(totCommStr, 'Helvetica-Bold', 10)
-    report.drawString(600-totCommWidth, 605-shift, totCommStr)
+    report.drawString(20, TABLE_TOP + 5 - shift, 'TOTAL COMMISSIONS DUE:')
+    tot_comm_str = format_currency(tot_comm)
+    report.drawString(600 - text_width(tot_comm_str, 'Helvetica-Bold', 10), TABLE_TOP + 5 - shift, tot_comm_str)
 
     # Footer.
     report.setFont('Helvetica', 10)
-    report.drawString(20, 605-shift-40, 'Sales draw:')
+    report.drawString(20, TABLE_TOP + 5 - shift - 40, 'Sales draw:')
+    report.drawString(145, TABLE_TOP + 5 - shift - 40, format_currency(statement.sales_draw))
     report.setFillColorRGB(0.9, 0.9, 0.9)
-    report.rect(20, 605-shift-80, 580, 20, fill=1)
+    report.rect(20, TABLE_TOP + 5 - shift - 80, 580, 20, fill=1)
     report.setFont('Helvetica-Bold', 10)
     report.setFillColorRGB(0, 0, 0)
-    report.drawString(25, 605-shift-73, 'BALANCE DUE:')
+    report.drawString(25, TABLE_TOP + 5 - shift - 73, 'BALANCE DUE:')
 
     report.save()
+    return file_path
+
+
+def get_statement_path(output_dir, comm_qtr, statement):
+    # Names can have characters that aren't allowed in filenames (like Bo/B), so those become underscores.
+    salesperson = re.sub(r'[\\/:*?"<>|]', '_', statement.salesperson).strip()
+    return os.path.join(output_dir, f'Quarterly Sales Report {comm_qtr} - {salesperson}.pdf')
+
+
+def render_statements(statements, output_dir, comm_qtr, workers=PDF_WORKERS):
+    """
+    Render a batch of statements, spread over worker processes.
+
+    Returns a list of the PDF file paths that were written. Any statement that fails is logged and
+    left out, so one bad statement doesn't hold up the rest.
+    """
+    if not statements:
+        return []
+    file_paths = [get_statement_path(output_dir, comm_qtr, i) for i in statements]
+    report_date = date.today().strftime('%m/%d/%Y')
+    workers = max(1, min(workers, len(statements)))
+    written = []
+    if workers == 1:
+        for statement, file_path in zip(statements, file_paths):
+            try:
+                written.append(render_statement(statement, file_path, report_date))
+            except Exception as error:
+                logger.error(f'Error writing quarterly statement for {statement.salesperson}: {error}')
+        return written
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(render_statement, i, j, report_date) for i, j in zip(statements, file_paths)]
+        for statement, future in zip(statements, futures):
+            try:
+                written.append(future.result())
+            except Exception as error:
+                logger.error(f'Error writing quarterly statement for {statement.salesperson}: {error}')
+    return written
+
+
+def create_pdf_statements(totals, sales_info, principal_info, output_dir, comm_qtr, salespeople=None,
+                          workers=PDF_WORKERS):
+    """Render the quarterly PDF statement for each salesperson straight from the salesperson/principal totals."""
+    statements = build_statements(totals, sales_info, get_principal_names(principal_info), salespeople)
+    written = render_statements(statements, output_dir, comm_qtr, workers)
+    logger.info(f'Wrote {len(written)} of {len(statements)} quarterly PDF statements.')
+    return written
@@ -1,12 +1,340 @@
 import os
 import re
+import json
+import pickle
 import logging
+import tempfile
 import pandas as pd
 import numpy as np
+from functools import lru_cache
 from GenerateMasterUtils import DIRECTORIES
 
 logger = logging.getLogger(__name__)
 
+# Extra (or replacement) principal rules can be put in this file in the Commissions Lookup directory,
+# in the same layout as PRINCIPAL_RULES, so that a new principal can be set up without a code change.
+PRINCIPAL_RULES_FILE = 'principalRules.json'
+MILLMAX_LOG_FILE = 'Mill-Max Invoice Log.xlsx'
+# The Mill-Max invoice index is kept for the session, plus a local copy that's reused until the log changes.
+MILLMAX_INDEX_CACHE = {}
+MILLMAX_INDEX_FILE = os.path.join(tempfile.gettempdir(), 'Mill-Max Invoice Index.pkl')
+
+# The special processing for each principal. Each principal can declare:
+#   renames -- Columns to rename before the Field Mappings are applied, optionally only on sheets matching a
+#              'sheets' regex. These would otherwise get looked up incorrectly.
+#   rules -- Sets of column operations (see apply_ops), optionally only on sheets matching a 'sheets' regex.
+#            Rules with 'stage': 'pre' run during pre-processing, everything else runs during processing.
+#   first_match -- Only use the first sheet-specific rule that matches the sheet (like an if/elif).
+#   unmatched_sheets -- Warning to give when the principal has sheet-specific rules and none of them match.
+RESALE = {'op': 'constant', 'column': 'Comm Source', 'value': 'Resale'}
+PAID_ON_INVOICED = {'op': 'copy', 'column': 'Paid-On Revenue', 'source': 'Invoiced Dollars'}
+GENERIC_RULES = {'rules': [{'ops': [PAID_ON_INVOICED, RESALE]}]}
+PRINCIPAL_RULES = {
+    'ABR': {
+        'rules': [
+            {'sheets': 'Adj', 'ops': [
+                # Input missing data. Commission Rate is always 3% here, and these are paid on resale.
+                {'op': 'constant', 'column': 'Commission Rate', 'value': 0.03},
+                {'op': 'scale', 'column': 'Paid-On Revenue', 'source': 'Invoiced Dollars', 'factor': 0.7},
+                {'op': 'scale', 'column': 'Actual Comm Paid', 'source': 'Paid-On Revenue', 'factor': 0.03,
+                 'log': 'Columns added from Abracon special processing: '
+                        'Commission Rate, Paid-On Revenue, Actual Comm Paid'},
+                RESALE]},
+            {'sheets': 'MoComm', 'ops': [
+                # Fill down Distributor for their grouping scheme.
+                {'op': 'fill_down', 'column': 'Reported Distributor'},
+                PAID_ON_INVOICED,
+                RESALE,
+                {'op': 'ratio', 'column': 'Commission Rate', 'numerator': 'Actual Comm Paid',
+                 'denominator': 'Paid-On Revenue', 'decimals': 3,
+                 'log': 'Columns added from Abracon special processing: Commission Rate'}]}],
+        'first_match': True,
+        'unmatched_sheets': 'Sheet not recognized! Make sure the tab name contains either MoComm or Adj in the '
+                            'name. Continuing without extra ABR processing.'},
+    'ATS': {
+        'renames': [{'columns': {'Resale': 'Extended Resale', 'Cost': 'Extended Cost'}}],
+        'rules': [{'ops': [
+            PAID_ON_INVOICED,
+            # Digikey and Mouser are paid on cost, not resale.
+            {'op': 'choose', 'column': 'Comm Source', 'source': 'Reported Distributor',
+             'contains': ['digi', 'mous'], 'then': 'Cost', 'else': 'Resale'}]}]},
+    'GLO': {
+        'rules': [{'ops': [
+            PAID_ON_INVOICED,
+            {'op': 'constant', 'column': 'Commission Rate', 'value': 0.05, 'if_missing': True},
+            {'op': 'scale', 'column': 'Actual Comm Paid', 'source': 'Paid-On Revenue', 'factor': 0.05,
+             'if_missing': True, 'stop_if_missing': True},
+            RESALE]}]},
+    'ISS': {
+        'renames': [{'columns': {'Commission Due': 'Unmapped', 'Name': 'OEM/POS'}}],
+        'rules': [{'ops': [{'op': 'custom', 'function': 'iss_oem_lines'}, RESALE]}]},
+    'MIL': {
+        'rules': [{'ops': [{'op': 'custom', 'function': 'millmax_paid_on'}]}]},
+    'OSR': {
+        'renames': [{'columns': {'Item': 'Unmapped', 'Material Number': 'Unmapped 2', 'Customer Name': 'Unmapped 3',
+                                 'Sales Date': 'Unmapped 4'}}],
+        'rules': [
+            {'stage': 'pre', 'ops': [
+                # Combine Rep 1 % and Rep 2 %.
+                {'op': 'copy_where_blank', 'column': 'Rep 1 %', 'source': 'Rep 2 %',
+                 'log': 'Copying Rep 2 % into empty Rep 1 % lines.'}]},
+            # For World Star POS tab, enter World Star as the distributor.
+            {'sheets': 'World', 'ops': [{'op': 'constant', 'column': 'Reported Distributor', 'value': 'World Star'}]},
+            {'ops': [PAID_ON_INVOICED, RESALE]}]},
+    'QRF': {
+        'renames': [{'sheets': '^(OEM|OFF)$', 'columns': {'End Customer': 'Unmapped 2', 'Item': 'Unmapped 3'}},
+                    {'sheets': '^POS$', 'columns': {'Company': 'Distributor', 'BillDocNo': 'Unmapped',
+                                                    'End Customer': 'Unmapped 2', 'Item': 'Unmapped 3'}}],
+        'rules': GENERIC_RULES['rules']},
+    'XMO': {
+        'renames': [{'columns': {'Amount': 'Commission', 'Commission Due': 'Unmapped'}}],
+        'rules': GENERIC_RULES['rules']},
+    'GAN': GENERIC_RULES,
+    'TRI': GENERIC_RULES,
+}
+
+
+def iss_oem_lines(sheet, sheet_name, disty_map):
+    """Deal with ISS OEM idiosyncrasies: the city is in Sales Region, and some customers are distributors."""
+    if 'OEM/POS' not in list(sheet):
+        return
+    oem = sheet['OEM/POS'].str.contains('OEM', regex=False).fillna(False).astype(bool)
+    # Put Sales Region into City.
+    sheet.loc[oem, 'City'] = sheet.loc[oem, 'Sales Region']
+    # Check for distributor in Customer, and copy it over if exactly one Distributor Abbreviation matches.
+    cust = sheet.loc[oem, 'Reported Customer']
+    dist_name = cust.astype(str).str.lower().str.replace('[^a-zA-Z0-9]', '', regex=True)
+    num_matches = np.zeros(len(dist_name), dtype=int)
+    for abbreviation in disty_map['Search Abbreviation'].astype(str):
+        num_matches += dist_name.str.contains(abbreviation, regex=False).to_numpy(dtype=int)
+    single_match = cust.index[num_matches == 1]
+    sheet.loc[single_match, 'Reported Distributor'] = cust[single_match]
+
+
+def millmax_paid_on(sheet, sheet_name, disty_map):
+    """Set up Mill-Max sheets, which are either paid on cost or need their part numbers looked up."""
+    invoice_dollars = 'Invoiced Dollars' in list(sheet)
+    ext_cost = 'Ext. Cost' in list(sheet)
+    invoice_num = 'Invoice Number' in list(sheet)
+    if not invoice_num:
+        logger.info('Found no Invoice Numbers on this sheet.')
+    if ext_cost and not invoice_dollars:
+        # Sometimes the Totals are written in the Part Number column.
+        sheet.drop(sheet[sheet['Part Number'] == 'Totals'].index, inplace=True)
+        sheet.reset_index(drop=True, inplace=True)
+        # These commissions are paid on cost.
+        sheet['Paid-On Revenue'] = sheet['Ext. Cost']
+        sheet['Comm Source'] = 'Cost'
+    elif 'Part Number' not in list(sheet) and invoice_num:
+        # We need the part number index from the invoice log.
+        invoice_index = load_millmax_index()
+        if invoice_index is None:
+            logger.warning('No Mill-Max Invoice Log found! Please make sure the Invoice Log is in the '
+                           'Commission Lookup directory. Skipping tab.')
+            return False
+        logger.info('Looking up part numbers from invoice log.')
+        # Input part number from Mill-Max Invoice Log. Invoices that aren't in the log exactly once aren't found.
+        invoices = sheet['Invoice Number']
+        has_invoice = invoices.astype(bool)
+        part_nums = invoices[has_invoice].map(invoice_index)
+        not_found = part_nums.isna()
+        sheet.loc[has_invoice, 'Part Number'] = part_nums.fillna('NOT FOUND')
+        if not_found.any():
+            logger.warning(f'{not_found.sum()} lines have invoices that are missing (or listed more than once) '
+                           'in the Mill-Max Invoice Log. Their Part Number is set to NOT FOUND.')
+        # These commissions are paid on resale.
+        sheet['Comm Source'] = 'Resale'
+
+
+def load_millmax_index():
+    """
+    Return the Mill-Max Invoice Log as a Series of Inv# --> Part Number, or None if there's no log.
+
+    Only invoices listed exactly once are included. The index is built once per session, and a local
+    copy is reused across sessions until the log's modified time changes.
+    """
+    log_path = os.path.join(DIRECTORIES.get('COMM_LOOKUPS_DIR'), MILLMAX_LOG_FILE)
+    if not os.path.exists(log_path):
+        return None
+    modified = os.path.getmtime(log_path)
+    if MILLMAX_INDEX_CACHE.get('key') == (log_path, modified):
+        return MILLMAX_INDEX_CACHE['index']
+    invoice_index = None
+    try:
+        with open(MILLMAX_INDEX_FILE, 'rb') as file:
+            cached = pickle.load(file)
+        if cached['path'] == log_path and cached['modified'] == modified:
+            invoice_index = cached['index']
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError):
+        pass
+    if invoice_index is None:
+        millmax_log = pd.read_excel(log_path, dtype=str).fillna('')
+        unique_invoice = ~millmax_log['Inv#'].duplicated(keep=False)
+        invoice_index = millmax_log.loc[unique_invoice].set_index('Inv#')['Part Number']
+        try:
+            with open(MILLMAX_INDEX_FILE, 'wb') as file:
+                pickle.dump({'path': log_path, 'modified': modified, 'index': invoice_index}, file)
+        except OSError:
+            logger.info('Could not save a local copy of the Mill-Max invoice index.')
+    MILLMAX_INDEX_CACHE.update({'key': (log_path, modified), 'index': invoice_index})
+    return invoice_index
+
+
+# Processing that's too involved to declare as column operations. These modify the sheet inplace,
+# and can return False to skip the rest of the processing for the sheet.
+CUSTOM_OPS = {'iss_oem_lines': iss_oem_lines, 'millmax_paid_on': millmax_paid_on}
+# The settings each column operation needs (see apply_ops).
+OP_SETTINGS = {'constant': ['column', 'value'], 'copy': ['column', 'source'], 'copy_where_blank': ['column', 'source'],
+               'fill_down': ['column'], 'scale': ['column', 'source', 'factor'],
+               'ratio': ['column', 'numerator', 'denominator'],
+               'choose': ['column', 'source', 'contains', 'then', 'else'], 'custom': ['function']}
+
+
+def check_principal_rules(processor):
+    """Return a description of the first problem with a principal's rules, or None if they look usable."""
+    if not isinstance(processor, dict):
+        return 'the entry is not a set of renames/rules'
+    entries = [('rename', i) for i in processor.get('renames', [])] + [('rule', i) for i in processor.get('rules', [])]
+    for kind, entry in entries:
+        if not isinstance(entry, dict):
+            return f'{kind} {entry!r} is not a set of settings'
+        try:
+            re.compile(entry.get('sheets', ''))
+        except (re.error, TypeError):
+            return f'{kind} has an invalid sheets pattern: {entry['sheets']!r}'
+        if kind == 'rename' and not isinstance(entry.get('columns'), dict):
+            return 'rename has no columns to rename'
+        if kind == 'rule' and not isinstance(entry.get('ops'), list):
+            return 'rule has no list of ops'
+    for op in [op for kind, entry in entries if kind == 'rule' for op in entry['ops']]:
+        if not isinstance(op, dict) or op.get('op') not in OP_SETTINGS:
+            return f'unknown operation: {op!r}'
+        missing = [i for i in OP_SETTINGS[op['op']] if i not in op]
+        if missing:
+            return f'{op['op']} operation is missing {', '.join(missing)}: {op!r}'
+        if op['op'] == 'custom' and op['function'] not in CUSTOM_OPS:
+            return f'unknown custom function: {op['function']!r}'
+    return None
+
+
+@lru_cache(maxsize=1)
+def load_principal_rules():
+    """
+    Return the principal rules, with any from the principalRules file overriding the built-in ones.
+
+    Principals in the file with rules that can't be run are left out (keeping any built-in rules for them).
+    """
+    rules = dict(PRINCIPAL_RULES)
+    rules_file = os.path.join(DIRECTORIES.get('COMM_LOOKUPS_DIR'), PRINCIPAL_RULES_FILE)
+    if os.path.exists(rules_file):
+        try:
+            with open(rules_file, 'r') as file:
+                file_rules = json.load(file)
+        except (ValueError, OSError) as error:
+            logger.error(f'Error reading {PRINCIPAL_RULES_FILE}, using the built-in principal rules only: {error}')
+            return rules
+        if not isinstance(file_rules, dict):
+            logger.error(f'{PRINCIPAL_RULES_FILE} is not laid out by principal, using the built-in principal rules only.')
+            return rules
+        for principal, processor in file_rules.items():
+            problem = check_principal_rules(processor)
+            if problem:
+                logger.error(f'Skipping the {principal} rules in {PRINCIPAL_RULES_FILE}, since {problem}')
+                continue
+            rules[principal] = processor
+        logger.info(f'Loaded principal rules from {PRINCIPAL_RULES_FILE}.')
+    return rules
+
+
+def matches_sheet(entry, sheet_name):
+    """Check if a rename/rule entry applies to this sheet."""
+    return 'sheets' not in entry or re.search(entry['sheets'], sheet_name) is not None
+
+
+def apply_ops(sheet, ops, sheet_name, disty_map):
+    """
+    Run a list of column operations over a sheet in a single pass.
+
+    Operations are dicts with an 'op', the 'column' to set, and the settings for that op:
+        constant -- Set to 'value'.
+        copy -- Copy the 'source' column.
+        copy_where_blank -- Copy the 'source' column into blank cells of the column.
+        fill_down -- Fill blank cells with the value above.
+        scale -- The 'source' column times 'factor'.
+        ratio -- 'numerator' column / 'denominator' column, rounded to 'decimals'.
+        choose -- 'then' where the 'source' column contains any of the 'contains' text, otherwise 'else'.
+        custom -- Run the named 'function' from CUSTOM_OPS.
+    Adding 'if_missing': true only sets the column if it isn't already there, and 'log' is noted when
+    the op runs. Ops are skipped (with a note) when the columns they read aren't on the sheet, or with
+    'stop_if_missing': true, the rest of the ops are skipped too (with a warning).
+
+    Ops run in the order listed. Each reads from the columns computed so far, and the changed columns are
+    written back to the sheet together, either at the end or before a custom op (which works directly
+    on the sheet).
+    This function modifies a dataframe inplace.
+    """
+    new_columns = {}
+
+    def has(name):
+        return name in new_columns or name in sheet.columns
+
+    def column(name):
+        return new_columns[name] if name in new_columns else sheet[name]
+
+    for op in ops:
+        if op['op'] == 'custom':
+            for col, values in new_columns.items():
+                sheet[col] = values
+            new_columns.clear()
+            if CUSTOM_OPS[op['function']](sheet, sheet_name, disty_map) is False:
+                return
+            continue
+        target = op['column']
+        if op.get('if_missing') and has(target):
+            continue
+        required = [op[i] for i in ('source', 'numerator', 'denominator') if i in op]
+        if op['op'] in ('copy_where_blank', 'fill_down'):
+            required.append(target)
+        missing = [i for i in required if not has(i)]
+        if missing:
+            if op.get('stop_if_missing'):
+                logger.warning(f'No {', '.join(missing)} found on this sheet, could not calculate {target}. '
+                               'Skipping the rest of the special processing for this sheet.')
+                break
+            logger.info(f'No {', '.join(missing)} found on this sheet, so {target} was not filled in.')
+            continue
+        match op['op']:
+            case 'constant':
+                values = pd.Series(op['value'], index=sheet.index)
+            case 'copy':
+                values = column(op['source'])
+            case 'copy_where_blank':
+                source = column(op['source'])
+                values = column(target).where(~source.astype(bool) | column(target).astype(bool), source)
+            case 'fill_down':
+                values = column(target).replace('', np.nan).ffill().fillna('')
+            case 'scale':
+                values = pd.to_numeric(column(op['source']), errors='coerce') * op['factor']
+            case 'ratio':
+                numerator = pd.to_numeric(column(op['numerator']), errors='coerce')
+                denominator = pd.to_numeric(column(op['denominator']), errors='coerce')
+                values = round(numerator / denominator, op.get('decimals', 3))
+            case 'choose':
+                source = column(op['source']).astype(str).str.lower()
+                chosen = np.zeros(len(source), dtype=bool)
+                for text in op['contains']:
+                    chosen |= source.str.contains(text.lower(), regex=False).to_numpy()
+                values = pd.Series(np.where(chosen, op['then'], op['else']), index=sheet.index)
+            case _:
+                logger.warning(f'Unknown principal rule operation: {op['op']}')
+                continue
+        new_columns[target] = values
+        if 'log' in op:
+            logger.info(op['log'])
+
+    for col, values in new_columns.items():
+        sheet[col] = values
+
 
 def preprocess_by_principal(principal, sheet, sheet_name):
     """
@@ -15,47 +343,21 @@ def preprocess_by_principal(principal, sheet, sheet_name):
 
     This function modifies a dataframe inplace.
     """
-    # Initialize the rename_dict in case it doesn't get set by any matching principal.
+    processor = load_principal_rules().get(principal, {})
     rename_dict = {}
-
-    match principal:
-        case 'OSR':
-            rename_dict = {'Item': 'Unmapped', 'Material Number': 'Unmapped 2', 'Customer Name': 'Unmapped 3',
-                           'Sales Date': 'Unmapped 4'}
-            sheet.rename(columns=rename_dict, inplace=True)
-            # Combine Rep 1 % and Rep 2 %.
-            if 'Rep 1 %' in list(sheet) and 'Rep 2 %' in list(sheet):
-                logger.info('Copying Rep 2 % into empty Rep 1 % lines.')
-                for row in sheet.index:
-                    if sheet.loc[row, 'Rep 2 %'] and not sheet.loc[row, 'Rep 1 %']:
-                        sheet.loc[row, 'Rep 1 %'] = sheet.loc[row, 'Rep 2 %']
-
-        case 'ISS':
-            rename_dict = {'Commission Due': 'Unmapped', 'Name': 'OEM/POS'}
-            sheet.rename(columns=rename_dict, inplace=True)
-
-        case 'ATS':
-            rename_dict = {'Resale': 'Extended Resale', 'Cost': 'Extended Cost'}
-            sheet.rename(columns=rename_dict, inplace=True)
-
-        case 'QRF':
-            if sheet_name in ['OEM', 'OFF']:
-                rename_dict = {'End Customer': 'Unmapped 2', 'Item': 'Unmapped 3'}
-                sheet.rename(columns=rename_dict, inplace=True)
-            elif sheet_name == 'POS':
-                rename_dict = {'Company': 'Distributor', 'BillDocNo': 'Unmapped',
-                               'End Customer': 'Unmapped 2', 'Item': 'Unmapped 3'}
-                sheet.rename(columns=rename_dict, inplace=True)
-
-        case 'XMO':
-            rename_dict = {'Amount': 'Commission', 'Commission Due': 'Unmapped'}
-            sheet.rename(columns=rename_dict, inplace=True)
-
-    # Return the rename_dict for future use in the matched raw file.
+    for entry in processor.get('renames', []):
+        if matches_sheet(entry, sheet_name):
+            rename_dict.update(entry['columns'])
     if rename_dict:
+        sheet.rename(columns=rename_dict, inplace=True)
         logger.info(f'The following columns were renamed automatically on this sheet ({principal}):\n'
                     f'{', '.join([f'{i} --> {j}' for i, j in zip(rename_dict.keys(), rename_dict.values())])}')
 
+    ops = [op for rule in processor.get('rules', []) if rule.get('stage') == 'pre' and matches_sheet(rule, sheet_name)
+           for op in rule['ops']]
+    if ops:
+        apply_ops(sheet, ops, sheet_name, disty_map=None)
+
 
 def process_by_principal(principal, sheet, sheet_name, disty_map):
     """
@@ -66,151 +368,20 @@ def process_by_principal(principal, sheet, sheet_name, disty_map):
     This function modifies a dataframe inplace.
     """
     # Make sure applicable entries exist and are numeric.
-    invoice_dollars = ext_cost = True
-    try:
-        sheet['Invoiced Dollars'] = pd.to_numeric(sheet['Invoiced Dollars'], errors='coerce').fillna(0)
-    except KeyError:
-        invoice_dollars = False
-    try:
-        sheet['Ext. Cost'] = pd.to_numeric(sheet['Ext. Cost'], errors='coerce').fillna(0)
-    except KeyError:
-        ext_cost = False
-
-    match principal:
-        case 'ABR':
-            # Use the sheet names to figure out what processing needs to be done.
-            if 'Adj' in sheet_name:
-                # Input missing data. Commission Rate is always 3% here.
-                sheet['Commission Rate'] = 0.03
-                sheet['Paid-On Revenue'] = pd.to_numeric(sheet['Invoiced Dollars'], errors='coerce') * 0.7
-                sheet['Actual Comm Paid'] = sheet['Paid-On Revenue'] * 0.03
-                # These are paid on resale.
-                sheet['Comm Source'] = 'Resale'
-                logger.info('Columns added from Abracon special processing:'
-                            'Commission Rate, Paid-On Revenue, Actual Comm Paid')
-            elif 'MoComm' in sheet_name:
-                # Fill down Distributor for their grouping scheme.
-                sheet['Reported Distributor'].replace('', np.nan, inplace=True)
-                sheet['Reported Distributor'].fillna(method='ffill', inplace=True)
-                sheet['Reported Distributor'].fillna('', inplace=True)
-                # Paid-On Revenue gets Invoiced Dollars.
-                sheet['Paid-On Revenue'] = sheet['Invoiced Dollars']
-                sheet['Comm Source'] = 'Resale'
-                # Calculate the Commission Rate.
-                comm_paid = pd.to_numeric(sheet['Actual Comm Paid'], errors='coerce')
-                revenue = pd.to_numeric(sheet['Paid-On Revenue'], errors='coerce')
-                comm_rate = round(comm_paid / revenue, 3)
-                sheet['Commission Rate'] = comm_rate
-                logger.info('Columns added from Abracon special processing: Commission Rate')
-            else:
-                logger.warning('Sheet not recognized! Make sure the tab name contains either MoComm or Adj in the name.'
-                               'Continuing without extra ABR processing.')
-
-        case 'ISS':
-            if 'OEM/POS' in list(sheet):
-                for row in sheet.index:
-                    # Deal with OEM idiosyncrasies.
-                    if 'OEM' in sheet.loc[row, 'OEM/POS']:
-                        # Put Sales Region into City.
-                        sheet.loc[row, 'City'] = sheet.loc[row, 'Sales Region']
-                        # Check for distributor in Customer
-                        cust = sheet.loc[row, 'Reported Customer']
-                        dist_name = re.sub(pattern='[^a-zA-Z0-9]', repl='', string=str(cust).lower())
-                        # Find matches in the Distributor Abbreviations.
-                        dist_matches = [i for i in disty_map['Search Abbreviation']
-                                        if i in dist_name]
-                        if len(dist_matches) == 1:
-                            # Copy to distributor column.
-                            try:
-                                sheet.loc[row, 'Reported Distributor'] = cust
-                            except KeyError:
-                                pass
-            sheet['Comm Source'] = 'Resale'
-
-        case 'ATS':
-            # Try setting the Paid-On Revenue as the Invoiced Dollars.
-            try:
-                sheet['Paid-On Revenue'] = sheet['Invoiced Dollars']
-            except KeyError:
-                pass
-            # Try setting the cost/resale by the distributor.
-            try:
-                for row in sheet.index:
-                    dist = str(sheet.loc[row, 'Reported Distributor']).lower()
-                    # Digikey and Mouser are paid on cost, not resale.
-                    if 'digi' in dist or 'mous' in dist:
-                        sheet.loc[row, 'Comm Source'] = 'Cost'
-                    else:
-                        sheet.loc[row, 'Comm Source'] = 'Resale'
-            except KeyError:
-                pass
-
-        case 'MIL':
-            invoice_num = True
-            try:
-                sheet['Invoice Number']
-            except KeyError:
-                logger.info('Found no Invoice Numbers on this sheet.')
-                invoice_num = False
-            if ext_cost and not invoice_dollars:
-                # Sometimes the Totals are written in the Part Number column.
-                sheet.drop(sheet[sheet['Part Number'] == 'Totals'].index, inplace=True)
-                sheet.reset_index(drop=True, inplace=True)
-                # These commissions are paid on cost.
-                sheet['Paid-On Revenue'] = sheet['Ext. Cost']
-                sheet['Comm Source'] = 'Cost'
-            elif 'Part Number' not in list(sheet) and invoice_num:
-                # We need to load in the part number log.
-                if os.path.exists(os.path.join(DIRECTORIES.get('COMM_LOOKUPS_DIR'), 'Mill-Max Invoice Log.xlsx')):
-                    millmax_log = pd.read_excel(os.path.join(DIRECTORIES.get('COMM_LOOKUPS_DIR'),
-                                                             'Mill-Max Invoice Log.xlsx'), dtype=str)
-                    millmax_log = millmax_log.fillna('')
-                    logger.info('Looking up part numbers from invoice log.')
-                else:
-                    logger.warning('No Mill-Max Invoice Log found! Please make sure the Invoice Log is in the '
-                                   'Commission Lookup directory. Skipping tab.')
-                    return
-                # Input part number from Mill-Max Invoice Log.
-                for row in sheet.index:
-                    if sheet.loc[row, 'Invoice Number']:
-                        matches = millmax_log['Inv#'] == sheet.loc[row, 'Invoice Number']
-                        if sum(matches) == 1:
-                            part_num = millmax_log[matches].iloc[0]['Part Number']
-                            sheet.loc[row, 'Part Number'] = part_num
-                        else:
-                            sheet.loc[row, 'Part Number'] = 'NOT FOUND'
-                # These commissions are paid on resale.
-                sheet['Comm Source'] = 'Resale'
-
-        case 'OSR':
-            # For World Star POS tab, enter World Star as the distributor.
-            if 'World' in sheet_name:
-                sheet['Reported Distributor'] = 'World Star'
-            try:
-                sheet['Paid-On Revenue'] = sheet['Invoiced Dollars']
-            except KeyError:
-                pass
-            sheet['Comm Source'] = 'Resale'
-
-        case 'GLO':
-            try:
-                sheet['Paid-On Revenue'] = sheet['Invoiced Dollars']
-            except KeyError:
-                logger.info('No Invoiced Dollars found on this sheet!')
-            if 'Commission Rate' not in sheet.columns:
-                sheet['Commission Rate'] = 0.05
-            if 'Actual Comm Paid' not in sheet.columns:
-                try:
-                    sheet['Actual Comm Paid'] = sheet['Paid-On Revenue'] * 0.05
-                except KeyError:
-                    logger.warning('No Paid-On Revenue found, could not calculate Actual Comm Paid.')
-                    return
-            sheet['Comm Source'] = 'Resale'
-
-    # Generic special processing for a few principals.
-    if principal in ['QRF', 'GAN', 'XMO', 'TRI']:
-        try:
-            sheet['Paid-On Revenue'] = sheet['Invoiced Dollars']
-        except KeyError:
-            pass
-        sheet['Comm Source'] = 'Resale'
+    for col in ['Invoiced Dollars', 'Ext. Cost']:
+        if col in list(sheet):
+            sheet[col] = pd.to_numeric(sheet[col], errors='coerce').fillna(0)
+
+    processor = load_principal_rules().get(principal, {})
+    rules = [rule for rule in processor.get('rules', []) if rule.get('stage') != 'pre']
+    matched = [rule for rule in rules if matches_sheet(rule, sheet_name)]
+    if processor.get('first_match'):
+        # Keep just the first of the sheet-specific rules that matched.
+        sheet_rules = [rule for rule in matched if 'sheets' in rule]
+        matched = [rule for rule in matched if 'sheets' not in rule or rule is sheet_rules[0]]
+    if 'unmatched_sheets' in processor and not any('sheets' in rule for rule in matched):
+        logger.warning(processor['unmatched_sheets'])
+        return
+    ops = [op for rule in matched for op in rule['ops']]
+    if ops:
+        apply_ops(sheet, ops, sheet_name, disty_map)
@@ -1,97 +1,114 @@
-import pandas as pd
-import math
+import os
+import logging
+import datetime
+import numpy as np
 from dateutil.parser import parse
-from RCExcelTools import tableFormat, formDate, saveError
-from xlrd import XLRDError
-
-
-# The main function.
-def main(runCom):
-    """Generates quarterly reports, then marks lines as paid."""
-    # Set the directory for the data input/output.
-    dataDir = 'Z:/MK Working Commissions/'
+import GenerateMasterUtils as Utils
+from RCExcelTools import check_file_locks, describe_file_locks
+from BackupManager import snapshot_file
+from FileIO import load_salespeople_info, load_com_master
+from SalesReportGenerator import (get_quarter_months, sales_principal_totals, quarterly_report_tabs,
+                                  get_quarterly_report_path, save_quarterly_files)
+
+logger = logging.getLogger(__name__)
+
+
+def last_finished_quarter(year, month):
+    """Returns the (year, quarter) of the most recent quarter that's finished as of the given Comm Month."""
+    quarter = month // 3
+    if quarter == 0:
+        return year - 1, 4
+    return year, quarter
+
+
+def get_quarter_rows(month_index, quarter_months):
+    """Look up the row positions of the quarter's Comm Months in the Comm Month index, in file order."""
+    rows = [month_index[i] for i in quarter_months if i in month_index]
+    return np.sort(np.concatenate(rows)) if rows else np.array([], dtype=int)
+
+
+def main():
+    """
+    Generates the quarterly report and PDF statements for the most recent finished quarter in the
+    Commissions Master, then marks its lines as paid.
+
+    The report and the updated Commissions Master are saved together, so either both get written or
+    neither does.
+    """
+    filepath_CM = os.path.join(Utils.DIRECTORIES.get('COMM_WORKING_DIR'), 'Commissions Master.xlsx')
+    locks = check_file_locks(filepath_CM)
+    if locks:
+        logger.error(f'The following files are currently open:\n{describe_file_locks(locks)}\n'
+                     'Please close these files and try again.\n*Program Terminated*')
+        return
 
-    print('Loading the data from Commissions Master...')
+    logger.info('Loading the data from Commissions Master...')
+    sales_info = load_salespeople_info()
+    # The whole Master gets loaded, since it's rewritten with the new Paid Dates.
+    com_mast, master_files = load_com_master()
+    if any([sales_info.empty, com_mast.empty, master_files.empty]):
+        logger.error('Error loading files.\n*Program Terminated*')
+        return
 
-    # ---------------------------------------------
-    # Load and prepare the Commissions Master file.
-    # ---------------------------------------------
-    # Load up the current Commissions Master file from the server.
+    # --------------------------------------
+    # Find the most recent finished quarter.
+    # --------------------------------------
+    month_index = Utils.build_comm_month_index(com_mast)
     try:
-        comMast = pd.read_excel(dataDir + 'Commissions Master.xlsx', 'Master',
-                                dtype=str)
-        masterFiles = pd.read_excel(dataDir + 'Commissions Master.xlsx',
-                                    'Files Processed').fillna('')
-    except FileNotFoundError:
-        print('No Commissions Master file found!\n'
-              '***')
+        comm_months = [parse(i) for i in month_index if i != '']
+    except ValueError:
+        logger.error('Error parsing dates in Comm Month column of Commissions Master! '
+                     'Please check that all dates are in standard formatting and try again.\n*Program Terminated*')
         return
-    except XLRDError:
-        print('Commissions Master tab names incorrect!\n'
-              'Make sure the tabs are named Master and Files Processed.\n'
-              '***')
+    if not comm_months:
+        logger.error('No Comm Months found in the Commissions Master.\n*Program Terminated*')
         return
-    # Convert applicable columns to numeric.
-    numCols = ['Quantity', 'Ext. Cost', 'Invoiced Dollars', 'Paid-On Revenue',
-               'Actual Comm Paid', 'Unit Cost', 'Unit Price', 'CM Split',
-               'Year', 'Sales Commission', 'Split Percentage',
-               'Commission Rate', 'Gross Rev Reduction',
-               'Shared Rev Tier Rate']
-    for col in numCols:
-        try:
-            comMast[col] = pd.to_numeric(comMast[col],
-                                         errors='coerce').fillna(0)
-        except KeyError:
-            pass
-    # Convert individual numbers to numeric in rest of columns.
-    mixedCols = [col for col in list(comMast) if col not in numCols]
-    # Invoice/part numbers sometimes has leading zeros we'd like to keep.
-    mixedCols.remove('Invoice Number')
-    mixedCols.remove('Part Number')
-    # The INF gets read in as infinity, so skip the principal column.
-    mixedCols.remove('Principal')
-    for col in mixedCols:
-        comMast[col] = comMast[col].map(
-                lambda x: pd.to_numeric(x, errors='ignore'))
-    # Now remove the nans.
-    comMast.replace('nan', '', inplace=True)
-
-    # Make sure all the dates are formatted correctly.
-    for col in ['Invoice Date', 'Paid Date', 'Sales Report Date']:
-        comMast[col] = comMast[col].map(lambda x: formDate(x))
-    # Make sure that the CM Splits aren't blank or zero.
-    comMast['CM Split'] = comMast['CM Split'].replace(['', '0', 0], 20)
-
-    # -------------------------------------------------
-    # Filter down data to most recent finished quarter.
-    # -------------------------------------------------
-    # Determine the commissions months that are currently in the Master.
-    commMonths = comMast['Comm Month'].unique()
-    try:
-        commMonths = [parse(str(i)) for i in commMonths if i != '']
-    except ValueError:
-        print('Error parsing dates in Comm Month column of Commissions Master!'
-              '\nPlease check that all dates are in standard formatting and '
-              'try again.\n***')
+    last_month = max(comm_months)
+    year, quarter = last_finished_quarter(last_month.year, last_month.month)
+    comm_qtr = f'{year}Q{quarter}'
+    quarter_months = get_quarter_months(year, quarter * 3)
+    logger.info(f'Most recent finished quarter detected as {comm_qtr} (Comm Months {', '.join(quarter_months)}).')
+
+    filepath_report = get_quarterly_report_path(comm_qtr)
+    locks = check_file_locks(filepath_report)
+    if locks:
+        logger.error(f'The following files are currently open:\n{describe_file_locks(locks)}\n'
+                     'Please close these files and try again.\n*Program Terminated*')
         return
-    # Grab the most recent month in Commissions Master
-    lastMonth = max(commMonths)
-    # Find the most recent finished quarter.
-    quarter = math.floor(int(lastMonth[-1:])/3)
-    print('Most recent quarter detected as Q' + str(quarter)
-          + '\n---')
-    # Find months in quarter.
-    monthsInQtr = [lastMonth[:-1] + str(quarter*3 - i) for i in [0, 1, 2]]
-    # Grab the data for the current quarter.
-    qtrCom = comMast[comMast['Comm Month'].isin(monthsInQtr)]
-    
-
-
-
-
-
-
-
 
+    # --------------------------------------------------------------
+    # Slice out the quarter through the Comm Month index and report.
+    # --------------------------------------------------------------
+    quarter_rows = get_quarter_rows(month_index, quarter_months)
+    if not quarter_rows.size:
+        logger.error(f'No lines found in the Commissions Master for {comm_qtr}.\n*Program Terminated*')
+        return
+    comm_data = com_mast.iloc[quarter_rows].reset_index(drop=True)
+    salespeople = sorted(sales_info['Sales Initials'].values)
+    totals = sales_principal_totals(comm_data, sales_info, salespeople)
+    report_tabs = quarterly_report_tabs(comm_data, totals, salespeople)
+
+    # -------------------------------------------------------------------
+    # Mark the quarter's lines as paid (keeping any existing Paid Dates).
+    # -------------------------------------------------------------------
+    in_quarter = np.zeros(len(com_mast), dtype=bool)
+    in_quarter[quarter_rows] = True
+    unpaid = in_quarter & (com_mast['Paid Date'] == '').to_numpy()
+    com_mast.loc[unpaid, 'Paid Date'] = datetime.date.today()
+    logger.info(f'Marking {unpaid.sum()} of {quarter_rows.size} lines in {comm_qtr} as paid.')
+
+    # ---------------
+    # Save the files.
+    # ---------------
+    snapshot_file(filepath_CM)
+    files = {filepath_report: report_tabs,
+             filepath_CM: ([com_mast, master_files], ['Master', 'Files Processed'])}
+    if not save_quarterly_files(files, totals, comm_qtr, salespeople, sales_info):
+        logger.error('Error saving files! No files were changed.\n*Program Terminated*')
+        return
+    logger.info(f'Quarterly report saved as: {filepath_report}\nCommissions Master updated.\n+Program Complete+')
 
 
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    main()
@@ -1,9 +1,13 @@
 import pandas as pd
+import numpy as np
 import os
+import numbers
+import datetime
 import sys
 import re
 import shutil
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from dateutil.parser import parse
 import win32com.client
 import pythoncom
@@ -75,38 +79,46 @@ class PivotTables:
         wb.Close(SaveChanges=1)
 
 
-def table_format(sheet_data, sheet_name, workbook):
-    """Formats the Excel output as a table with correct column formatting."""
-    # Nothing to format, so return.
-    if sheet_data.shape[0] == 0:
-        return
-    sheet = workbook.sheets[sheet_name]
-    sheet.freeze_panes(1, 0)
+# Tabs with at least this many rows get streamed out with XlsxWriter's constant_memory mode.
+CONSTANT_MEMORY_MIN_ROWS = 100000
+# Rows converted at a time when streaming a tab out.
+STREAMING_BATCH_ROWS = 10000
+# Columns that keep their leading zeros.
+PADDED_COLUMNS = ['Invoice Number', 'Part Number']
+
+
+def get_column_formats(sheet_data, sheet_name, book):
+    """
+    Work out the width and format of each column for table formatting.
+
+    Returns a list of (width, format) for each column, with (None, None) for the columns in PADDED_COLUMNS,
+    which get formatted cell by cell.
+    """
     # Set default document format.
-    doc_format = workbook.book.add_format({'font': 'Calibri', 'font_size': 11})
+    doc_format = book.add_format({'font': 'Calibri', 'font_size': 11})
     # Currency format ($XX.XX).
-    acct_format = workbook.book.add_format({'font': 'Calibri', 'font_size': 11, 'num_format': 7})
+    acct_format = book.add_format({'font': 'Calibri', 'font_size': 11, 'num_format': 7})
     # Comma format (XX,XXX).
-    comma_format = workbook.book.add_format({'font': 'Calibri', 'font_size': 11, 'num_format': 3})
+    comma_format = book.add_format({'font': 'Calibri', 'font_size': 11, 'num_format': 3})
     # Percent format, one decimal (XX.X%).
-    pct_format = workbook.book.add_format({'font': 'Calibri', 'font_size': 11, 'num_format': '0.0%'})
+    pct_format = book.add_format({'font': 'Calibri', 'font_size': 11, 'num_format': '0.0%'})
     # Date format (YYYY-MM-DD).
-    date_format = workbook.book.add_format({'font': 'Calibri', 'font_size': 11, 'num_format': 14})
-    # Format and fit each column.
-    for index, col in enumerate(sheet_data.columns):
-        # Match the correct formatting to each column.
-        acct_cols = ['Unit Price', 'Paid-On Revenue', 'Actual Comm Paid', 'Total NDS', 'Post-Split NDS',
-                     'Cust Revenue YTD', 'Ext. Cost', 'Unit Cost', 'Total Commissions',
-                     'Sales Commission', 'Invoiced Dollars', 'CM Sales Comm', 'Design Sales Comm']
-        pct_cols = ['Split Percentage', 'Commission Rate', 'Gross Rev Reduction', 'Shared Rev Tier Rate',
-                    'True Comm %', 'Comm Pct']
-        core_cols = ['CM Sales', 'Design Sales', 'T-End Cust', 'T-Name', 'CM', 'Invoice Date']
-        date_cols = ['Invoice Date', 'Paid Date', 'Sales Report Date', 'Date Added']
-        hide_cols = ['Quarter Shipped', 'Month', 'Year', 'Reported Distributor', 'PO Number', 'Sales Order #',
-                     'Unit Cost', 'Unit Price', 'Comm Source', 'On/Offshore', 'INF Comm Type', 'PL',
-                     'Division', 'Gross Rev Reduction', 'Project', 'Product Category', 'Shared Rev Tier Rate',
-                     'Cust Revenue YTD', 'Total NDS', 'Post-Split NDS', 'Cust Part Number', 'End Market',
-                     'Q Number', 'CM Split', 'Zip Code']
+    date_format = book.add_format({'font': 'Calibri', 'font_size': 11, 'num_format': 14})
+    # Match the correct formatting to each column.
+    acct_cols = ['Unit Price', 'Paid-On Revenue', 'Actual Comm Paid', 'Total NDS', 'Post-Split NDS',
+                 'Cust Revenue YTD', 'Ext. Cost', 'Unit Cost', 'Total Commissions',
+                 'Sales Commission', 'Invoiced Dollars', 'CM Sales Comm', 'Design Sales Comm']
+    pct_cols = ['Split Percentage', 'Commission Rate', 'Gross Rev Reduction', 'Shared Rev Tier Rate',
+                'True Comm %', 'Comm Pct']
+    core_cols = ['CM Sales', 'Design Sales', 'T-End Cust', 'T-Name', 'CM', 'Invoice Date']
+    date_cols = ['Invoice Date', 'Paid Date', 'Sales Report Date', 'Date Added']
+    hide_cols = ['Quarter Shipped', 'Month', 'Year', 'Reported Distributor', 'PO Number', 'Sales Order #',
+                 'Unit Cost', 'Unit Price', 'Comm Source', 'On/Offshore', 'INF Comm Type', 'PL',
+                 'Division', 'Gross Rev Reduction', 'Project', 'Product Category', 'Shared Rev Tier Rate',
+                 'Cust Revenue YTD', 'Total NDS', 'Post-Split NDS', 'Cust Part Number', 'End Market',
+                 'Q Number', 'CM Split', 'Zip Code']
+    column_formats = []
+    for col in sheet_data.columns:
         if col in acct_cols:
             formatting = acct_format
         elif col in pct_cols:
@@ -115,24 +127,8 @@ def table_format(sheet_data, sheet_name, workbook):
             formatting = date_format
         elif col == 'Quantity':
             formatting = comma_format
-        elif col in ['Invoice Number', 'Part Number']:
-            # We're going to do some work in order to keep leading zeros.
-            for row in sheet_data.index:
-                inv_len = len(str(sheet_data.loc[row, col]))
-                # Figure out how many places the number goes to.
-                num_padding = '0' * inv_len
-                inv_num = pd.to_numeric(sheet_data.loc[row, col], errors='ignore')
-                # The only way to continually preserve leading zeros is by
-                # adding the apostrophe label tag in front.
-                if len(num_padding) > len(str(inv_num)):
-                    inv_num = f"'{inv_num}"
-                inv_format = workbook.book.add_format({'font': 'Calibri', 'font_size': 11,
-                                                       'num_format': num_padding})
-                try:
-                    sheet.write_number(row+1, index, inv_num, inv_format)
-                except TypeError:
-                    pass
-            # Move to the next column.
+        elif col in PADDED_COLUMNS:
+            column_formats.append((None, None))
             continue
         else:
             formatting = doc_format
@@ -151,21 +147,187 @@ def table_format(sheet_data, sheet_name, workbook):
         # Extra space for '$'/'%' in accounting/percent format.
         if (col in acct_cols or col in pct_cols) and col not in hide_cols:
             max_width += 2
-        sheet.set_column(index, index, max_width+0.8, formatting)
+        column_formats.append((max_width + 0.8, formatting))
+    return column_formats
+
+
+class PaddedFormats:
+    """Number formats that keep leading zeros (e.g. 000000 for a six digit invoice), made once per width."""
+
+    def __init__(self, book):
+        self.book = book
+        self.formats = {}
+
+    def get(self, width):
+        if width not in self.formats:
+            self.formats[width] = self.book.add_format({'font': 'Calibri', 'font_size': 11,
+                                                        'num_format': '0' * width})
+        return self.formats[width]
+
+
+def table_format(sheet_data, sheet_name, workbook):
+    """Formats the Excel output as a table with correct column formatting."""
+    # Nothing to format, so return.
+    if sheet_data.shape[0] == 0:
+        return
+    sheet = workbook.sheets[sheet_name]
+    sheet.freeze_panes(1, 0)
+    padded_formats = PaddedFormats(workbook.book)
+    # Format and fit each column.
+    for index, (col, (width, formatting)) in enumerate(zip(sheet_data.columns,
+                                                           get_column_formats(sheet_data, sheet_name, workbook.book))):
+        if col in PADDED_COLUMNS:
+            # We're going to do some work in order to keep leading zeros.
+            for row in sheet_data.index:
+                inv_len = len(str(sheet_data.loc[row, col]))
+                inv_num = pd.to_numeric(sheet_data.loc[row, col], errors='ignore')
+                # The only way to continually preserve leading zeros is by
+                # adding the apostrophe label tag in front.
+                if inv_len > len(str(inv_num)):
+                    inv_num = f"'{inv_num}"
+                try:
+                    sheet.write_number(row+1, index, inv_num, padded_formats.get(inv_len))
+                except TypeError:
+                    pass
+            continue
+        sheet.set_column(index, index, width, formatting)
     # Set the auto-filter for the sheet.
     sheet.autofilter(0, 0, sheet_data.shape[0], sheet_data.shape[1] - 1)
 
 
-def save_error(*excel_files):
-    """Check Excel files and return True if any file is open."""
-    for file in excel_files:
+def write_sheet(writer, data, sheet_name):
+    """Write a tab and format it as a table, streaming it out if the workbook is in constant_memory mode."""
+    if getattr(writer.book, 'constant_memory', False):
+        write_sheet_streaming(writer, data, sheet_name)
+    else:
+        data.to_excel(writer, sheet_name=sheet_name, index=False)
+        table_format(sheet_data=data, sheet_name=sheet_name, workbook=writer)
+
+
+def write_sheet_streaming(writer, data, sheet_name):
+    """
+    Write a tab row by row, for workbooks opened in XlsxWriter's constant_memory mode.
+
+    Produces the same table formatting as to_excel followed by table_format, but each column gets a
+    cell writer picked up front from its type, so cells skip the generic type dispatch, and only one
+    row at a time is held by XlsxWriter.
+    """
+    book = writer.book
+    sheet = book.add_worksheet(sheet_name)
+    header_format = book.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    for index, col in enumerate(data.columns):
+        sheet.write_string(0, index, str(col), header_format)
+    if data.shape[0] == 0:
+        return
+    sheet.freeze_panes(1, 0)
+    sheet.autofilter(0, 0, data.shape[0], data.shape[1] - 1)
+    # Column formats need to be set before any rows are written.
+    column_formats = get_column_formats(data, sheet_name, book)
+    for index, (width, formatting) in enumerate(column_formats):
+        if formatting is not None:
+            sheet.set_column(index, index, width, formatting)
+    # Same date formats as pandas uses for the ExcelWriter.
+    date_format = book.add_format({'num_format': 'YYYY-MM-DD'})
+    datetime_format = book.add_format({'num_format': 'mm/dd/yyyy'})
+    padded_formats = PaddedFormats(book)
+
+    def write_number(row, col, value):
+        # Nullable (Int64/Float64) columns hold pd.NA for blanks, which can't be compared.
+        if not pd.isna(value):
+            sheet.write_number(row, col, value)
+
+    def write_mixed(row, col, value):
+        if isinstance(value, str):
+            if value:
+                sheet.write_string(row, col, value)
+        elif isinstance(value, (bool, np.bool_)):
+            sheet.write_boolean(row, col, bool(value))
+        elif isinstance(value, numbers.Number):
+            if value == value:
+                sheet.write_number(row, col, value)
+        elif isinstance(value, datetime.datetime):
+            sheet.write_datetime(row, col, value, datetime_format)
+        elif isinstance(value, datetime.date):
+            sheet.write_datetime(row, col, value, date_format)
+        elif value is not None and value is not pd.NaT and value is not pd.NA:
+            sheet.write_string(row, col, str(value))
+
+    def write_padded(row, col, value):
+        # Write whole numbers as numbers padded out to their full width, and anything with leading zeros as text.
+        text = str(value)
+        if text.isdigit() and (text[0] != '0' or text == '0'):
+            sheet.write_number(row, col, int(text), padded_formats.get(len(text)))
+        else:
+            write_mixed(row, col, value)
+
+    cell_writers = []
+    for col, (width, formatting) in zip(data.columns, column_formats):
+        if formatting is None:
+            cell_writers.append(write_padded)
+        elif pd.api.types.is_numeric_dtype(data[col]) and not pd.api.types.is_bool_dtype(data[col]):
+            cell_writers.append(write_number)
+        else:
+            cell_writers.append(write_mixed)
+    # Only one batch of rows is turned into Python values at a time.
+    for start in range(0, data.shape[0], STREAMING_BATCH_ROWS):
+        batch = data.iloc[start:start + STREAMING_BATCH_ROWS]
+        for row, values in enumerate(batch.itertuples(index=False, name=None), start=start + 1):
+            for col, value in enumerate(values):
+                cell_writers[col](row, col, value)
+
+
+def get_lock_owner(excel_file):
+    """
+    Read who has an Excel file open from its ~$ owner file. Return '' if it can't be found.
+
+    Excel names the owner file by replacing the start of the filename with ~$ (the first two characters
+    for longer names, nothing for short ones), and stores the user name length in the first byte.
+    """
+    folder, name = os.path.split(excel_file)
+    for owner_name in ['~$' + name[2:], '~$' + name]:
         try:
-            open(file, 'r+')
-        except FileNotFoundError:
+            with open(os.path.join(folder, owner_name), 'rb') as file:
+                data = file.read(256)
+        except OSError:
+            continue
+        if data:
+            return data[1:1 + data[0]].decode('cp1252', errors='replace').strip()
+    return ''
+
+
+def check_file_lock(excel_file):
+    """Return None if a file can be written to, otherwise the user that has it open ('' if unknown)."""
+    try:
+        with open(excel_file, 'r+b'):
             pass
-        except PermissionError:
-            return True
-    return False
+    except FileNotFoundError:
+        return None
+    except PermissionError:
+        return get_lock_owner(excel_file)
+    return None
+
+
+def check_file_locks(*excel_files):
+    """Check all the files at once, and return a dictionary of file --> owner for any that are open."""
+    excel_files = [i for i in excel_files if i]
+    if not excel_files:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(len(excel_files), 8)) as executor:
+        owners = list(executor.map(check_file_lock, excel_files))
+    return {file: owner for file, owner in zip(excel_files, owners) if owner is not None}
+
+
+def describe_file_locks(locks):
+    """Put together a message listing the open files and who has them open."""
+    return '\n'.join(f'{os.path.basename(file)} (open by {owner or "unknown user"})' for file, owner in locks.items())
+
+
+def save_error(*excel_files):
+    """Check Excel files and return True if any file is open."""
+    locks = check_file_locks(*excel_files)
+    if locks:
+        logger.warning(f'The following files are currently open:\n{describe_file_locks(locks)}')
+    return bool(locks)
 
 
 def form_date(input_date):
@@ -177,32 +339,56 @@ def form_date(input_date):
         return input_date
 
 
+def form_dates(column):
+    """Run form_date over a column, parsing each distinct value only once."""
+    codes, uniques = pd.factorize(column)
+    formatted = np.empty(len(uniques) + 1, dtype=object)
+    formatted[:-1] = [form_date(i) for i in uniques]
+    values = formatted[codes]
+    # Blanks/NaNs get code -1, so put back whatever was there.
+    missing = codes < 0
+    values[missing] = column.to_numpy(dtype=object)[missing]
+    return pd.Series(values, index=column.index).infer_objects()
+
+
+def to_numeric_where_possible(column):
+    """Convert the numeric strings in a column to numbers, and leave everything else (and typed columns) as-is."""
+    kind = pd.api.types.infer_dtype(column, skipna=True)
+    if column.dtype == object and kind in ['string', 'mixed', 'mixed-integer']:
+        values = column.to_numpy(dtype=object)
+        if kind == 'string':
+            text = column.notna().to_numpy()
+        else:
+            text = np.array([isinstance(i, str) for i in values], dtype=bool)
+        numbers = pd.to_numeric(column[text], errors='coerce').to_numpy()
+        # Strings that aren't numbers come back NaN, so they stay put.
+        parsed = ~pd.isna(numbers)
+        if parsed.any():
+            values = values.copy()
+            values[np.flatnonzero(text)[parsed]] = numbers[parsed]
+            column = pd.Series(values, index=column.index, name=column.name).infer_objects()
+    return column.fillna('') if column.hasnans else column
+
+
 def tab_save_prep(writer, data, sheet_name):
-    """Prepares a commissions file for being saved."""
+    """Prepares a commissions file for being saved (without changing the data passed in)."""
+    # Work on a shallow copy, since whole columns get swapped out below rather than edited.
+    data = data.copy(deep=False)
     # Make sure desired columns are numeric, and replace zeros in non-commission columns with blanks.
-    for col in NUMERICAL_COLUMNS:
-        try:
-            if col not in ['Actual Comm Paid', 'Sales Commission']:
-                fill = ''
-                data[col].replace(0, '', inplace=True)
-            else:
-                fill = 0
-            data[col] = pd.to_numeric(data[col], errors='coerce').fillna(fill)
-        except KeyError:
-            pass
+    for col in [i for i in NUMERICAL_COLUMNS if i in data]:
+        values = data[col]
+        if not pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+            values = pd.to_numeric(values, errors='coerce')
+        if col not in ['Actual Comm Paid', 'Sales Commission']:
+            data[col] = values.mask(values == 0).fillna('')
+        else:
+            data[col] = values.fillna(0)
     # Convert individual numbers to numeric in rest of columns.
-    mixed_cols = [col for col in list(data) if col not in NUMERICAL_COLUMNS]
     skip_cols = ['Invoice Number', 'Part Number', 'Principal']
-    mixed_cols = [i for i in mixed_cols if i not in skip_cols]
-    for col in mixed_cols:
-        data[col] = data[col].map(lambda x: pd.to_numeric(x, errors='ignore')).fillna('')
-    date_cols = ['Invoice Date', 'Date Added', 'Paid Date']
+    for col in [i for i in data if i not in NUMERICAL_COLUMNS and i not in skip_cols]:
+        data[col] = to_numeric_where_possible(data[col])
     # Format the dates correctly where possible.
-    for col in date_cols:
-        try:
-            data[col] = data[col].map(lambda x: form_date(x))
-        except KeyError:
-            pass
-    data.to_excel(writer, sheet_name=sheet_name, index=False)
-    # Do the Excel formatting.
-    table_format(sheet_data=data, sheet_name=sheet_name, workbook=writer)
+    for col in [i for i in ['Invoice Date', 'Date Added', 'Paid Date'] if i in data]:
+        data[col] = form_dates(data[col])
+    # Write the tab and do the Excel formatting.
+    write_sheet(writer, data, sheet_name)
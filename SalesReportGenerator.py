@@ -3,11 +3,16 @@ import numpy as np
 import time
 import datetime
 import os
+import shutil
 import logging
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
 from dateutil.parser import parse
 from RCExcelTools import tab_save_prep, save_error, PivotTables
-from FileIO import load_salespeople_info, load_com_master, load_run_com, load_acct_list, load_lookup_master
-# from PDFReportGenerator import pdfReport
+from BackupManager import snapshot_file
+from FileIO import (load_salespeople_info, load_com_master, load_run_com, load_acct_list,
+                    load_lookup_master, load_principal_info, save_excel_files)
+from PDFReportGenerator import create_pdf_statements
 
 logger = logging.getLogger(__name__)
 
@@ -79,50 +84,133 @@ def data_by_princ_tab(input_data):
     return princ_tab
 
 
-def create_quarterly_report(comm_data, comm_qtr, salespeople, sales_info):
-    """Builds the report that runs at the end of each quarter."""
-    print('---\nCreating end-of-quarter report.')
+def get_quarter_months(year, month):
+    """Returns the Comm Months (YYYY-M) in the quarter so far, counting back from the given month."""
+    num_prev_mos = (month - 1) % 3
+    return [f'{year}-{i}' for i in range(month, month - num_prev_mos - 1, -1)]
+
+
+def sales_principal_totals(comm_data, sales_info, salespeople=None):
+    """
+    Total up the Paid-On Revenue and commissions for each salesperson and principal, in one groupby.
+
+    Commission is split between salespeople the same way as get_sales_comm_data: each line counts
+    once for its CM salesperson and once for its design salesperson (if it's someone else), and
+    shared lines get their Actual Comm Paid scaled by the CM Split and their Sales Commission
+    recalculated from the salesperson's percentage.
+
+    Arguments:
+    comm_data -- The commissions data to total up.
+    sales_info -- Salespeople Info, for the sales percentages.
+    salespeople -- Sales initials to include (defaults to everyone in Salespeople Info).
+
+    Returns a DataFrame with columns Salesperson, Principal, Paid-On Revenue, Actual Comm Paid and
+    Sales Commission, sorted by salesperson then principal.
+    """
+    total_cols = ['Paid-On Revenue', 'Actual Comm Paid', 'Sales Commission']
+    if salespeople is None:
+        salespeople = sales_info['Sales Initials'].values
+    comm_pct = sales_info.drop_duplicates('Sales Initials').set_index('Sales Initials')['Sales Percentage'] / 100
+    lines = comm_data[['CM Sales', 'Design Sales', 'Principal', 'CM Split'] + total_cols].reset_index(drop=True)
+    shared = ((lines['CM Sales'] != '') & (lines['Design Sales'] != '')).to_numpy()
+    split = np.where(lines['CM Sales'] != lines['Design Sales'], lines['CM Split'] / 100, 1)
+    cm_lines = lines.assign(Salesperson=lines['CM Sales'], Share=np.where(shared, split, 1), Shared=shared)
+    # Lines where the design salesperson is also the CM salesperson only count once.
+    other_design = (lines['Design Sales'] != lines['CM Sales']).to_numpy()
+    design_lines = lines[other_design].assign(Salesperson=lines['Design Sales'][other_design],
+                                              Share=np.where(shared, 1 - split, 1)[other_design],
+                                              Shared=shared[other_design])
+    lines = pd.concat([cm_lines, design_lines], ignore_index=True)
+    lines = lines[lines['Salesperson'].isin(salespeople)]
+    lines['Actual Comm Paid'] = lines['Actual Comm Paid'] * lines['Share']
+    lines['Sales Commission'] = lines['Sales Commission'].where(
+        ~lines['Shared'], lines['Salesperson'].map(comm_pct) * lines['Actual Comm Paid'])
+    return lines.groupby(['Salesperson', 'Principal'], dropna=False)[total_cols].sum().reset_index()
+
+
+def sales_totals_tab(totals, salespeople):
+    """Lay out the salesperson/principal totals with a total line for each salesperson above their principals."""
+    total_cols = ['Actual Comm Paid', 'Sales Commission']
+    person_totals = totals.groupby('Salesperson')[total_cols].sum()
+    tabs = []
+    for person in salespeople:
+        person_total = pd.DataFrame({'Salesperson': [person], 'Principal': [np.nan]})
+        for col in total_cols:
+            person_total[col] = person_totals[col].get(person, 0)
+        tabs.append(person_total)
+        tabs.append(totals.loc[totals['Salesperson'] == person, ['Principal'] + total_cols])
+    return pd.concat(tabs, ignore_index=True, sort=False)[['Salesperson', 'Principal'] + total_cols]
+
+
+def get_quarterly_report_path(comm_qtr):
+    """Where the quarterly report for a quarter (YYYYQ#) gets saved."""
+    return os.path.join(reports_dir, f'Quarterly Commission Report {comm_qtr}.xlsx')
+
+
+def quarterly_report_tabs(comm_data, totals, salespeople):
+    """Build the tabs (and tab names) of the end-of-quarter report from the salesperson/principal totals."""
     # ---------------------------------------------------------
     # Build the tab with commissions broken down by principal.
     # ---------------------------------------------------------
     princ_tab = data_by_princ_tab(input_data=comm_data)
-    for princ_row in princ_tab.index:
-        actual_comm = princ_tab.loc[princ_row, 'Actual Comm Paid']
-        revenue = princ_tab.loc[princ_row, 'Paid-On Revenue']
-        if actual_comm and revenue:
-            true_comm_pct = actual_comm / revenue
-        else:
-            true_comm_pct = ''
-        princ_tab.loc[princ_row, 'True Comm %'] = true_comm_pct
+    actual_comm = pd.to_numeric(princ_tab['Actual Comm Paid'])
+    revenue = pd.to_numeric(princ_tab['Paid-On Revenue'])
+    princ_tab['True Comm %'] = (actual_comm / revenue).where((actual_comm != 0) & (revenue != 0), '')
     # ---------------------------------------------------------------------------
     # Build the tab with commissions broken down by salesperson, then principal.
     # ---------------------------------------------------------------------------
-    sales_tab = pd.DataFrame(columns=['Salesperson', 'Principal', 'Actual Comm Paid', 'Sales Commission'])
-    row = 0
-    for person in salespeople:
-        sales_data = get_sales_comm_data(salesperson=person, input_data=comm_data, sales_info=sales_info)
-        sales_tab.loc[row, 'Salesperson'] = person
-        sales_tab.loc[row, 'Actual Comm Paid'] = np.sum(sales_data['Actual Comm Paid'])
-        sales_tab.loc[row, 'Sales Commission'] = np.sum(sales_data['Sales Commission'])
-        row += 1
-        for princ in sorted(sales_data['Principal'].unique()):
-            sales_tab.loc[row, 'Principal'] = princ
-            princ_data = sales_data[sales_data['Principal'] == princ]
-            sales_tab.loc[row, 'Actual Comm Paid'] = np.sum(princ_data['Actual Comm Paid'])
-            sales_tab.loc[row, 'Sales Commission'] = np.sum(princ_data['Sales Commission'])
-            row += 1
-    # -----------------
-    # Save the report.
-    # -----------------
-    filename = os.path.join(reports_dir, 'Quarterly Commission Report ' + comm_qtr + '.xlsx')
-    writer = pd.ExcelWriter(filename, engine='xlsxwriter', datetime_format='mm/dd/yyyy')
-    tab_save_prep(writer=writer, data=comm_data, sheet_name='Comm Data')
-    tab_save_prep(writer=writer, data=princ_tab, sheet_name='Principals')
-    tab_save_prep(writer=writer, data=sales_tab, sheet_name='Salespeople')
-    if not save_error(filename):
-        writer.save()
-    else:
-        print('Error saving quarter commission report.')
+    sales_tab = sales_totals_tab(totals, salespeople)
+    return [comm_data, princ_tab, sales_tab], ['Comm Data', 'Principals', 'Salespeople']
+
+
+def save_quarterly_files(files, totals, comm_qtr, salespeople, sales_info):
+    """
+    Save the end-of-quarter Excel files while the PDF statements are rendered alongside them.
+
+    The statements are built from the same salesperson/principal totals as the Salespeople tab. They're
+    rendered into a temporary folder in the Reports folder, and only moved into place once the Excel
+    files have been saved, so a failed save doesn't leave statements behind for a quarter that wasn't
+    recorded. A problem with the statements is logged but doesn't undo the save.
+    Returns True if the Excel files were saved.
+    """
+    temp_dir = os.path.join(reports_dir, f'Statements {comm_qtr}.{uuid4().hex[:8]}.tmp')
+    try:
+        os.makedirs(temp_dir)
+    except OSError as error:
+        logger.error(f'Error creating a folder for the quarterly PDF statements, so they were skipped: {error}')
+        return save_excel_files(files, write_tab=tab_save_prep)
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            statements = executor.submit(create_pdf_statements, totals=totals, sales_info=sales_info,
+                                         principal_info=load_principal_info(), output_dir=temp_dir,
+                                         comm_qtr=comm_qtr, salespeople=salespeople)
+            saved = save_excel_files(files, write_tab=tab_save_prep)
+            try:
+                written = statements.result()
+            except Exception as error:
+                logger.error(f'Error creating the quarterly PDF statements: {error}')
+                written = []
+        if saved:
+            for file_path in written:
+                try:
+                    os.replace(file_path, os.path.join(reports_dir, os.path.basename(file_path)))
+                except OSError as error:
+                    logger.error(f'Error saving {os.path.basename(file_path)} (is it open?): {error}')
+        elif written:
+            logger.info('The quarterly PDF statements were discarded, since the Excel files were not saved.')
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return saved
+
+
+def create_quarterly_report(comm_data, comm_qtr, salespeople, sales_info):
+    """Builds the report and PDF statements that run at the end of each quarter. Returns the totals."""
+    logger.info('Creating end-of-quarter report.')
+    totals = sales_principal_totals(comm_data, sales_info, salespeople)
+    files = {get_quarterly_report_path(comm_qtr): quarterly_report_tabs(comm_data, totals, salespeople)}
+    if not save_quarterly_files(files, totals, comm_qtr, salespeople, sales_info):
+        logger.error('Error saving quarter commission report.')
+    return totals
 
 
 def main(run_com):
@@ -131,25 +219,37 @@ def main(run_com):
     If run_com is not supplied, then no new data is read/appended;
     reports are run instead on the data for the most recent month in Commissions Master.
     """
+    # The Commissions Master and Lookup Master get overwritten when adding a new RC, so make sure
+    # they aren't open before doing any work.
+    if run_com and save_error(data_dir + '\\Commissions Master.xlsx', look_dir + '\\Lookup Master - Current.xlsx'):
+        logger.error('Please close the Commissions Master and Lookup Master and try again.\n*Program Terminated*')
+        return
+
     logger.info('Loading the data from Commissions Master...')
     # --------------------------------------------------------
     # Load in the supporting files, exit if any aren't found.
     # --------------------------------------------------------
     sales_info = load_salespeople_info()
     acct_list = load_acct_list()
-    com_mast, master_files = load_com_master()
-    if any([acct_list.empty, sales_info.empty, com_mast.empty, master_files.empty]):
+    if any([acct_list.empty, sales_info.empty]):
+        logger.error('Error loading files.\n*Program Terminated*')
+        return
+    if run_com:
+        # The new data gets appended to the Commissions Master, so we need all of it.
+        com_mast, master_files = load_com_master()
+    else:
+        # Reruns only report on the last five quarters shipped and the current quarter's Comm Months,
+        # so only those lines are kept as the Commissions Master is read in.
+        com_mast, master_files = load_com_master(recent_quarters=5)
+    if any([com_mast.empty, master_files.empty]):
         logger.error('Error loading files.\n*Program Terminated*')
         return
-    # Grab the column list for use later.
-    master_cols = list(com_mast)
 
     # ------------------------------------------------------------------
     # Determine the commission months that are currently in the Master.
     # ------------------------------------------------------------------
-    comm_months = com_mast['Comm Month'].unique()
     try:
-        comm_months = [parse(str(i).strip()) for i in comm_months if i != '']
+        comm_months = [parse(str(i).strip()) for i in com_mast['Comm Month'].unique() if str(i).strip() != '']
     except ValueError:
         logger.error('Error parsing dates in Comm Month column of Commissions Master!'
                      ' Please check that all dates are in standard formatting and '
@@ -157,6 +257,8 @@ def main(run_com):
         return
     # Grab the most recent month in Commissions Master.
     last_month = max(comm_months)
+    # Grab the column list for use later.
+    master_cols = list(com_mast)
 
     if run_com:
         look_mast = load_lookup_master()
@@ -255,7 +357,7 @@ def main(run_com):
     revenue_data = com_mast[com_mast['Quarter Shipped'].isin(quarters)]
     revenue_data.reset_index(drop=True, inplace=True)
     if run_com:
-        revenue_data = revenue_data.append(running_com, ignore_index=True, sort=False)
+        revenue_data = pd.concat([revenue_data, running_com], ignore_index=True, sort=False)
     # Tag the data by current Design Sales in the Account List.
     for cust in revenue_data['T-End Cust'].unique():
         # Check for a single match in Account List.
@@ -292,12 +394,11 @@ def main(run_com):
         return
     # Determine how many months back we need to go.
     num_prev_mos = (current_month - 1) % 3
-    months = range(current_month, current_month - num_prev_mos - 1, -1)
-    qtr_mos = [f'{current_year}-{i}' for i in months]
+    qtr_mos = get_quarter_months(current_year, current_month)
     qtr_data = com_mast_tracked[com_mast_tracked['Comm Month'].isin(qtr_mos)]
     # Compile the quarter data.
     if run_com:
-        comm_data = qtr_data.append(running_com, ignore_index=True, sort=False)
+        comm_data = pd.concat([qtr_data, running_com], ignore_index=True, sort=False)
     else:
         comm_data = qtr_data
     del qtr_data, com_mast_tracked
@@ -327,15 +428,15 @@ def main(run_com):
         # Also grab any nonstandard splits.
         cm_data = split_data[split_data['CM Sales'] == person]
         cm_data = cm_data[cm_data['CDS'] != person]
-        design_data = design_data.append(cm_data, ignore_index=True, sort=False)
+        design_data = pd.concat([design_data, cm_data], ignore_index=True, sort=False)
         # Get rid of empty Quarter Shipped lines.
         design_data = design_data[design_data['Quarter Shipped'] != '']
         design_data.reset_index(drop=True, inplace=True)
 
         # Write the raw data to a file.
         filename = os.path.join(reports_dir, f'{person} Revenue Report - {current_yr_mo}.xlsx')
-        writer = pd.ExcelWriter(filename, engine='xlsxwriter', datetime_format='mm/dd/yyyy')
-        tab_save_prep(writer=writer, data=design_data, sheet_name='Raw Data')
+        with pd.ExcelWriter(filename, engine='xlsxwriter', datetime_format='mm/dd/yyyy') as writer:
+            tab_save_prep(writer=writer, data=design_data, sheet_name='Raw Data')
 
         # Create the revenue pivot table.
         pivots.create_pivot_table(excel_file=filename, data_sheet_name='Raw Data',
@@ -369,7 +470,7 @@ def main(run_com):
         final_report = get_sales_comm_data(salesperson=person, input_data=comm_data,
                                            sales_info=sales_info)
         # Append the data.
-        final_report = final_report.append(qq_condensed, ignore_index=True, sort=False)
+        final_report = pd.concat([final_report, qq_condensed], ignore_index=True, sort=False)
         # Total up the Paid-On Revenue and Actual/Sales Commission.
         report_total = pd.DataFrame(columns=['Salesperson', 'Paid-On Revenue', 'Actual Comm Paid',
                                              'Sales Commission'], index=[0])
@@ -386,16 +487,15 @@ def main(run_com):
         person_total = princ_tab[princ_tab['Principal'] == 'Grand Total']
         person_total['Salesperson'] = person
         person_total['Principal'] = ''
-        sales_tot = sales_tot.append(person_total, ignore_index=True, sort=False)
-        sales_tot = sales_tot.append(princ_tab[princ_tab['Principal'] != 'Grand Total'],
-                                     ignore_index=True, sort=False)
+        sales_tot = pd.concat([sales_tot, person_total, princ_tab[princ_tab['Principal'] != 'Grand Total']],
+                              ignore_index=True, sort=False)
 
         # Write report to file.
         filename = os.path.join(reports_dir, f'{person} Commission Report - {current_yr_mo}.xlsx')
-        writer = pd.ExcelWriter(filename, engine='xlsxwriter', datetime_format='mm/dd/yyyy')
-        # Prepare the data in Excel.
-        tab_save_prep(writer=writer, data=princ_tab, sheet_name='Principals')
-        tab_save_prep(writer=writer, data=final_report, sheet_name='Raw Data')
+        with pd.ExcelWriter(filename, engine='xlsxwriter', datetime_format='mm/dd/yyyy') as writer:
+            # Prepare the data in Excel.
+            tab_save_prep(writer=writer, data=princ_tab, sheet_name='Principals')
+            tab_save_prep(writer=writer, data=final_report, sheet_name='Raw Data')
 
         pivots.create_pivot_table(excel_file=filename,  data_sheet_name='Raw Data',
                                   pivot_sheet_name='Comm Table', row_fields=['T-End Cust', 'Principal'],
@@ -408,11 +508,6 @@ def main(run_com):
         current_qtr = f'{current_year}Q{int(current_month / 3)}'
         create_quarterly_report(comm_data=comm_data, comm_qtr=current_qtr,
                                 salespeople=salespeople, sales_info=sales_info)
-        # fullName = sales['Salesperson'].iloc[0]
-        # priorComm = sales['Prior Qtr Commission'].iloc[0]
-        # priorDue = sales['Prior Qtr Due'].iloc[0]
-        # salesDraw = sales['Sales Draw'].iloc[0]
-        # pdfReport(fullName, finalReport, priorComm, priorDue, salesDraw)
 
     # ------------------------------------------------------
     # Create the tabs for the reported Running Commissions.
@@ -433,8 +528,8 @@ def main(run_com):
     # -----------------------------------
     # Write the raw data to a file.
     filename = os.path.join(reports_dir, f'Revenue Report - {current_yr_mo}{RC_addon}.xlsx')
-    writer = pd.ExcelWriter(filename, engine='xlsxwriter', datetime_format='mm/dd/yyyy')
-    tab_save_prep(writer=writer, data=revenue_data, sheet_name='Raw Data')
+    with pd.ExcelWriter(filename, engine='xlsxwriter', datetime_format='mm/dd/yyyy') as writer:
+        tab_save_prep(writer=writer, data=revenue_data, sheet_name='Raw Data')
 
     # Add the pivot table for revenue by quarter.
     pivots.create_pivot_table(excel_file=filename,  data_sheet_name='Raw Data',
@@ -475,13 +570,13 @@ def main(run_com):
                 new_lookup = running_com.loc[row, lookup_cols]
                 new_lookup['Date Added'] = datetime.datetime.now().date()
                 new_lookup['Last Used'] = datetime.datetime.now().date()
-                look_mast = look_mast.append(new_lookup, ignore_index=True)
+                look_mast = pd.concat([look_mast, new_lookup.to_frame().T], ignore_index=True)
 
         # --------------------------------------------------------------
         # Append the new Running Commissions to the Commissions Master.
         # --------------------------------------------------------------
-        com_mast = com_mast.append(running_com, ignore_index=True, sort=False)
-        master_files = master_files.append(files_processed, ignore_index=True, sort=False)
+        com_mast = pd.concat([com_mast, running_com], ignore_index=True, sort=False)
+        master_files = pd.concat([master_files, files_processed], ignore_index=True, sort=False)
         # Convert commission dollars to numeric.
         master_files['Total Commissions'] = pd.to_numeric(master_files['Total Commissions'],
                                                           errors='coerce').fillna(0)
@@ -499,30 +594,25 @@ def main(run_com):
               'Please close these files and try again.\n*Program Terminated*')
         return
 
-    if run_com:
-        # Write the Commissions Master file if new RC data was added to it.
-        writer1 = pd.ExcelWriter(filename_1, engine='xlsxwriter', datetime_format='mm/dd/yyyy')
-        tab_save_prep(writer=writer1, data=com_mast, sheet_name='Master')
-        tab_save_prep(writer=writer1, data=master_files, sheet_name='Files Processed')
-
-        # Write the Lookup Master.
-        writer2 = pd.ExcelWriter(filename_2, engine='xlsxwriter', datetime_format='mm/dd/yyyy')
-        tab_save_prep(writer=writer2, data=look_mast, sheet_name='Lookup')
-
     # Write the Running Commissions report.
-    writer3 = pd.ExcelWriter(filename_3, engine='xlsxwriter', datetime_format='mm/dd/yyyy')
-    tab_save_prep(writer=writer3, data=running_com, sheet_name='Data')
+    rc_tabs = [running_com, sales_tot, princ_tab]
+    rc_tab_names = ['Data', 'Salesperson Totals', 'Principal Totals']
     if run_com:
         # Only write the Files Processed tab if it's a new RC.
-        tab_save_prep(writer=writer3, data=files_processed, sheet_name='Files Processed')
-    tab_save_prep(writer=writer3, data=sales_tot, sheet_name='Salesperson Totals')
-    tab_save_prep(writer=writer3, data=princ_tab, sheet_name='Principal Totals')
-
-    # Save the files.
+        rc_tabs.insert(1, files_processed)
+        rc_tab_names.insert(1, 'Files Processed')
+    files = {filename_3: (rc_tabs, rc_tab_names)}
     if run_com:
-        writer1.save()
-        writer2.save()
-    writer3.save()
+        # Back up the Commissions Master before it gets overwritten.
+        snapshot_file(filename_1)
+        # Write the Commissions Master and Lookup Master if new RC data was added.
+        files[filename_1] = ([com_mast, master_files], ['Master', 'Files Processed'])
+        files[filename_2] = (look_mast, 'Lookup')
+
+    # Save the files all together.
+    if not save_excel_files(files, write_tab=tab_save_prep):
+        print('---\nError saving files! No files were changed.\n*Program Terminated*')
+        return
     print('---\nSales reports finished successfully!')
     if run_com:
         print('---\nCommissions Master updated.\nLookup Master updated.')
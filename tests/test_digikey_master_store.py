@@ -0,0 +1,87 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+import DigikeyMasterStore as DMS
+
+
+def legacy_master():
+    return pd.DataFrame({'Customer': ['Acme', 'Beta'], 'Invoice Date': ['1/5/2024', '1/9/2024'],
+                         'Current Sales': ['AB', 'CD']})
+
+
+class TestDigikeyMasterStore(unittest.TestCase):
+
+    def setUp(self):
+        self.digikey_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.digikey_dir.cleanup)
+        self.location = self.digikey_dir.name
+        with pd.ExcelWriter(self.path(DMS.LEGACY_MASTER_NAME)) as writer:
+            legacy_master().to_excel(writer, sheet_name='Master', index=False)
+            pd.DataFrame({'Filename': ['old.xlsx']}).to_excel(writer, sheet_name='Files Processed', index=False)
+
+    def path(self, name):
+        return os.path.join(self.location, name)
+
+    def store_files(self):
+        return sorted(os.listdir(os.path.join(self.location, DMS.MASTER_STORE_DIR_NAME)))
+
+    def add_month(self, store, digikey_master, files_processed):
+        new_data = pd.DataFrame({'Customer': ['Gamma'], 'Invoice Date': ['2/3/2024'], 'Current Sales': ['EF']})
+        digikey_master = store.append(digikey_master, new_data)
+        files_processed = pd.concat([files_processed, pd.DataFrame({'Filename': ['new.xlsx']})], ignore_index=True)
+        return digikey_master, files_processed
+
+    def test_migration_renames_legacy_master(self):
+        store = DMS.DigikeyMasterStore(self.location)
+        digikey_master, files_processed = store.load()
+        with self.assertLogs(DMS.logger, 'WARNING'):
+            self.assertEqual(store.save(digikey_master, files_processed), [DMS.LEGACY_PARTITION])
+        self.assertFalse(os.path.exists(self.path(DMS.LEGACY_MASTER_NAME)))
+        self.assertTrue(os.path.exists(self.path(DMS.MIGRATED_LEGACY_NAME)))
+        reloaded, reloaded_files = DMS.DigikeyMasterStore(self.location).load()
+        pd.testing.assert_frame_equal(reloaded, digikey_master)
+        self.assertEqual(list(reloaded_files['Filename']), ['old.xlsx'])
+
+    def test_restore_undoes_save(self):
+        store = DMS.DigikeyMasterStore(self.location)
+        store.save(*store.load())
+        before = self.store_files()
+        digikey_master, files_processed = self.add_month(store, *store.load())
+        digikey_master.loc[0, 'Current Sales'] = 'EF'
+        changed_rows = [True, False, False]
+        self.assertEqual(store.save(digikey_master, files_processed, changed_rows, keep_backups=True),
+                         [DMS.LEGACY_PARTITION, '2024-02'])
+        store.restore()
+        self.assertEqual(self.store_files(), before)
+        reloaded, reloaded_files = DMS.DigikeyMasterStore(self.location).load()
+        pd.testing.assert_frame_equal(reloaded, legacy_master())
+        self.assertEqual(list(reloaded_files['Filename']), ['old.xlsx'])
+        # The changes are still waiting to be saved.
+        store.save(digikey_master, files_processed, changed_rows)
+        self.assertEqual(len(DMS.DigikeyMasterStore(self.location).load()[0]), 3)
+
+    def test_failed_save_leaves_store_intact(self):
+        store = DMS.DigikeyMasterStore(self.location)
+        store.save(*store.load())
+        before = self.store_files()
+        digikey_master, files_processed = self.add_month(store, *store.load())
+        real_replace = os.replace
+
+        def fail_on_manifest(source, destination):
+            if destination == store.manifest_path and source.endswith('.tmp'):
+                raise PermissionError('manifest is locked')
+            real_replace(source, destination)
+
+        with mock.patch.object(DMS.os, 'replace', fail_on_manifest):
+            with self.assertRaises(PermissionError):
+                store.save(digikey_master, files_processed)
+        self.assertEqual(self.store_files(), before)
+        pd.testing.assert_frame_equal(DMS.DigikeyMasterStore(self.location).load()[0], legacy_master())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import os
+import socketserver
+import tempfile
+import threading
+import unittest
+from email import message_from_string
+
+import pandas as pd
+
+from MailDigikeyReports import SMTPPool, MailJob, DEFAULT_BODY, send_bulk, find_sales_reports, build_report_jobs
+
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough of an SMTP server to test against. Like a real server, it won't take a MAIL before
+    the client has said EHLO/HELO, and it can hang up after a set number of messages per connection.
+    """
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply('220 stub ESMTP')
+        greeted = False
+        sent = 0
+        while True:
+            line = self.rfile.readline().decode()
+            if not line:
+                return
+            command = line.strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                greeted = True
+                self.reply('250 stub')
+            elif command.startswith('MAIL'):
+                self.reply('250 ok' if greeted else '503 5.5.1 EHLO/HELO first')
+            elif command.startswith('RCPT'):
+                self.reply('550 no such user' if 'BAD' in command else '250 ok')
+            elif command.startswith('DATA'):
+                self.reply('354 go ahead')
+                data = []
+                for line in iter(self.rfile.readline, b''):
+                    if line in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(line.decode())
+                with server.lock:
+                    server.messages.append(''.join(data))
+                self.reply('250 ok')
+                sent += 1
+                if server.hang_up_after and sent >= server.hang_up_after:
+                    return
+            elif command.startswith('QUIT'):
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class StubSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, hang_up_after=0):
+        super().__init__(('127.0.0.1', 0), StubSMTPHandler)
+        self.hang_up_after = hang_up_after
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = []
+
+
+class MailTestCase(unittest.TestCase):
+    hang_up_after = 0
+
+    def setUp(self):
+        self.server = StubSMTPServer(self.hang_up_after)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestSendBulk(MailTestCase):
+
+    def test_delivers_each_job_with_attachments(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            report = os.path.join(temp_dir, 'report.xlsx')
+            with open(report, 'wb') as file:
+                file.write(b'report data')
+            jobs = [MailJob(f'sales{i}@example.com', f'Report {i}', files=[report]) for i in range(6)]
+            results = send_bulk('reports@example.com', jobs, port=self.port, workers=2)
+        self.assertEqual([i.send_to for i in results], [i.send_to for i in jobs])
+        self.assertTrue(all(i.delivered for i in results))
+        self.assertEqual(len(self.server.messages), 6)
+        # Sessions are reused, so there's one connection per worker rather than per message.
+        self.assertLessEqual(self.server.connections, 2)
+        msg = message_from_string(self.server.messages[0])
+        names = [i.get_filename() for i in msg.walk() if i.get_filename()]
+        self.assertEqual(names, ['report.xlsx'])
+
+    def test_failed_recipient_is_recorded(self):
+        jobs = [MailJob('good@example.com', 'Report'), MailJob('BAD@example.com', 'Report')]
+        results = send_bulk('reports@example.com', jobs, port=self.port, workers=1)
+        self.assertEqual([i.delivered for i in results], [True, False])
+        self.assertIn('550', results[1].error)
+
+
+class TestReconnect(MailTestCase):
+    # The server drops the connection after every message.
+    hang_up_after = 1
+
+    def test_reconnects_and_greets_again(self):
+        with SMTPPool('127.0.0.1', self.port) as pool:
+            for i in range(3):
+                pool.sendmail('reports@example.com', f'sales{i}@example.com', f'Subject: {i}\r\n\r\nmessage {i}')
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.server.connections, 3)
+
+
+class TestReportJobs(MailTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.reports_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.reports_dir.cleanup)
+        for name in ['AB Commission Report - 2024-3.xlsx', 'AB Revenue Report - 2024-3.xlsx',
+                     'AB Commission Report - 2024-2.xlsx', 'CD Commission Report - 2024-3.xlsx',
+                     'Insight With Salespeople.xlsx']:
+            with open(os.path.join(self.reports_dir.name, name), 'wb') as file:
+                file.write(name.encode())
+        self.sales_info = pd.DataFrame({'Sales Initials': ['AB', 'CD', 'EF'],
+                                        'Email': ['ab@example.com', '', 'ef@example.com']})
+
+    def path(self, name):
+        return os.path.join(self.reports_dir.name, name)
+
+    def test_find_sales_reports(self):
+        reports = find_sales_reports(self.reports_dir.name, ['AB', 'CD', 'EF'], '2024-3')
+        self.assertEqual(reports, {'AB': [self.path('AB Commission Report - 2024-3.xlsx'),
+                                          self.path('AB Revenue Report - 2024-3.xlsx')],
+                                   'CD': [self.path('CD Commission Report - 2024-3.xlsx')],
+                                   'EF': []})
+
+    def test_jobs_skip_missing_addresses(self):
+        reports = find_sales_reports(self.reports_dir.name, ['AB', 'CD', 'EF'], '2024-3')
+        jobs = build_report_jobs(self.sales_info, reports, shared_files=[self.path('Insight With Salespeople.xlsx')])
+        # CD has no email address. EF has no reports of their own, but still gets the Insight file.
+        self.assertEqual([i.send_to for i in jobs], ['ab@example.com', 'ef@example.com'])
+        self.assertEqual(jobs[0].body, DEFAULT_BODY)
+        self.assertEqual(len(jobs[0].files), 3)
+        self.assertEqual(jobs[1].files, [self.path('Insight With Salespeople.xlsx')])
+
+    def test_jobs_need_email_column(self):
+        reports = find_sales_reports(self.reports_dir.name, ['AB'], '2024-3')
+        self.assertEqual(build_report_jobs(self.sales_info.drop(columns='Email'), reports), [])
+
+    def test_jobs_send(self):
+        reports = find_sales_reports(self.reports_dir.name, ['AB', 'CD', 'EF'], '2024-3')
+        jobs = build_report_jobs(self.sales_info, reports, shared_files=[self.path('Insight With Salespeople.xlsx')])
+        results = send_bulk('reports@example.com', jobs, port=self.port)
+        self.assertTrue(all(i.delivered for i in results))
+        msg = message_from_string(self.server.messages[0])
+        self.assertIn('Attached are your latest reports', msg.get_payload()[0].get_payload())
+
+
+if __name__ == '__main__':
+    unittest.main()
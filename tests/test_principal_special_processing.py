@@ -0,0 +1,143 @@
+import os
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+import PrincipalSpecialProcessing as PSP
+
+# Expected outputs were produced by the original OSR/ISS/ATS/GLO processing on the same inputs,
+# so these pin the rule-driven processing to the old behavior.
+DISTY_MAP = pd.DataFrame({'Search Abbreviation': ['arrow', 'avnet', 'digikey']})
+
+
+def osr_sheet():
+    return pd.DataFrame({'Item': ['1', '2', '3', '4'], 'Material Number': ['M1', 'M2', 'M3', 'M4'],
+                         'Customer Name': ['Acme', 'Beta', 'Gamma', 'Delta'], 'Sales Date': ['1/2/2024'] * 4,
+                         'Rep 1 %': [0.5, '', '', 0.25], 'Rep 2 %': ['', 0.4, '', 0.75],
+                         'Invoiced Dollars': [100, '250.5', 'n/a', 40],
+                         'Reported Distributor': ['Arrow', '', 'Avnet', '']})
+
+
+def iss_sheet():
+    return pd.DataFrame({'Name': ['OEM', 'OEM', 'POS', 'OEM', 'OEM Direct'], 'Commission Due': [1, 2, 3, 4, 5],
+                         'Sales Region': ['San Jose', 'Austin', 'Boston', 'Reno', 'Denver'],
+                         'City': ['', '', 'Boston', '', ''],
+                         'Reported Customer': ['Arrow Electronics', 'Arrow/Avnet Inc', 'Arrow', 'Acme Corp', 'Digi-Key'],
+                         'Reported Distributor': ['', '', 'Arrow', '', ''], 'Invoiced Dollars': [10, 20, 30, 40, 50]})
+
+
+def ats_sheet():
+    return pd.DataFrame({'Resale': [10, 20, 30, 40], 'Cost': [8, 16, 24, 32], 'Invoiced Dollars': [10, 'x', 30, 40],
+                         'Reported Distributor': ['Digi-Key', 'MOUSER ELEC', 'Arrow', '']})
+
+
+OSR_EXPECTED = {
+    'Unmapped': ['1', '2', '3', '4'], 'Unmapped 2': ['M1', 'M2', 'M3', 'M4'],
+    'Unmapped 3': ['Acme', 'Beta', 'Gamma', 'Delta'], 'Unmapped 4': ['1/2/2024'] * 4,
+    'Rep 1 %': [0.5, 0.4, '', 0.25], 'Rep 2 %': ['', 0.4, '', 0.75],
+    'Invoiced Dollars': [100.0, 250.5, 0.0, 40.0], 'Reported Distributor': ['Arrow', '', 'Avnet', ''],
+    'Paid-On Revenue': [100.0, 250.5, 0.0, 40.0], 'Comm Source': ['Resale'] * 4}
+ISS_EXPECTED = {
+    'OEM/POS': ['OEM', 'OEM', 'POS', 'OEM', 'OEM Direct'], 'Unmapped': [1, 2, 3, 4, 5],
+    'Sales Region': ['San Jose', 'Austin', 'Boston', 'Reno', 'Denver'],
+    'City': ['San Jose', 'Austin', 'Boston', 'Reno', 'Denver'],
+    'Reported Customer': ['Arrow Electronics', 'Arrow/Avnet Inc', 'Arrow', 'Acme Corp', 'Digi-Key'],
+    'Reported Distributor': ['Arrow Electronics', '', 'Arrow', '', 'Digi-Key'],
+    'Invoiced Dollars': [10, 20, 30, 40, 50], 'Comm Source': ['Resale'] * 5}
+GLO_EXPECTED = {
+    'Invoiced Dollars': [100.0, 20.5], 'Paid-On Revenue': [100.0, 20.5], 'Commission Rate': [0.05, 0.05],
+    'Actual Comm Paid': [5.0, 1.0250000000000001], 'Comm Source': ['Resale', 'Resale']}
+ATS_EXPECTED = {
+    'Extended Resale': [10, 20, 30, 40], 'Extended Cost': [8, 16, 24, 32],
+    'Invoiced Dollars': [10.0, 0.0, 30.0, 40.0], 'Reported Distributor': ['Digi-Key', 'MOUSER ELEC', 'Arrow', ''],
+    'Paid-On Revenue': [10.0, 0.0, 30.0, 40.0], 'Comm Source': ['Cost', 'Cost', 'Resale', 'Resale']}
+
+
+class TestPrincipalProcessing(unittest.TestCase):
+
+    def setUp(self):
+        # Use only the built-in rules, not any principalRules file lying around.
+        self.lookups_dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch.dict(PSP.DIRECTORIES, {'COMM_LOOKUPS_DIR': self.lookups_dir.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.lookups_dir.cleanup)
+        PSP.load_principal_rules.cache_clear()
+        self.addCleanup(PSP.load_principal_rules.cache_clear)
+
+    def process(self, principal, sheet, sheet_name='Sheet1'):
+        PSP.preprocess_by_principal(principal, sheet, sheet_name)
+        PSP.process_by_principal(principal, sheet, sheet_name, DISTY_MAP)
+        return sheet
+
+    def test_osr(self):
+        result = self.process('OSR', osr_sheet(), 'POS')
+        pd.testing.assert_frame_equal(result, pd.DataFrame(OSR_EXPECTED))
+
+    def test_osr_world_star(self):
+        result = self.process('OSR', osr_sheet(), 'World Star POS')
+        expected = pd.DataFrame(OSR_EXPECTED).assign(**{'Reported Distributor': 'World Star'})
+        pd.testing.assert_frame_equal(result, expected)
+
+    def test_iss(self):
+        result = self.process('ISS', iss_sheet())
+        pd.testing.assert_frame_equal(result, pd.DataFrame(ISS_EXPECTED))
+
+    def test_ats(self):
+        result = self.process('ATS', ats_sheet())
+        pd.testing.assert_frame_equal(result, pd.DataFrame(ATS_EXPECTED))
+
+    def test_glo(self):
+        result = self.process('GLO', pd.DataFrame({'Invoiced Dollars': [100, '20.5']}))
+        pd.testing.assert_frame_equal(result, pd.DataFrame(GLO_EXPECTED))
+
+    def test_glo_keeps_reported_commission(self):
+        sheet = pd.DataFrame({'Invoiced Dollars': [100, 50], 'Commission Rate': [0.04, 0.06], 'Actual Comm Paid': [4, 3]})
+        expected = sheet.assign(**{'Paid-On Revenue': [100, 50], 'Comm Source': 'Resale'})
+        pd.testing.assert_frame_equal(self.process('GLO', sheet), expected)
+
+    def test_glo_without_revenue_stops(self):
+        # With no Paid-On Revenue the commission can't be worked out, so (as before) the Commission Rate
+        # is filled in but the rest of the processing, including the Comm Source, is skipped.
+        with self.assertLogs(PSP.logger, 'WARNING'):
+            result = self.process('GLO', pd.DataFrame({'Reported Customer': ['A', 'B']}))
+        expected = pd.DataFrame({'Reported Customer': ['A', 'B'], 'Commission Rate': [0.05, 0.05]})
+        pd.testing.assert_frame_equal(result, expected)
+
+    def test_abr_uses_only_the_first_matching_tab_rule(self):
+        sheet = pd.DataFrame({'Invoiced Dollars': [100.0], 'Actual Comm Paid': [3.0], 'Reported Distributor': ['A']})
+        self.process('ABR', sheet, 'MoComm Adj')
+        self.assertEqual(sheet.loc[0, 'Paid-On Revenue'], 70.0)
+        self.assertEqual(sheet.loc[0, 'Commission Rate'], 0.03)
+
+    def test_ops_run_in_listed_order(self):
+        seen = []
+        sheet = pd.DataFrame({'a': [1]})
+        with mock.patch.dict(PSP.CUSTOM_OPS, {'peek': lambda sheet, *args: seen.extend(sheet.columns)}):
+            PSP.apply_ops(sheet, [{'op': 'constant', 'column': 'b', 'value': 2},
+                                  {'op': 'custom', 'function': 'peek'},
+                                  {'op': 'copy', 'column': 'c', 'source': 'b'}], 'Sheet1', None)
+        self.assertEqual(seen, ['a', 'b'])
+        self.assertEqual(list(sheet.columns), ['a', 'b', 'c'])
+
+    def test_bad_rules_in_file_are_skipped(self):
+        file_rules = {'AAA': {'rules': [{'ops': [{'op': 'custom', 'function': 'missing'}]}]},
+                      'BBB': {'rules': [{'ops': [{'op': 'copy', 'source': 'Invoiced Dollars'}]}]},
+                      'ISS': {'rules': [{'ops': [{'op': 'unknown', 'column': 'City'}]}]},
+                      'DDD': {'rules': [{'ops': [{'op': 'constant', 'column': 'Comm Source', 'value': 'Cost'}]}]}}
+        with open(os.path.join(self.lookups_dir.name, PSP.PRINCIPAL_RULES_FILE), 'w') as file:
+            json.dump(file_rules, file)
+        with self.assertLogs(PSP.logger, 'ERROR') as logs:
+            rules = PSP.load_principal_rules()
+        self.assertEqual(len(logs.output), 3)
+        self.assertNotIn('AAA', rules)
+        self.assertNotIn('BBB', rules)
+        self.assertIs(rules['ISS'], PSP.PRINCIPAL_RULES['ISS'])
+        self.assertEqual(rules['DDD'], file_rules['DDD'])
+
+
+if __name__ == '__main__':
+    unittest.main()